@@ -0,0 +1,291 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Streaming authenticated encryption of backup archives at rest.
+
+UCS archives hold the F5's private keys and MineMeld/Panorama exports hold
+credentials, so the backup scripts can encrypt them as they are downloaded:
+each block of data is hashed, encrypted and written in the same pass, and the
+plain archive never touches the disk. Decryption for restores is streamed
+the same way.
+
+File format ('.enc' suffix added to the archive name):
+-header: MAGIC, the segment size (4 byte big endian) and a random 7 byte
+    nonce prefix
+-frames: 4 byte big endian ciphertext length followed by the AES-256-GCM
+    ciphertext and tag of one segment of plain data. Every frame but the last
+    holds exactly one full segment.
+Each frame's nonce is the prefix, the frame number and a flag set only for
+the last frame, and the header is authenticated with every frame, so frames
+cannot be altered, reordered, dropped or the file truncated without
+decryption failing. A file part written by an interrupted download can be
+resumed after its last complete frame.
+
+Keys are 32 random bytes, stored base64 encoded in a key file readable only
+by the backup user. Encryption needs the optional 'cryptography' package
+(pip install cryptography), the backup scripts work unencrypted without it.
+
+Usage:
+python archiveCrypto.py genkey [keyFile]
+python archiveCrypto.py encrypt <archive> [keyFile]
+python archiveCrypto.py decrypt <archive.enc> <output file> [keyFile]
+"""
+import sys, os, struct, hashlib, base64, logging
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#suffix added to the name of an encrypted archive
+ENC_SUFFIX = ".enc"
+MAGIC = b"ARCENC01"
+#plain bytes per frame
+SEGMENT_SIZE = 1024 * 1024
+KEY_FILE = os.path.join(os.getcwd(), "backups.key")
+_HEADER = struct.Struct(">8sI7s")
+_LENGTH = struct.Struct(">I")
+_TAG_SIZE = 16
+
+
+class ArchiveDecryptError(ValueError):
+    """raised when an encrypted archive is truncated, altered or the key is wrong"""
+
+
+def _cipher(key):
+    if AESGCM is None:
+        raise RuntimeError("archive encryption needs the cryptography package, pip install cryptography")
+    if len(key) != 32:
+        raise ValueError(f'archive key must be 32 bytes, not {len(key)}')
+    return AESGCM(key)
+
+
+def _nonce(prefix, counter, last):
+    return prefix + struct.pack(">IB", counter, int(last))
+
+
+def generate_key(keyFile=KEY_FILE):
+    """writes a new random key to 'keyFile' (owner read/write only), returns the key"""
+    key = os.urandom(32)
+    fd = os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as keyOut:
+        keyOut.write(base64.b64encode(key).decode()+"\n")
+    return key
+
+
+def load_key(keyFile=KEY_FILE):
+    """returns the 32 byte key stored base64 encoded in 'keyFile'"""
+    with open(keyFile) as keyIn:
+        key = base64.b64decode(keyIn.read().strip())
+    if len(key) != 32:
+        raise ValueError(f'{keyFile} does not hold a 32 byte key')
+    return key
+
+
+class EncryptingWriter:
+    """
+    This class encrypts data written to it, in order, into an encrypted
+    archive file.
+
+    Methods:
+    - write - buffers data, encrypting and writing each full segment
+    - close - writes the last frame and closes the file. close(final=False)
+        only closes the file, leaving it resumable.
+    - resume - (classmethod) reopens a part written file after its last
+        complete frame
+    The class can also be used as a context manager, the last frame is only
+    written if the block exits without an exception.
+
+    Instance Attributes:
+    -self.path - the encrypted file
+    -self.plainBytes - plain bytes written to complete frames so far
+    -self.sha256 - hashlib sha256 of the encrypted file as written, so the
+        stored file can be scrubbed without the key
+    """
+
+    def __init__(self, path, key, segmentSize=SEGMENT_SIZE, _resumed=None):
+        self.path = path
+        self._aead = _cipher(key)
+        self.sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        if _resumed:
+            self._file, self._header, self._prefix, self.segmentSize, self._counter, self.sha256 = _resumed
+        else:
+            self.segmentSize = segmentSize
+            self._prefix = os.urandom(7)
+            self._header = _HEADER.pack(MAGIC, segmentSize, self._prefix)
+            self._counter = 0
+            self._file = open(path, 'wb')
+            self._file.write(self._header)
+            self.sha256.update(self._header)
+        self.plainBytes = self._counter * self.segmentSize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *exc):
+        self.close(final=excType is None)
+
+    def _frame(self, data, last):
+        ciphertext = self._aead.encrypt(_nonce(self._prefix, self._counter, last), bytes(data), self._header)
+        frame = _LENGTH.pack(len(ciphertext)) + ciphertext
+        self._file.write(frame)
+        self.sha256.update(frame)
+        self._counter += 1
+        self.plainBytes += len(data)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.segmentSize:
+            self._frame(self._buffer[:self.segmentSize], False)
+            del self._buffer[:self.segmentSize]
+
+    def close(self, final=True):
+        if self._file.closed:
+            return
+        if final:
+            self._frame(self._buffer, True)
+            self._buffer = bytearray()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    @classmethod
+    def resume(cls, path, key, consume):
+        """
+        Reopens encrypted file 'path' written by an interrupted run. The plain
+        data of every complete frame is passed to 'consume' (eg to restore hash
+        state), anything after the last complete frame is cut off and writing
+        continues from there.
+
+        Returns:
+        EncryptingWriter, its plainBytes is the number of plain bytes recovered
+        """
+
+        aead = _cipher(key)
+        archive = open(path, 'r+b')
+        try:
+            header = archive.read(_HEADER.size)
+            magic, segmentSize, prefix = _HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ArchiveDecryptError(f'{path} is not an encrypted archive')
+            sha256 = hashlib.sha256(header)
+            counter, position = 0, _HEADER.size
+            while True:
+                length = archive.read(_LENGTH.size)
+                if len(length) < _LENGTH.size or _LENGTH.unpack(length)[0] != segmentSize + _TAG_SIZE:
+                    break
+                ciphertext = archive.read(segmentSize + _TAG_SIZE)
+                try:
+                    data = aead.decrypt(_nonce(prefix, counter, False), ciphertext, header)
+                except InvalidTag:
+                    break
+                consume(data)
+                sha256.update(length + ciphertext)
+                counter += 1
+                position = archive.tell()
+            archive.seek(position)
+            archive.truncate()
+        except (struct.error, ArchiveDecryptError):
+            archive.close()
+            raise ArchiveDecryptError(f'{path} has no valid header, cannot resume')
+        logging.debug(f'DEBUG resuming {path} after {counter} frames')
+        return cls(path, key, _resumed=(archive, header, prefix, segmentSize, counter, sha256))
+
+
+def decrypt_chunks(fileObj, key):
+    """
+    Generator of the plain data of encrypted archive 'fileObj' (open in binary
+    mode), one segment at a time.
+
+    Exceptions:
+    ArchiveDecryptError if any frame fails authentication or the file is
+    truncated. Data already yielded is authentic, but the caller must discard
+    its output if the generator raises.
+    """
+
+    aead = _cipher(key)
+    header = fileObj.read(_HEADER.size)
+    try:
+        magic, segmentSize, prefix = _HEADER.unpack(header)
+    except struct.error:
+        raise ArchiveDecryptError("file too short to be an encrypted archive")
+    if magic != MAGIC:
+        raise ArchiveDecryptError("not an encrypted archive")
+    counter = 0
+    length = fileObj.read(_LENGTH.size)
+    while True:
+        if len(length) < _LENGTH.size:
+            raise ArchiveDecryptError(f'archive truncated after {counter} frames')
+        ciphertext = fileObj.read(_LENGTH.unpack(length)[0])
+        length = fileObj.read(_LENGTH.size)
+        last = not length
+        try:
+            yield aead.decrypt(_nonce(prefix, counter, last), ciphertext, header)
+        except InvalidTag:
+            raise ArchiveDecryptError(f'frame {counter} failed authentication, archive altered, ' \
+            'truncated or wrong key')
+        if last:
+            return
+        counter += 1
+
+
+def encrypt_file(path, key, remove=True):
+    """
+    Encrypts existing archive 'path' to 'path'.enc, eg for archives taken
+    before encryption was enabled, removing the plain file if 'remove'
+
+    Returns:
+    dictionary with the plain 'md5' and 'sha256' and the 'encryptedSha256'
+    """
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(path, 'rb') as plain, EncryptingWriter(path+ENC_SUFFIX, key) as writer:
+        for block in iter(lambda: plain.read(SEGMENT_SIZE), b''):
+            md5.update(block)
+            sha256.update(block)
+            writer.write(block)
+    if remove:
+        os.remove(path)
+    return {"md5": md5.hexdigest(), "sha256": sha256.hexdigest(), "encryptedSha256": writer.sha256.hexdigest()}
+
+
+def decrypt_file(path, destination, key):
+    """
+    Decrypts archive 'path' to 'destination'. The output is written to a
+    temporary file and only renamed to 'destination' once every frame has
+    authenticated.
+
+    Returns:
+    dictionary of the plain 'md5' and 'sha256'
+    """
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    try:
+        with open(path, 'rb') as encrypted, open(destination+".tmp", 'wb') as plain:
+            for data in decrypt_chunks(encrypted, key):
+                md5.update(data)
+                sha256.update(data)
+                plain.write(data)
+    except (ArchiveDecryptError, OSError):
+        if os.path.exists(destination+".tmp"):
+            os.remove(destination+".tmp")
+        raise
+    os.replace(destination+".tmp", destination)
+    return {"md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "genkey":
+        generate_key(*sys.argv[2:])
+        print(f'key written to {sys.argv[2] if len(sys.argv) == 3 else KEY_FILE}')
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "encrypt":
+        print(encrypt_file(sys.argv[2], load_key(*sys.argv[3:])))
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == "decrypt":
+        print(decrypt_file(sys.argv[2], sys.argv[3], load_key(*sys.argv[4:])))
+    else:
+        print(__doc__)
@@ -0,0 +1,374 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+SQLite catalog of every archive taken by F5Archive (UCS), mmBackup (MineMeld
+zip) and the Panorama export (running-config XML).
+
+Archive file names carry a random prefix or suffix, so finding eg the latest
+verified UCS of a device by scanning the backup directories means guesswork.
+Each backup is instead recorded as a row with its device, hostname, type,
+location, size, digests, duration and throughput. Indexed queries return the
+latest archive, archives by date range and archives by device, and the
+retention (retention.py) and reporting tools read the catalog rather than
+the directories.
+
+Usage:
+python backupCatalog.py report [maxAgeHours]
+python backupCatalog.py latest <device>
+python backupCatalog.py import <backup dir> [<backup dir> ...]
+"""
+import sys, os, json, sqlite3, datetime, logging
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#archive types
+UCS = "ucs"
+MINEMELD = "minemeld"
+PANORAMA = "panorama"
+#text config snapshot (F5Archive.snapshot_config), only taken when the config changes
+CONFIG = "config"
+CATALOG_FILE = os.path.join(os.getcwd(), "backups.catalog.sqlite")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    hostname TEXT,
+    type TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    taken TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    sha256 TEXT,
+    digests TEXT,
+    seconds REAL,
+    throughput REAL,
+    verified INTEGER NOT NULL DEFAULT 0,
+    delta INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    replicated TEXT,
+    UNIQUE (directory, name)
+);
+CREATE INDEX IF NOT EXISTS archives_device ON archives (device, type, taken);
+CREATE INDEX IF NOT EXISTS archives_taken ON archives (taken);
+CREATE INDEX IF NOT EXISTS archives_directory ON archives (directory, deleted);
+"""
+#columns added since the first schema, added to existing catalogs on open
+_ADDED_COLUMNS = {"replicated": "TEXT"}
+
+
+def archive_type(fileName):
+    """returns the archive type of a backup file name, or empty string"""
+    #archives stored encrypted (see archiveCrypto.py) have '.enc' added
+    if fileName.endswith(".enc"):
+        fileName = fileName[:-len(".enc")]
+    if fileName.endswith((".ucs", ".ucs.delta")):
+        return UCS
+    if fileName.endswith(".zip"):
+        return MINEMELD
+    if fileName.endswith(".xml"):
+        return PANORAMA
+    if fileName.endswith(".conf.gz"):
+        return CONFIG
+    return ""
+
+
+class BackupCatalog:
+    """
+    This class records backups in, and queries, a SQLite catalog file.
+
+    Each call opens its own short lived connection, so one BackupCatalog can be
+    shared by the threads of the fleet backup and by separate processes. The
+    database is in WAL mode so reports can read while backups are recorded.
+
+    Methods:
+    - record - adds (or replaces) the row for an archive file
+    - update - changes columns of an archive's row, eg verified or delta
+    - mark_deleted - flags an archive as deleted by retention
+    - latest - newest archive, optionally of one device and/or type
+    - by_date - archives taken within a date range
+    - by_device - archives of one device, newest first
+    - unreplicated - archives not yet copied to the object store (replication.py)
+    - digests - digests recorded for an archive file, eg for the scrubber
+    - archives - (taken, file name) of the archives in a directory, for retention
+    - report - newest archive of every device and type, flagging stale ones
+    - import_dir - catalogs archives already in a directory (backfill)
+
+    Rows are returned as dictionaries of column:value, with 'digests' decoded.
+
+    Instance Attributes:
+    -self.path - the catalog database file
+    """
+
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(archives)")}
+            for column, columnType in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    db.execute(f'ALTER TABLE archives ADD COLUMN {column} {columnType}')
+            db.execute("CREATE INDEX IF NOT EXISTS archives_replicated ON archives (replicated, deleted)")
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _query(self, sql, args=()):
+        db = self._connect()
+        try:
+            rows = db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+        rows = [dict(row) for row in rows]
+        for row in rows:
+            if "digests" in row:
+                row["digests"] = json.loads(row["digests"] or "{}")
+        return rows
+
+    def _write(self, sql, args):
+        db = self._connect()
+        try:
+            with db:
+                return db.execute(sql, args).rowcount
+        finally:
+            db.close()
+
+    def record(self, device, archiveType, path, hostname=None, digests=None, seconds=None, \
+    verified=False, taken=None):
+        """
+        Adds the archive file 'path' to the catalog
+
+        Parameters:
+        device - string, management IP or hostname the backup was taken from
+        archiveType - string, one of UCS, MINEMELD, PANORAMA or CONFIG
+        path - string, archive file path, its size is read from the file
+        hostname - string, device hostname if known
+        digests - dictionary of algorithm:hexdigest, eg from the .digest sidecar
+        seconds - float, time the backup (download) took
+        verified - boolean, True if the digest was checked against the device
+        taken - datetime, default now
+
+        Backfilled rows (import_dir) still keyed by the UCS 'hostname' or the
+        snapshot file name form of 'device' ('10.0.0.1_443' for
+        '10.0.0.1:443') are re-keyed to 'device', so latest() and by_device()
+        see one series per device.
+
+        Returns:
+        integer, number of rows written
+        """
+
+        digests = digests or {}
+        size = os.path.getsize(path)
+        throughput = size / seconds if seconds else None
+        taken = (taken or datetime.datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+        if hostname and hostname != device:
+            self._write("UPDATE archives SET device=? WHERE device=? AND hostname=?", (device, hostname, hostname))
+        if device.replace(":", "_") != device:
+            self._write("UPDATE archives SET device=? WHERE device=?", (device, device.replace(":", "_")))
+        return self._write("""INSERT INTO archives (device, hostname, type, directory, name,
+        taken, size, md5, sha256, digests, seconds, throughput, verified)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (directory, name) DO UPDATE SET device=excluded.device,
+        hostname=excluded.hostname, type=excluded.type, taken=excluded.taken,
+        size=excluded.size, md5=excluded.md5, sha256=excluded.sha256,
+        digests=excluded.digests, seconds=excluded.seconds, throughput=excluded.throughput,
+        verified=excluded.verified, delta=0, deleted=0, replicated=NULL""", \
+        (device, hostname, archiveType, os.path.abspath(os.path.dirname(path)), \
+        os.path.basename(path), taken, size, digests.get("md5"), digests.get("sha256"), \
+        json.dumps(digests), seconds, throughput, int(verified)))
+
+    def update(self, path, **columns):
+        """
+        Sets 'columns' (eg verified=True, delta=True, md5=...) on the row for
+        archive file 'path'. Returns the number of rows changed.
+        """
+
+        allowed = ("hostname", "md5", "sha256", "seconds", "throughput", "verified", "delta", "deleted", \
+        "replicated")
+        names = [name for name in columns if name in allowed]
+        if len(names) != len(columns):
+            raise ValueError(f'cannot update catalog columns {set(columns) - set(allowed)}')
+        assignments = ", ".join(f'{name}=?' for name in names)
+        return self._write(f'UPDATE archives SET {assignments} WHERE directory=? AND name=?', \
+        [columns[name] for name in names] + [os.path.abspath(os.path.dirname(path)), \
+        os.path.basename(path)])
+
+    def mark_deleted(self, path):
+        """flags archive file 'path' as deleted, its history stays in the catalog"""
+        return self.update(path, deleted=True)
+
+    def latest(self, device=None, archiveType=None, verified=False):
+        """
+        Returns the row of the newest archive not deleted, optionally limited to
+        one 'device', one 'archiveType' and to archives verified against the
+        device. None if no archive matches.
+        """
+
+        where, args = ["deleted=0"], []
+        if device:
+            where.append("device=?")
+            args.append(device)
+        if archiveType:
+            where.append("type=?")
+            args.append(archiveType)
+        if verified:
+            where.append("verified=1")
+        rows = self._query(f'SELECT * FROM archives WHERE {" AND ".join(where)} ' \
+        'ORDER BY taken DESC, id DESC LIMIT 1', args)
+        return rows[0] if rows else None
+
+    def by_date(self, start, end=None, archiveType=None, includeDeleted=False):
+        """
+        Returns rows of archives taken from date/datetime 'start' up to, but not
+        including, 'end' (default now), oldest first
+        """
+
+        end = end or datetime.datetime.now() + datetime.timedelta(seconds=1)
+        sql = 'SELECT * FROM archives WHERE taken >= ? AND taken < ?'
+        args = [str(start), str(end)]
+        if archiveType:
+            sql += ' AND type=?'
+            args.append(archiveType)
+        if not includeDeleted:
+            sql += ' AND deleted=0'
+        return self._query(sql+' ORDER BY taken, id', args)
+
+    def by_device(self, device, archiveType=None, limit=None, includeDeleted=False):
+        """returns rows of the archives of 'device', newest first"""
+        sql = 'SELECT * FROM archives WHERE device=?'
+        args = [device]
+        if archiveType:
+            sql += ' AND type=?'
+            args.append(archiveType)
+        if not includeDeleted:
+            sql += ' AND deleted=0'
+        sql += ' ORDER BY taken DESC, id DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return self._query(sql, args)
+
+    def unreplicated(self, archiveType=None):
+        """returns rows of archives not deleted and not yet replicated off site, oldest first"""
+        sql = 'SELECT * FROM archives WHERE replicated IS NULL AND deleted=0'
+        args = []
+        if archiveType:
+            sql += ' AND type=?'
+            args.append(archiveType)
+        return self._query(sql+' ORDER BY taken, id', args)
+
+    def digests(self, path):
+        """returns the digests recorded for archive file 'path', empty if it is not catalogued"""
+        rows = self._query('SELECT digests FROM archives WHERE directory=? AND name=?', \
+        (os.path.abspath(os.path.dirname(path)), os.path.basename(path)))
+        return rows[0]["digests"] if rows else {}
+
+    def archives(self, backupDir):
+        """
+        Returns list of (datetime taken, file name) for every archive in
+        'backupDir' not deleted, as used by retention.retention_plan. Delta
+        stored UCS' are returned under their '.delta' file name.
+        """
+
+        rows = self._query('SELECT name, taken, delta FROM archives WHERE directory=? AND deleted=0', \
+        (os.path.abspath(backupDir),))
+        return [(datetime.datetime.strptime(row["taken"], "%Y-%m-%d %H:%M:%S"), \
+        row["name"]+".delta" if row["delta"] else row["name"]) for row in rows]
+
+    def report(self, maxAge=26):
+        """
+        Returns a plain text report of the newest archive of every device and
+        archive type, stale devices (newest archive older than 'maxAge' hours,
+        or not verified) listed first. Config snapshots are only written when
+        the config changes so are never stale by age. Usable as an email body.
+        """
+
+        rows = self._query("""SELECT * FROM archives AS a WHERE deleted=0 AND id=(SELECT b.id
+        FROM archives AS b WHERE b.device=a.device AND b.type=a.type AND b.deleted=0
+        ORDER BY b.taken DESC, b.id DESC LIMIT 1) ORDER BY device, type""")
+        cutoff = (datetime.datetime.now() - datetime.timedelta(hours=maxAge)).strftime("%Y-%m-%d %H:%M:%S")
+        lines = []
+        for row in rows:
+            stale = (row["taken"] < cutoff and row["type"] != CONFIG) or \
+            (row["type"] == UCS and not row["verified"])
+            rate = f', {row["throughput"] / 1000000:0.1f}MB/s' if row["throughput"] else ""
+            lines.append((not stale, f'{"STALE " if stale else "OK    "}{row["device"]} {row["type"]} ' \
+            f'{row["name"]} taken {row["taken"]}, {row["size"]}bytes{rate}' \
+            f'{"" if row["verified"] else ", not verified"}'))
+        return "\n".join(line for _, line in sorted(lines, key=lambda l: l[0]))
+
+    def import_dir(self, backupDir):
+        """
+        Catalogs archives in 'backupDir' not already in the catalog, eg those
+        taken before the catalog existed. The modification time is used as the
+        time taken, digests come from the '.digest' sidecar if there is one and
+        the device is taken from the UCS hostname or config snapshot name (empty
+        for other types). A hostname or snapshot name of a device already in
+        the catalog is mapped to that device's key (eg the management IP
+        F5Archive records), so imported and live rows form one series.
+
+        Returns:
+        integer, number of archives added
+        """
+
+        known = {name for _, name in self.archives(backupDir)}
+        #device keys of the live rows, by UCS hostname and by snapshot file name prefix
+        devices = {}
+        for row in self._query("SELECT DISTINCT device, hostname FROM archives WHERE device!=''"):
+            devices[row["device"].replace(":", "_")] = row["device"]
+            if row["hostname"] and row["hostname"] != row["device"]:
+                devices[row["hostname"]] = row["device"]
+        added = 0
+        for fileName in sorted(os.listdir(backupDir)):
+            path = os.path.join(backupDir, fileName)
+            archiveType = archive_type(fileName)
+            if not archiveType or fileName in known or not os.path.isfile(path):
+                continue
+            name = fileName[:-len(".delta")] if fileName.endswith(".delta") else fileName
+            #digests of an encrypted archive are recorded against the plain name
+            plainName = name[:-len(".enc")] if name.endswith(".enc") else name
+            digests = {}
+            if os.path.isfile(os.path.join(backupDir, plainName+".digest")):
+                with open(os.path.join(backupDir, plainName+".digest")) as digestFile:
+                    digests = json.load(digestFile)
+            hostname = name.rsplit('_', 2)[0] if archiveType == UCS else None
+            #config snapshots are named after the device they were taken from
+            device = name.rsplit('_', 2)[0] if archiveType == CONFIG else hostname
+            device = devices.get(device, device)
+            taken = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+            if name == fileName:
+                self.record(device or "", archiveType, path, hostname, digests, \
+                taken=taken, verified="remoteMd5" in digests)
+            else:
+                self._record_delta(device, hostname, path, name, digests, taken)
+            added += 1
+        return added
+
+    def _record_delta(self, device, hostname, deltaPath, name, digests, taken):
+        #the full UCS no longer exists, size is that of the delta file
+        self._write("""INSERT OR IGNORE INTO archives (device, hostname, type, directory, name,
+        taken, size, md5, sha256, digests, verified, delta) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)""", \
+        (device, hostname, UCS, os.path.abspath(os.path.dirname(deltaPath)), name, \
+        taken.strftime("%Y-%m-%d %H:%M:%S"), os.path.getsize(deltaPath), digests.get("md5"), \
+        digests.get("sha256"), json.dumps(digests), int("remoteMd5" in digests)))
+
+
+if __name__ == "__main__":
+    catalog = BackupCatalog()
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "report":
+        print(catalog.report(*(float(a) for a in sys.argv[2:])))
+    elif len(sys.argv) == 3 and sys.argv[1] == "latest":
+        print(json.dumps(catalog.latest(sys.argv[2]), indent=2))
+    elif len(sys.argv) > 2 and sys.argv[1] == "import":
+        for backupDir in sys.argv[2:]:
+            print(f'{backupDir}: {catalog.import_dir(backupDir)} archives added')
+    else:
+        print(__doc__)
@@ -0,0 +1,229 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Integrity scrubber for the local backup store.
+
+Re-hashes every stored archive (F5 UCS, MineMeld zips, Panorama XML exports)
+and compares it with the digest recorded when the backup was taken, so silent
+corruption of old copies is found before a restore is needed.
+
+Digests are read from the backup catalog (backupCatalog.py), where every
+backup script records them when the backup is taken, and otherwise from the
+'<archive>.digest' JSON sidecar written by F5Archive.download_ucs. Archives
+without a recorded digest have a sha256 digest recorded on their first scrub
+and are verified against it from then on. Encrypted archives ('.enc', see
+archiveCrypto.py) are checked against the 'encryptedSha256' recorded at
+download, so no key is needed to scrub them. The digests recorded for a UCS
+stored as a delta ('.delta') are those of the UCS it rebuilds, so the delta
+file itself is checked against the digest recorded on its first scrub.
+
+Files are hashed by a process pool using memory-mapped reads, and each worker
+is throttled so the pool as a whole stays under an I/O rate cap and does not
+starve the nightly backup jobs. Progress is written to a state file in the
+first backup directory, so an interrupted scrub resumes where it stopped.
+
+Usage:
+python backupScrub.py [--rate MB/s] [--processes N] [--restart] [--catalog FILE] [dir ...]
+"""
+import argparse, json, os, time, mmap, hashlib, sqlite3, logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from backupCatalog import BackupCatalog, CATALOG_FILE
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#default backup locations used by the backup scripts in this repo
+BACKUP_DIRS = [os.path.join(os.getcwd(), d) for d in ("F5Backups", "MMBackups", "PABackups")]
+#sidecar, working and database files which are not archives themselves,
+#'.tmp' covers the '.verify.tmp' and '.base.tmp' files of store_ucs_delta
+SKIP_SUFFIXES = (".digest", ".journal", ".scrubstate", ".ucslist.json", ".tuning.json", ".tmp", \
+".sqlite", ".sqlite-wal", ".sqlite-shm")
+STATE_FILE = "backups.scrubstate"
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def _hash_file(path, algorithms, rateLimit):
+    """
+    Hashes 'path' with each hashlib algorithm in 'algorithms' using a
+    memory-mapped read, sleeping between blocks so the read rate does not
+    exceed 'rateLimit' bytes per second (0 = unlimited).
+
+    Runs in a pool worker process.
+
+    Returns:
+    tuple of (path, dict of algorithm:hexdigest, error string)
+    """
+
+    hashes = {name: hashlib.new(name) for name in algorithms}
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            #zero length files cannot be memory-mapped
+            if size == 0:
+                return path, {name: h.hexdigest() for name, h in hashes.items()}, ""
+            startTime = time.perf_counter()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, BLOCK_SIZE):
+                    block = mapped[offset:offset + BLOCK_SIZE]
+                    for h in hashes.values():
+                        h.update(block)
+                    if rateLimit:
+                        #sleep off any time we are ahead of the rate cap
+                        ahead = (offset + len(block)) / rateLimit - (time.perf_counter() - startTime)
+                        if ahead > 0:
+                            time.sleep(ahead)
+    except OSError as e:
+        return path, {}, f'ERROR reading {path}: {e}'
+    return path, {name: h.hexdigest() for name, h in hashes.items()}, ""
+
+
+def _read_digest(path, catalog=None):
+    """
+    returns the recorded digest dict for archive 'path', from 'catalog' if it
+    has one for the archive, otherwise from its sidecar, empty if none
+    """
+    if path.endswith(".delta"):
+        #the catalogued digests are of the rebuilt UCS, not the delta file
+        return _read_sidecar(path)
+    recorded = {}
+    if catalog:
+        try:
+            recorded = catalog.digests(path)
+        except sqlite3.Error as e:
+            logging.debug(f'DEBUG catalog digest lookup of {path} failed error: {e}')
+    if path.endswith(".enc"):
+        #the sidecar of the plain name holds the plain digests and that of the .enc file
+        encrypted = recorded.get("encryptedSha256") or \
+        _read_sidecar(path[:-len(".enc")]).get("encryptedSha256")
+        if encrypted:
+            return {"sha256": encrypted}
+    if "sha256" in recorded or "md5" in recorded:
+        return {name: recorded[name] for name in ("sha256", "md5") if name in recorded}
+    return _read_sidecar(path)
+
+
+def _read_sidecar(path):
+    """returns the digest dict of the '.digest' sidecar of 'path', empty if none"""
+    if os.path.isfile(path+".digest"):
+        try:
+            with open(path+".digest") as digestFile:
+                return json.load(digestFile)
+        except ValueError:
+            return {}
+    return {}
+
+
+def scrub_backups(backupDirs=BACKUP_DIRS, processes=4, rateLimit=(50 * 1024 * 1024), resume=True, \
+catalog=None):
+    """
+    Verifies every archive in 'backupDirs' against its recorded digest
+
+    Functionality:
+    -Lists the archives in each backup directory (not recursive), skipping
+    digest, journal and state files
+    -Skips archives already verified by an interrupted scrub if 'resume' is True.
+    A state file records each verified archive with its size and mtime, so an
+    archive that changed since is scrubbed again.
+    -Hashes the remaining archives in a pool of 'processes' workers. The rate
+    cap is shared evenly between the workers.
+    -Archives are checked with sha256 where recorded, otherwise md5, looked
+    up in 'catalog' first and then in the '.digest' sidecars. Archives with
+    no recorded digest have a sha256 digest recorded in a sidecar.
+    -The state file is removed once every archive has been scrubbed, corrupt
+    and unreadable archives are reported in the returned string each run.
+
+    Parameters:
+    backupDirs - list of directories holding archives
+    processes - integer, number of worker processes, default=4
+    rateLimit - integer, total read rate cap in bytes per second, 0 = unlimited,
+    default=(50 * 1024 * 1024)
+    resume - boolean, continue a previous partial scrub, default=True
+    catalog - BackupCatalog the digests are recorded in, default is the
+    catalog file in the working directory if there is one
+
+    Returns:
+    string summary of the scrub, with a line per corrupt, missing digest or
+    unreadable archive
+    """
+
+    status = ""
+    backupDirs = [d for d in backupDirs if os.path.isdir(d)]
+    if not backupDirs:
+        return "ERROR scrub_backups no backup directories found"
+    if catalog is None and os.path.isfile(CATALOG_FILE):
+        catalog = BackupCatalog()
+    stateFile = os.path.join(backupDirs[0], STATE_FILE)
+    scrubbed = {}
+    if resume and os.path.isfile(stateFile):
+        with open(stateFile) as state:
+            for line in state:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #last line may be part written if previous scrub was killed
+                    break
+                scrubbed[entry["path"]] = (entry["size"], entry["mtime"])
+
+    #build list of (path, recorded digest) to scrub
+    work = []
+    for backupDir in backupDirs:
+        for name in sorted(os.listdir(backupDir)):
+            path = os.path.join(backupDir, name)
+            if not os.path.isfile(path) or name.endswith(SKIP_SUFFIXES):
+                continue
+            stat = os.stat(path)
+            if scrubbed.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            work.append((path, _read_digest(path, catalog)))
+
+    verified, recorded, corrupt, errors = 0, 0, 0, 0
+    startTime = time.perf_counter()
+    workerRate = rateLimit / processes if rateLimit else 0
+    with ProcessPoolExecutor(max_workers=processes) as pool, open(stateFile, 'a') as state:
+        futures = {}
+        for path, digest in work:
+            algorithm = "sha256" if "sha256" in digest else "md5" if "md5" in digest else "sha256"
+            futures[pool.submit(_hash_file, path, [algorithm], workerRate)] = (digest, algorithm)
+        for future in as_completed(futures):
+            path, digests, error = future.result()
+            digest, algorithm = futures[future]
+            if error:
+                errors += 1
+                status += f'\n{error}'
+                continue
+            if algorithm not in digest:
+                #first scrub of this archive, record digest to verify against later
+                digest[algorithm] = digests[algorithm]
+                with open(path+".digest", 'w') as digestFile:
+                    json.dump(digest, digestFile)
+                recorded += 1
+            elif digest[algorithm] != digests[algorithm]:
+                corrupt += 1
+                status += f'\nCORRUPT {path} {algorithm} recorded {digest[algorithm]} now {digests[algorithm]}'
+                continue
+            else:
+                verified += 1
+            stat = os.stat(path)
+            state.write(json.dumps({"path": path, "size": stat.st_size, "mtime": stat.st_mtime})+"\n")
+            state.flush()
+    stopTime = time.perf_counter()
+
+    #scrub complete, next run starts afresh
+    os.remove(stateFile)
+    status = f'Scrubbed {len(work)} archives in {stopTime - startTime:0.4f} seconds: ' \
+    f'{verified} verified, {recorded} digests recorded, {corrupt} corrupt, {errors} errors' \
+    f'{", "+str(len(scrubbed))+" skipped (resumed)" if scrubbed else ""}'+status
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify stored backups against recorded digests")
+    parser.add_argument("dirs", nargs="*", default=BACKUP_DIRS, help="backup directories to scrub")
+    parser.add_argument("--rate", type=float, default=50, help="read rate cap in MB/s, 0 = unlimited")
+    parser.add_argument("--processes", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--restart", action="store_true", help="ignore any partial scrub and start again")
+    parser.add_argument("--catalog", help="backup catalog file, default is the one in the working directory")
+    args = parser.parse_args()
+    print(scrub_backups(args.dirs, args.processes, int(args.rate * 1024 * 1024), not args.restart, \
+    BackupCatalog(args.catalog) if args.catalog else None))
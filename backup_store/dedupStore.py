@@ -0,0 +1,292 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Deduplicating backup repository for UCS archives, MineMeld zips and Panorama
+XML exports.
+
+Nightly archives from the same device are mostly the same bytes. Instead of
+storing a full copy each night, archives added to a DedupStore are split into
+variable size chunks with content-defined chunking, so an insertion or
+deletion only changes the chunks around it. Boundaries are anchors, 3 byte
+windows with one byte from each of three fixed byte sets, found by a
+compiled regular expression: the scan runs in the re engine's C loop at
+hundreds of MB/s, where a per byte rolling hash in Python manages a few
+MB/s, which would take minutes per multi GB UCS. Each unique chunk is stored once, zlib compressed, named by its sha256.
+A small JSON manifest per archive lists its chunks, size and digests, so the
+store grows with the amount of change rather than the number of backups.
+
+Layout under the store root:
+chunks/<first 2 hex chars>/<sha256 of chunk> - compressed chunk
+manifests/<archive name>.json - ordered chunk list, size, sha256 (and md5 etc
+    recorded in the archive's .digest sidecar, if it had one)
+
+Usage:
+python dedupStore.py add <archive> [<archive> ...]
+python dedupStore.py restore <archive name> <destination file>
+python dedupStore.py list
+"""
+import sys, json, os, re, hashlib, zlib, random, time, datetime, logging
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#chunk size limits, boundaries are content defined between min and max
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+READ_SIZE = 4 * 1024 * 1024
+#bytes per anchor set, a window matches with (n/256)**3 odds, ie about once
+#every AVG_CHUNK - MIN_CHUNK bytes past the minimum of random data
+ANCHOR_SET_SIZE = round(256 / (AVG_CHUNK - MIN_CHUNK) ** (1 / 3))
+#anchor sets, fixed seed so chunk boundaries are the same on every run
+_random = random.Random(0x5EED)
+_ANCHOR = re.compile(b"".join(b"["+b"".join(re.escape(bytes([byte])) for byte in \
+_random.sample(range(256), ANCHOR_SET_SIZE))+b"]" for _ in range(3)))
+
+
+def _cut_point(data, start, end):
+    """
+    Returns the offset of the next chunk boundary in data[start:end]. The
+    first MIN_CHUNK bytes are skipped, the chunk is cut at MAX_CHUNK if no
+    boundary is found.
+    """
+
+    limit = min(end, start + MAX_CHUNK)
+    if limit - start <= MIN_CHUNK:
+        return limit
+    #the boundary follows the first anchor past the minimum
+    anchor = _ANCHOR.search(data, start + MIN_CHUNK, limit)
+    return anchor.end() if anchor else limit
+
+
+def content_chunks(f):
+    """
+    Generator yielding content defined chunks (bytes) read from binary file
+    object 'f', holding at most READ_SIZE + MAX_CHUNK bytes in memory.
+    """
+
+    buffer = b""
+    eof = False
+    while True:
+        if not eof and len(buffer) < MAX_CHUNK:
+            block = f.read(READ_SIZE)
+            eof = not block
+            buffer += block
+        if not buffer:
+            return
+        start = 0
+        #only cut where a full MAX_CHUNK window is available, unless at eof
+        while len(buffer) - start >= MAX_CHUNK or (eof and start < len(buffer)):
+            cut = _cut_point(buffer, start, len(buffer))
+            yield buffer[start:cut]
+            start = cut
+        buffer = buffer[start:]
+
+
+class DedupStore:
+    """
+    This class stores archives as deduplicated, compressed content defined chunks.
+
+    Methods:
+    - add - chunks an archive file into the store and writes its manifest
+    - restore - rebuilds an archive from its chunks and verifies its digest
+    - verify - rebuilds an archive in memory chunk by chunk and checks its digest
+    - remove - deletes an archive's manifest, gc removes its unreferenced chunks
+    - gc - deletes chunks no longer referenced by any manifest
+    - list - returns the manifests in the store
+
+    Instance Attributes:
+    -self.root - directory holding the store
+    -self.level - zlib compression level for new chunks
+    """
+
+    def __init__(self, root=os.path.join(os.getcwd(), "DedupStore"), level=6):
+        self.root = root
+        self.level = level
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(root, "manifests"), exist_ok=True)
+
+    def _chunk_path(self, chunkHash):
+        return os.path.join(self.root, "chunks", chunkHash[:2], chunkHash)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, "manifests", name+".json")
+
+    def add(self, path, name=None):
+        """
+        Adds the archive at 'path' to the store
+
+        Functionality:
+        -Reads the archive once, splitting it into content defined chunks and
+        hashing the whole archive (sha256) in the same pass
+        -Writes each chunk not already in the store, compressed. Chunks are
+        written to a temporary name and renamed so a crash never leaves a
+        truncated chunk under its final name
+        -Writes the manifest last, so an archive is only listed once all its
+        chunks are stored. Digests from an existing '.digest' sidecar (eg the
+        md5 recorded by F5Archive.download_ucs) are kept in the manifest.
+
+        Parameters:
+        path - string, archive file to add
+        name - string, name to store it under, default is the file name
+
+        Returns:
+        string with archive name, chunk counts and bytes added to the store,
+        or error string
+        """
+
+        name = name or os.path.basename(path)
+        fileHash = hashlib.sha256()
+        chunkList = []
+        newChunks, newBytes, size = 0, 0, 0
+        startTime = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in content_chunks(f):
+                    fileHash.update(chunk)
+                    size += len(chunk)
+                    chunkHash = hashlib.sha256(chunk).hexdigest()
+                    chunkList.append(chunkHash)
+                    chunkPath = self._chunk_path(chunkHash)
+                    if os.path.exists(chunkPath):
+                        continue
+                    os.makedirs(os.path.dirname(chunkPath), exist_ok=True)
+                    compressed = zlib.compress(chunk, self.level)
+                    with open(chunkPath+".tmp", 'wb') as chunkFile:
+                        chunkFile.write(compressed)
+                    os.replace(chunkPath+".tmp", chunkPath)
+                    newChunks += 1
+                    newBytes += len(compressed)
+        except OSError as e:
+            logging.debug(f'DEBUG dedup add {path} failed error: {e}')
+            return f'ERROR dedup add {path} failed: {e}'
+
+        manifest = {}
+        if os.path.isfile(path+".digest"):
+            with open(path+".digest") as digestFile:
+                manifest.update(json.load(digestFile))
+        manifest.update({"name": name, "size": size, "sha256": fileHash.hexdigest(), \
+        "created": str(datetime.datetime.now()), "chunks": chunkList})
+        with open(self._manifest_path(name)+".tmp", 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+        os.replace(self._manifest_path(name)+".tmp", self._manifest_path(name))
+        stopTime = time.perf_counter()
+        return f'{name} size {size}bytes, {len(chunkList)} chunks, {newChunks} new, ' \
+        f'{newBytes}bytes stored in {stopTime - startTime:0.4f} seconds'
+
+    def _read_manifest(self, name):
+        with open(self._manifest_path(name)) as manifestFile:
+            return json.load(manifestFile)
+
+    def _rebuild(self, manifest, out=None):
+        """
+        Decompresses the chunks of 'manifest' in order, writing them to binary
+        file object 'out' if given, while hashing with every algorithm recorded
+        in the manifest.
+
+        Returns:
+        error string, empty if every digest matches
+        """
+
+        algorithms = [a for a in ("sha256", "sha1", "md5") if a in manifest]
+        hashes = {a: hashlib.new(a) for a in algorithms}
+        size = 0
+        for chunkHash in manifest["chunks"]:
+            try:
+                with open(self._chunk_path(chunkHash), 'rb') as chunkFile:
+                    chunk = zlib.decompress(chunkFile.read())
+            except (OSError, zlib.error) as e:
+                return f'ERROR chunk {chunkHash} unreadable: {e}'
+            if hashlib.sha256(chunk).hexdigest() != chunkHash:
+                return f'ERROR chunk {chunkHash} corrupt'
+            for h in hashes.values():
+                h.update(chunk)
+            size += len(chunk)
+            if out:
+                out.write(chunk)
+        if size != manifest["size"]:
+            return f'ERROR size {size} does not match recorded {manifest["size"]}'
+        for algorithm, h in hashes.items():
+            if h.hexdigest() != manifest[algorithm]:
+                return f'ERROR {algorithm} {h.hexdigest()} does not match recorded {manifest[algorithm]}'
+        return ""
+
+    def restore(self, name, destination):
+        """
+        Rebuilds archive 'name' to file 'destination' and verifies it against
+        the digests recorded when it was added. The file is written to a
+        temporary name and only renamed to 'destination' once verified.
+
+        Returns:
+        string with restored archive details, or error string
+        """
+
+        try:
+            manifest = self._read_manifest(name)
+        except (OSError, ValueError) as e:
+            return f'ERROR dedup restore {name} no manifest: {e}'
+        with open(destination+".tmp", 'wb') as out:
+            error = self._rebuild(manifest, out)
+        if error:
+            os.remove(destination+".tmp")
+            return f'ERROR dedup restore {name} {error}'
+        os.replace(destination+".tmp", destination)
+        return f'{name} restored to {destination}, size {manifest["size"]}bytes, sha256 {manifest["sha256"]} verified'
+
+    def verify(self, name):
+        """rebuilds archive 'name' without writing it, returns error string or empty string"""
+        try:
+            return self._rebuild(self._read_manifest(name))
+        except (OSError, ValueError) as e:
+            return f'ERROR dedup verify {name} no manifest: {e}'
+
+    def remove(self, name):
+        """deletes the manifest of archive 'name', run gc to free its chunks"""
+        os.remove(self._manifest_path(name))
+
+    def gc(self):
+        """
+        Deletes every chunk not referenced by a manifest
+
+        Returns:
+        tuple of (chunks deleted, compressed bytes freed)
+        """
+
+        referenced = set()
+        for manifest in self.list():
+            referenced.update(manifest["chunks"])
+        deleted, freed = 0, 0
+        chunksDir = os.path.join(self.root, "chunks")
+        for prefix in os.listdir(chunksDir):
+            for chunkHash in os.listdir(os.path.join(chunksDir, prefix)):
+                if chunkHash not in referenced:
+                    chunkPath = os.path.join(chunksDir, prefix, chunkHash)
+                    freed += os.path.getsize(chunkPath)
+                    os.remove(chunkPath)
+                    deleted += 1
+        return deleted, freed
+
+    def list(self):
+        """returns list of manifest dictionaries for every archive in the store"""
+        manifests = []
+        manifestsDir = os.path.join(self.root, "manifests")
+        for fileName in sorted(os.listdir(manifestsDir)):
+            if fileName.endswith(".json"):
+                with open(os.path.join(manifestsDir, fileName)) as manifestFile:
+                    manifests.append(json.load(manifestFile))
+        return manifests
+
+
+if __name__ == "__main__":
+    store = DedupStore()
+    if len(sys.argv) > 2 and sys.argv[1] == "add":
+        for archive in sys.argv[2:]:
+            print(store.add(archive))
+    elif len(sys.argv) == 4 and sys.argv[1] == "restore":
+        print(store.restore(sys.argv[2], sys.argv[3]))
+    elif len(sys.argv) == 2 and sys.argv[1] == "list":
+        for m in store.list():
+            print(f'{m["name"]}\t{m["size"]}bytes\t{len(m["chunks"])} chunks\t{m["created"]}')
+    else:
+        print(__doc__)
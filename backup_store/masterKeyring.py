@@ -0,0 +1,203 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+SQLite keyring of F5 master keys, one history per device.
+
+A UCS restored to a different (eg replacement) BIG-IP can only decrypt its
+secure attributes with the master key of the device it was taken from, so
+F5Archive.get_f5mk records each device's key here. Previously keys were
+appended to a single f5mk.txt with no device name, which was read in full on
+every call and grew without bound, and across a fleet the 'last line'
+comparison compared keys of different devices.
+
+Each device has at most one current key (enforced by a unique partial index),
+so looking up and comparing the current key is a single indexed row. A key
+seen again only updates 'last_seen', a new key becomes current and the old
+one is kept as history. Writes take the database write lock before reading
+the current key, so devices gathered in parallel by the fleet pipeline (and
+separate processes) update the keyring safely.
+
+The keyring file holds key material and is created readable by its owner only.
+
+Usage:
+python masterKeyring.py list
+python masterKeyring.py history <device or hostname>
+python masterKeyring.py import <f5mk.txt> <device>
+"""
+import sys, os, json, sqlite3, datetime, logging
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+KEYRING_FILE = os.path.join(os.getcwd(), "f5mk.keyring.sqlite")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS masterkeys (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    hostname TEXT,
+    masterkey TEXT NOT NULL,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    current INTEGER NOT NULL DEFAULT 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS masterkeys_current ON masterkeys (device) WHERE current=1;
+CREATE INDEX IF NOT EXISTS masterkeys_device ON masterkeys (device, first_seen);
+"""
+
+
+class MasterKeyring:
+    """
+    This class records and queries F5 master keys in a SQLite keyring file.
+
+    Like BackupCatalog, each call opens its own short lived connection so one
+    MasterKeyring can be shared by threads and processes.
+
+    Methods:
+    - record - records the key read from a device, returns whether it changed
+    - current - the current key row of a device, by IP or hostname
+    - history - every key row of a device by IP or hostname, newest first
+    - devices - the current key row of every device
+    - import_file - adds the keys of an old f5mk.txt to a device's history
+
+    Rows are returned as dictionaries of column:value.
+
+    Instance Attributes:
+    -self.path - the keyring database file
+    """
+
+    def __init__(self, path=KEYRING_FILE):
+        self.path = path
+        if not os.path.exists(path):
+            #create the file owner only before sqlite opens it
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        #isolation_level None so record() controls its own transaction
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _query(self, sql, args=()):
+        db = self._connect()
+        try:
+            return [dict(row) for row in db.execute(sql, args).fetchall()]
+        finally:
+            db.close()
+
+    def record(self, device, masterKey, hostname=None, seen=None):
+        """
+        Records 'masterKey' read from 'device'
+
+        Parameters:
+        device - string, management IP or hostname the key was read from
+        masterKey - string, output of 'f5mku -K'
+        hostname - string, device hostname if known
+        seen - datetime the key was read, default now
+
+        Returns:
+        tuple of (changed boolean, previous current row or None). changed is
+        True if the key is new for the device, False if it was already current.
+        """
+
+        seen = (seen or datetime.datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+        db = self._connect()
+        try:
+            #take the write lock first so concurrent records of one device serialise
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT * FROM masterkeys WHERE device=? AND current=1", (device,)).fetchone()
+                previous = dict(row) if row else None
+                if previous and previous["masterkey"] == masterKey:
+                    db.execute("UPDATE masterkeys SET last_seen=?, hostname=COALESCE(?, hostname) WHERE id=?", \
+                    (max(seen, previous["last_seen"]), hostname, previous["id"]))
+                    changed = False
+                else:
+                    db.execute("UPDATE masterkeys SET current=0 WHERE device=? AND current=1", (device,))
+                    db.execute("""INSERT INTO masterkeys (device, hostname, masterkey, first_seen, last_seen)
+                    VALUES (?, ?, ?, ?, ?)""", (device, hostname, masterKey, seen, seen))
+                    changed = True
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+        return changed, previous
+
+    def current(self, device):
+        """
+        returns the current key row of 'device', a management IP or hostname,
+        None if no key recorded. A device match wins over a hostname match.
+        """
+        rows = self._query("""SELECT * FROM masterkeys WHERE (device=? OR hostname=?) AND current=1
+        ORDER BY device=? DESC, last_seen DESC LIMIT 1""", (device, device, device))
+        return rows[0] if rows else None
+
+    def history(self, device):
+        """returns every key row recorded for 'device' (IP or hostname), newest first"""
+        return self._query("SELECT * FROM masterkeys WHERE device=? OR hostname=? ORDER BY first_seen DESC, id DESC", \
+        (device, device))
+
+    def devices(self):
+        """returns the current key row of every device"""
+        return self._query("SELECT * FROM masterkeys WHERE current=1 ORDER BY device")
+
+    def import_file(self, path, device):
+        """
+        Adds the 'timestamp/key' lines of an f5mk.txt written by the old
+        get_f5mk to the history of 'device'. The last key in the file becomes
+        current, unless the keyring already holds a newer key for the device.
+
+        Returns:
+        integer, number of keys added
+        """
+
+        entries = []
+        with open(path) as keyFile:
+            for line in keyFile:
+                if "/" not in line:
+                    continue
+                #base64 keys can hold '/', the timestamp never does
+                timestamp, masterKey = line.strip().split("/", 1)
+                try:
+                    seen = datetime.datetime.fromisoformat(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+                except ValueError:
+                    continue
+                if entries and entries[-1][1] == masterKey:
+                    entries[-1][2] = seen
+                else:
+                    entries.append([seen, masterKey, seen])
+        current = self.current(device)
+        added = 0
+        for index, (firstSeen, masterKey, lastSeen) in enumerate(entries):
+            if index == len(entries) - 1 and not (current and current["last_seen"] > lastSeen):
+                added += self.record(device, masterKey, seen=datetime.datetime.fromisoformat(firstSeen))[0]
+                self.record(device, masterKey, seen=datetime.datetime.fromisoformat(lastSeen))
+            elif not current or current["masterkey"] != masterKey:
+                db = self._connect()
+                try:
+                    db.execute("""INSERT INTO masterkeys (device, masterkey, first_seen, last_seen, current)
+                    VALUES (?, ?, ?, ?, 0)""", (device, masterKey, firstSeen, lastSeen))
+                finally:
+                    db.close()
+                added += 1
+        return added
+
+if __name__ == "__main__":
+    keyring = MasterKeyring()
+    if len(sys.argv) == 2 and sys.argv[1] == "list":
+        for row in keyring.devices():
+            print(f'{row["device"]} {row["hostname"] or ""} since {row["first_seen"]}, last seen {row["last_seen"]}')
+    elif len(sys.argv) == 3 and sys.argv[1] == "history":
+        print(json.dumps(keyring.history(sys.argv[2]), indent=2))
+    elif len(sys.argv) == 4 and sys.argv[1] == "import":
+        print(f'{keyring.import_file(sys.argv[2], sys.argv[3])} keys imported for {sys.argv[3]}')
+    else:
+        print(__doc__)
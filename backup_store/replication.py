@@ -0,0 +1,308 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Replication of cataloged backups to an S3 compatible object store (AWS S3,
+MinIO, Ceph RGW etc), so the archives do not only exist on the backup
+server's disk.
+
+Archives not yet replicated are read from the backup catalog (see
+backupCatalog.py) and each is uploaded as '<prefix><type>/<device>/<file>'.
+Files larger than one part go as multipart uploads, and the parts of every
+file being replicated share one bounded pool of upload threads, so a multi GB
+UCS goes up as parallel streams rather than one slow copy.
+
+-Skip: the sha256 (or md5 where that is all the catalog holds) of each
+    object's content is stored in its metadata. An archive whose object
+    already exists with the same digest is only marked replicated.
+-Resume: an interrupted multipart upload is left open on the store. The next
+    run finds it in the store's list of incomplete uploads for the key and
+    keeps the parts whose ETag matches the md5 of the local bytes, so only the
+    missing parts are uploaded. Incomplete uploads that are never resumed
+    should be expired with a bucket lifecycle rule.
+
+Needs the optional 'boto3' package (pip install boto3). Credentials are taken
+from the arguments or the usual boto3 sources (environment variables,
+~/.aws/credentials). For on-prem stores or tests, point 'endpointUrl' at eg a
+local MinIO server.
+
+Usage:
+python replication.py <bucket> [--endpoint-url URL] [--prefix P] [--part-size MB]
+    [--parallel N] [--files N] [--type ucs|minemeld|panorama|config]
+"""
+import sys, os, argparse, hashlib, base64, datetime, threading, time, sqlite3, logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from backupCatalog import BackupCatalog
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#default multipart part size, S3 needs at least 5MB for every part but the last
+PART_SIZE = 64 * 1024 * 1024
+#S3 limit of parts per upload, parts grow for files larger than PART_SIZE x MAX_PARTS
+MAX_PARTS = 10000
+#content digests stored in object metadata (x-amz-meta-sha256), in order of preference
+_DIGEST_ALGORITHMS = ("sha256", "md5")
+
+
+class S3Replicator:
+    """
+    This class uploads cataloged archives to an S3 compatible bucket.
+
+    Methods:
+    - replicate - uploads every archive the catalog has not marked replicated
+    - replicate_archive - uploads (or skips) the archive of one catalog row
+    - object_key - the object key an archive is stored under
+    - close - stops the part upload pool. The class can also be used as a
+        context manager, ie 'with S3Replicator(bucket) as replicator:'
+
+    Instance Attributes:
+    -self.bucket - bucket name, it must already exist
+    -self.prefix - prefix added to every object key, eg 'backups/'
+    -self.partSize - multipart part size in bytes
+    -self.maxFiles - archives replicated at once by replicate()
+    -self.catalog - BackupCatalog the archives are read from and marked in
+    -self.client - boto3 S3 client, shared by all threads
+    """
+
+    def __init__(self, bucket, endpointUrl=None, prefix="", accessKey=None, secretKey=None, region=None, \
+    partSize=PART_SIZE, maxParallel=8, maxFiles=4, catalog=None, verify=True):
+        if boto3 is None:
+            raise RuntimeError("replication needs the boto3 package, pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.partSize = max(5 * 1024 * 1024, partSize)
+        self.maxFiles = maxFiles
+        self.catalog = catalog or BackupCatalog()
+        #one connection per part upload thread plus the per file calls
+        self.client = boto3.client("s3", endpoint_url=endpointUrl, aws_access_key_id=accessKey, \
+        aws_secret_access_key=secretKey, region_name=region, verify=verify, config=Config( \
+        max_pool_connections=maxParallel + maxFiles, retries={"max_attempts": 5, "mode": "standard"}))
+        #parts of every file being replicated share this pool, bounding
+        #concurrent uploads (and part buffers in memory) to maxParallel
+        self._parts = ThreadPoolExecutor(max_workers=maxParallel, thread_name_prefix="s3part")
+        self._uploadedLock = threading.Lock()
+        self._uploaded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """waits for running part uploads and stops the part pool"""
+        self._parts.shutdown()
+
+    def object_key(self, row):
+        """returns the object key for catalog 'row'"""
+        device = (row["device"] or "unknown").replace(":", "_")
+        return f'{self.prefix}{row["type"]}/{device}/{self._file_name(row)}'
+
+    @staticmethod
+    def _file_name(row):
+        #a UCS stored as a delta is replicated as its delta file
+        return row["name"]+".delta" if row["delta"] else row["name"]
+
+    @staticmethod
+    def _content_digest(row, path):
+        """
+        Returns (algorithm, hexdigest) of the bytes of 'path'. Taken from the
+        catalog where it describes the stored file, otherwise the file is
+        hashed (delta files, archives cataloged without digests).
+        """
+
+        digests = row["digests"] or {}
+        if not row["delta"]:
+            if row["name"].endswith(".enc"):
+                if digests.get("encryptedSha256"):
+                    return "sha256", digests["encryptedSha256"]
+            else:
+                for algorithm in _DIGEST_ALGORITHMS:
+                    if row.get(algorithm) or digests.get(algorithm):
+                        return algorithm, row.get(algorithm) or digests[algorithm]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return "sha256", sha256.hexdigest()
+
+    def _remote_metadata(self, key):
+        """returns the metadata of object 'key', None if it does not exist"""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)["Metadata"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def replicate_archive(self, row):
+        """
+        Uploads the archive of catalog 'row' unless the bucket already holds it
+        with the same content digest, then marks the row replicated.
+
+        Returns:
+        status string, prefixed 'ERROR' on failure
+        """
+
+        path = os.path.join(row["directory"], self._file_name(row))
+        key = self.object_key(row)
+        startTime = time.perf_counter()
+        try:
+            algorithm, digest = self._content_digest(row, path)
+            size = os.path.getsize(path)
+            remote = self._remote_metadata(key)
+            if remote and remote.get(algorithm) == digest:
+                status = f'{key} already replicated, {algorithm} matches'
+            else:
+                metadata = {algorithm: digest}
+                if size <= self.partSize:
+                    with open(path, 'rb') as f:
+                        self.client.put_object(Bucket=self.bucket, Key=key, Body=f, Metadata=metadata)
+                    self._count(size)
+                    status = f'{key} uploaded'
+                else:
+                    status = self._multipart_upload(path, key, size, metadata)
+                    if status.startswith("ERROR"):
+                        return status
+                seconds = time.perf_counter() - startTime
+                status += f', {size}bytes in {seconds:0.2f} seconds'
+        except (OSError, BotoCoreError, ClientError) as e:
+            logging.debug(f'DEBUG replicate {path} failed error: {e}')
+            return f'ERROR replicating {path}: {e}'
+        try:
+            self.catalog.update(os.path.join(row["directory"], row["name"]), \
+            replicated=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        except (sqlite3.Error, OSError) as e:
+            logging.debug(f'DEBUG catalog update failed error: {e}')
+        return status
+
+    def _count(self, size):
+        with self._uploadedLock:
+            self._uploaded += size
+
+    def _multipart_upload(self, path, key, size, metadata):
+        """
+        Uploads 'path' as a multipart upload, resuming an incomplete upload of
+        the same key if one is open. Parts are uploaded by the shared part pool.
+
+        Returns:
+        status string, prefixed 'ERROR' if any part failed (the upload is left
+        open so the next run resumes it)
+        """
+
+        #whole MB parts, grown if the file would need more than MAX_PARTS
+        partSize = max(self.partSize, -(-size // (MAX_PARTS * 1024 * 1024)) * 1024 * 1024)
+        partCount = -(-size // partSize)
+        uploadId, etags = self._resume_upload(path, key, size, partSize)
+        resumed = len(etags)
+        if not uploadId:
+            uploadId = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, \
+            Metadata=metadata)["UploadId"]
+        futures = {self._parts.submit(self._upload_part, path, key, uploadId, number, \
+        (number - 1) * partSize, min(partSize, size - (number - 1) * partSize)): number \
+        for number in range(1, partCount + 1) if number not in etags}
+        wait(futures)
+        errors = []
+        for future, number in futures.items():
+            try:
+                etags[number] = future.result()
+            except (OSError, BotoCoreError, ClientError) as e:
+                errors.append(f'part {number}: {e}')
+        if errors:
+            return f'ERROR replicating {path}: {len(errors)} of {partCount} parts failed, ' \
+            f'rerun to resume ({errors[0]})'
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=uploadId, \
+        MultipartUpload={"Parts": [{"PartNumber": number, "ETag": etags[number]} for number in sorted(etags)]})
+        return f'{key} uploaded in {partCount} parts of {partSize // (1024 * 1024)}MB' + \
+        (f', {resumed} parts resumed' if resumed else "")
+
+    def _upload_part(self, path, key, uploadId, number, offset, length):
+        """uploads one part, run in the part pool. Returns its ETag"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        md5 = hashlib.md5(data)
+        etag = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=uploadId, PartNumber=number, \
+        Body=data, ContentMD5=base64.b64encode(md5.digest()).decode())["ETag"]
+        self._count(length)
+        return etag
+
+    def _resume_upload(self, path, key, size, partSize):
+        """
+        Looks for an incomplete multipart upload of 'key' left by an earlier run
+
+        Returns:
+        tuple of the upload id (empty if there is nothing to resume) and a
+        dictionary of part number:ETag of the parts already uploaded whose
+        md5 matches the local file. Uploads that cannot be resumed (different
+        part size or content) are aborted.
+        """
+
+        uploads = self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=key).get("Uploads", [])
+        uploads = sorted((upload for upload in uploads if upload["Key"] == key), key=lambda u: u["Initiated"])
+        for stale in uploads[:-1]:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=stale["UploadId"])
+        if not uploads:
+            return "", {}
+        uploadId = uploads[-1]["UploadId"]
+        etags = {}
+        paginator = self.client.get_paginator("list_parts")
+        with open(path, 'rb') as f:
+            for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=uploadId):
+                for part in page.get("Parts", []):
+                    number = part["PartNumber"]
+                    expected = min(partSize, size - (number - 1) * partSize)
+                    f.seek((number - 1) * partSize)
+                    #ETag of a part is its md5, unless the store encrypts with KMS
+                    if part["Size"] != expected or part["ETag"].strip('"') != hashlib.md5(f.read(expected)).hexdigest():
+                        logging.debug(f'DEBUG {key} upload {uploadId} part {number} does not match, restarting')
+                        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=uploadId)
+                        return "", {}
+                    etags[number] = part["ETag"]
+        logging.debug(f'DEBUG {key} resuming upload {uploadId} with {len(etags)} parts')
+        return uploadId, etags
+
+    def replicate(self, archiveType=None):
+        """
+        Replicates every archive not yet marked replicated in self.catalog,
+        self.maxFiles at a time, their parts sharing the part pool
+
+        Returns:
+        plain text summary with a line per archive
+        """
+
+        rows = self.catalog.unreplicated(archiveType)
+        self._uploaded = 0
+        startTime = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.maxFiles, thread_name_prefix="s3file") as files:
+            statuses = list(files.map(self.replicate_archive, rows))
+        seconds = time.perf_counter() - startTime
+        failed = sum(status.startswith("ERROR") for status in statuses)
+        summary = f'Replicated {len(rows) - failed} of {len(rows)} archives to {self.bucket}, ' \
+        f'{self._uploaded}bytes uploaded in {seconds:0.2f} seconds' + \
+        (f' ({self._uploaded / seconds / 1000000:0.1f} MB/s)' if self._uploaded and seconds else "")
+        return "\n".join([summary] + statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replicate cataloged backups to an S3 compatible store")
+    parser.add_argument("bucket")
+    parser.add_argument("--endpoint-url", help="eg http://minio.local:9000, default AWS S3")
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--part-size", type=int, default=PART_SIZE // (1024 * 1024), help="MB")
+    parser.add_argument("--parallel", type=int, default=8, help="part uploads at once")
+    parser.add_argument("--files", type=int, default=4, help="archives replicated at once")
+    parser.add_argument("--type", help="only replicate this archive type")
+    args = parser.parse_args()
+    with S3Replicator(args.bucket, args.endpoint_url, args.prefix, partSize=args.part_size * 1024 * 1024, \
+    maxParallel=args.parallel, maxFiles=args.files) as replicator:
+        status = replicator.replicate(args.type)
+    print(status)
+    sys.exit(1 if "\nERROR" in status else 0)
@@ -0,0 +1,191 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Grandfather-father-son (GFS) retention for the local backup directories.
+
+Archives in each backup directory are grouped into series, one per device/site
+and archive type, by removing the random prefix or suffix and the date from
+their file names, eg:
+F5Backups/bigip1_2020-05-20_123.ucs           -> series 'bigip1_.ucs'
+MMBackups/456_20_05_2020_SiteAminemeld.zip    -> series 'SiteAminemeld.zip'
+PABackups/789_20_05_2020_running-config.xml   -> series 'running-config.xml'
+F5Backups/ConfigSnapshots/10.1.1.1_2020-05-20_101500.conf.gz -> series '10.1.1.1_.conf.gz'
+
+Within each series the newest archive of each of the last 'daily' days,
+'weekly' ISO weeks and 'monthly' months is kept, everything else is deleted
+along with its sidecar files (.digest, .journal). The newest archive of every
+series is always kept, and a UCS that is the base of a kept delta (see
+F5Archive.store_ucs_delta) is kept for as long as the delta needs it.
+
+The archives of each directory and the time each was taken are read from the
+backup catalog (see backupCatalog.py), and deleted archives are flagged in
+it. Archives taken before the catalog existed can be added with
+'backupCatalog.py import', or the directories scanned instead with --scan.
+Config snapshot directories are not in BACKUP_DIRS, pass them explicitly if
+the full change history should not be kept.
+
+Usage:
+python retention.py [--daily N] [--weekly N] [--monthly N] [--delete] [--scan] [dir ...]
+without --delete the deletion plan is only printed.
+"""
+import sys, argparse, os, re, datetime, logging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_backups"))
+from ucsDelta import read_delta_header
+from backupCatalog import BackupCatalog
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+BACKUP_DIRS = [os.path.join(os.getcwd(), d) for d in ("F5Backups", "MMBackups", "PABackups")]
+#files that belong to an archive and are removed with it
+SIDECAR_SUFFIXES = (".digest", ".journal")
+#files in the backup directories that are not archives
+SKIP_SUFFIXES = SIDECAR_SUFFIXES + (".scrubstate", ".ucslist.json", ".tuning.json", ".tmp")
+#random 3 digit prefix/suffix, the two date formats and the config snapshot time used in archive names
+_NAME_NOISE = re.compile(r'^\d{3}_|_\d{3}(?=\.ucs$)|_\d{6}(?=\.conf\.gz$)|\d{4}-\d{2}-\d{2}|\d{2}_\d{2}_\d{4}_?')
+
+
+def series_key(fileName):
+    """returns the series an archive file name belongs to, see module docstring"""
+    if fileName.endswith((".delta", ".enc")):
+        fileName = fileName.rsplit(".", 1)[0]
+    return _NAME_NOISE.sub("", fileName)
+
+
+def gfs_keep(archives, daily=7, weekly=4, monthly=12):
+    """
+    Selects the archives to keep from one series under a GFS policy
+
+    Parameters:
+    archives - list of (datetime, name) tuples
+    daily - integer, number of most recent days to keep one archive for
+    weekly - integer, number of most recent ISO weeks to keep one archive for
+    monthly - integer, number of most recent months to keep one archive for
+
+    Returns:
+    set of names to keep
+    """
+
+    keep = set()
+    buckets = {"daily": set(), "weekly": set(), "monthly": set()}
+    limits = {"daily": daily, "weekly": weekly, "monthly": monthly}
+    ordered = sorted(archives, reverse=True)
+    if ordered:
+        keep.add(ordered[0][1])
+    #newest first, so the first archive seen in a bucket is the one kept for it
+    for taken, name in ordered:
+        keys = {"daily": taken.date(), "weekly": taken.isocalendar()[:2], \
+        "monthly": (taken.year, taken.month)}
+        for period, key in keys.items():
+            if key not in buckets[period] and len(buckets[period]) < limits[period]:
+                buckets[period].add(key)
+                keep.add(name)
+    return keep
+
+
+def retention_plan(backupDir, daily=7, weekly=4, monthly=12, archives=None):
+    """
+    Builds the GFS deletion plan for one backup directory
+
+    Parameters:
+    backupDir - string, directory holding archives
+    daily, weekly, monthly - integers, see gfs_keep
+    archives - optional list of (datetime taken, file name) in backupDir, eg
+    from the backup catalog. If not given the directory is scanned and file
+    modification times are used.
+
+    Returns:
+    tuple of (list of file names to keep, list of file names to delete)
+    """
+
+    if archives is None:
+        archives = []
+        for fileName in os.listdir(backupDir):
+            path = os.path.join(backupDir, fileName)
+            if os.path.isfile(path) and not fileName.endswith(SKIP_SUFFIXES):
+                archives.append((datetime.datetime.fromtimestamp(os.path.getmtime(path)), fileName))
+
+    series = {}
+    for taken, fileName in archives:
+        series.setdefault(series_key(fileName), []).append((taken, fileName))
+    keep = set()
+    for members in series.values():
+        keep |= gfs_keep(members, daily, weekly, monthly)
+
+    #a kept delta needs every archive back to the full base of its chain
+    for fileName in list(keep):
+        while fileName.endswith(".delta"):
+            try:
+                base = read_delta_header(os.path.join(backupDir, fileName))["base"]
+            except (OSError, ValueError) as e:
+                logging.debug(f'DEBUG unreadable delta {fileName}: {e}')
+                break
+            fileName = base if os.path.isfile(os.path.join(backupDir, base)) else base+".delta"
+            keep.add(fileName)
+
+    names = [fileName for _, fileName in archives]
+    return sorted(n for n in names if n in keep), sorted(n for n in names if n not in keep)
+
+
+def apply_retention(backupDirs=BACKUP_DIRS, daily=7, weekly=4, monthly=12, dryRun=True, catalog=None):
+    """
+    Applies the GFS policy to every directory in 'backupDirs'
+
+    Functionality:
+    -Builds the deletion plan for each directory (see retention_plan) from
+    the archives recorded in BackupCatalog 'catalog', or if catalog is None
+    from a scan of the directory
+    -Unless 'dryRun', deletes each planned archive and its sidecar files and
+    flags it deleted in the catalog
+
+    Returns:
+    string listing each archive deleted (or to be deleted, if dryRun) and
+    counts of archives kept, or error strings for failed deletions
+    """
+
+    status = ""
+    kept, deleted, planned = 0, 0, 0
+    for backupDir in backupDirs:
+        if not os.path.isdir(backupDir):
+            continue
+        archives = catalog.archives(backupDir) if catalog else None
+        keep, delete = retention_plan(backupDir, daily, weekly, monthly, archives)
+        kept += len(keep)
+        planned += len(delete)
+        for fileName in delete:
+            path = os.path.join(backupDir, fileName)
+            if dryRun:
+                status += f'\nWOULD DELETE {path}'
+                continue
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+                for suffix in SIDECAR_SUFFIXES:
+                    if os.path.isfile(path+suffix):
+                        os.remove(path+suffix)
+                #digest of a delta or encrypted archive is recorded against the plain name
+                if fileName.endswith((".delta", ".enc")) and os.path.isfile(path.rsplit(".", 1)[0]+".digest"):
+                    os.remove(path.rsplit(".", 1)[0]+".digest")
+            except OSError as e:
+                status += f'\nERROR deleting {path}: {e}'
+                continue
+            if catalog:
+                catalog.mark_deleted(path[:-len(".delta")] if path.endswith(".delta") else path)
+            deleted += 1
+            status += f'\nDELETED {path}'
+    summary = f'{planned} to delete' if dryRun else f'{deleted} of {planned} deleted'
+    return f'Retention daily={daily} weekly={weekly} monthly={monthly}: {kept} kept, {summary}'+status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply GFS retention to local backup directories")
+    parser.add_argument("dirs", nargs="*", default=BACKUP_DIRS, help="backup directories")
+    parser.add_argument("--daily", type=int, default=7)
+    parser.add_argument("--weekly", type=int, default=4)
+    parser.add_argument("--monthly", type=int, default=12)
+    parser.add_argument("--delete", action="store_true", help="delete, rather than only list, expired archives")
+    parser.add_argument("--scan", action="store_true", help="scan the directories rather than read the catalog")
+    args = parser.parse_args()
+    print(apply_retention(args.dirs, args.daily, args.weekly, args.monthly, not args.delete, \
+    None if args.scan else BackupCatalog()))
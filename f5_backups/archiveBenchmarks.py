@@ -0,0 +1,215 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Throughput benchmarks of the F5Archive backup path, run against local
+F5Simulator instances rather than production BIG-IPs.
+
+Benchmarks:
+-download - UCS download MB/s for each mode in DOWNLOAD_MODES
+-download_small - the same for a UCS smaller than the chunk size
+    (SMALL_UCS_SIZE), which is only one clamped range
+-task_poll - seconds from a UCS save task reaching COMPLETED on the simulator
+    to generate_ucs(isLarge=True) returning, ie the cost of task polling
+-fleet - wall time of fleet_backup across 'devices' simulators, and the
+    number of devices that failed
+
+Results are printed as a table and optionally written to a JSON file. Given
+a baseline JSON from an earlier run (eg on the last released code), any
+metric worse than its baseline by more than 'tolerance' is reported as a
+regression and the exit code is 1, so regressions show before rollout.
+
+Usage:
+python archiveBenchmarks.py [--ucs-size MB] [--latency S] [--bandwidth MB/s]
+    [--save-seconds N] [--devices N] [--repeat N] [--json FILE]
+    [--baseline FILE] [--tolerance 0.2]
+"""
+import sys, os, json, time, argparse, tempfile, statistics, logging
+from f5Archive import F5Archive
+from f5Simulator import F5Simulator
+from fleetArchives import fleet_backup
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from backupCatalog import BackupCatalog
+from f5DeviceCache import DeviceCache
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#download_ucs keyword arguments for each download benchmark
+DOWNLOAD_MODES = {
+    "chunk512K_workers1": {"chunk_size": 512 * 1024, "workers": 1},
+    "chunk512K_workers4": {"chunk_size": 512 * 1024, "workers": 4},
+    "adaptive_workers4": {"chunk_size": 512 * 1024, "workers": 4, "adaptive": True},
+}
+#bytes, UCS size of the small download benchmark, below every chunk size
+SMALL_UCS_SIZE = 100 * 1024
+
+
+def bench_download(simulator, workDir, repeat=3, prefix="download"):
+    """
+    Downloads a fresh UCS from 'simulator' 'repeat' times per download mode
+
+    Returns:
+    dictionary of metric name (starting 'prefix'):median MB/s
+    """
+
+    results = {}
+    for mode, options in DOWNLOAD_MODES.items():
+        modeDir = os.path.join(workDir, mode)
+        os.makedirs(modeDir, exist_ok=True)
+        rates = []
+        with F5Archive(simulator.address, simulator.username, simulator.password, \
+        poolSize=max(10, options["workers"] + 1), catalog=BackupCatalog(os.path.join(modeDir, "catalog.sqlite")), \
+        ucsDir=modeDir, deviceCache=DeviceCache(os.path.join(modeDir, "devices.sqlite"))) as archive:
+            for run in range(repeat):
+                ucsName = simulator.save_ucs(f'bench_{mode}_{run:03d}.ucs')
+                startTime = time.perf_counter()
+                status = archive.download_ucs(ucsName, **options)
+                seconds = time.perf_counter() - startTime
+                if not status.endswith("UCSSUCCESS"):
+                    raise RuntimeError(f'download benchmark {mode} failed: {status}')
+                rates.append(simulator.ucsSize / seconds / (1024 * 1024))
+                os.remove(os.path.join(modeDir, ucsName))
+        results[f'{prefix}.{mode}.MBps'] = statistics.median(rates)
+    return results
+
+
+def bench_task_poll(simulator, workDir, repeat=3):
+    """
+    Generates 'repeat' UCS' on 'simulator' with the asynchronous task API
+
+    Returns:
+    dictionary of metric name:median seconds between task completion and
+    generate_ucs returning
+    """
+
+    delays = []
+    with F5Archive(simulator.address, simulator.username, simulator.password, \
+    catalog=BackupCatalog(os.path.join(workDir, "catalog.sqlite")), ucsDir=workDir, \
+    deviceCache=DeviceCache(os.path.join(workDir, "devices.sqlite"))) as archive:
+        for _ in range(repeat):
+            status = archive.generate_ucs(isLarge=True)
+            returned = time.perf_counter()
+            if not status.endswith("seconds"):
+                raise RuntimeError(f'task poll benchmark failed: {status}')
+            completed = simulator.taskCompleted[max(simulator.taskCompleted, key=int)]
+            delays.append(returned - completed)
+    return {"task_poll.seconds": statistics.median(delays)}
+
+
+def bench_fleet(simulators, workDir):
+    """
+    Runs fleet_backup across every simulator in 'simulators'
+
+    Returns:
+    dictionary of metric name:value for the fleet wall time and failed devices
+    """
+
+    inventory = [{"host": simulator.address, "username": simulator.username, \
+    "password": simulator.password, "isLarge": True} for simulator in simulators]
+    startTime = time.perf_counter()
+    results = fleet_backup(inventory, downloadWorkers=4, adaptiveChunks=True, ucsDir=workDir, \
+    catalog=BackupCatalog(os.path.join(workDir, "catalog.sqlite")), \
+    deviceCache=DeviceCache(os.path.join(workDir, "devices.sqlite")))
+    seconds = time.perf_counter() - startTime
+    failed = [host for host, result in results.items() if result["state"] != "done"]
+    for host in failed:
+        logging.debug(f'DEBUG fleet benchmark {host} failed: {results[host]["error"]}')
+    return {"fleet.seconds": seconds, "fleet.failed": len(failed)}
+
+
+def run_benchmarks(ucsSize=(32 * 1024 * 1024), latency=0.01, bandwidth=None, saveSeconds=0.5, \
+devices=4, repeat=3):
+    """
+    Starts 'devices' simulators with the given link settings and runs every
+    benchmark against them in a temporary directory
+
+    Returns:
+    dictionary of metric name:value
+    """
+
+    results = {}
+    simulators = [F5Simulator(hostname=f'bigip{number}.simulator.local', ucsSize=ucsSize, \
+    saveSeconds=saveSeconds, latency=latency, bandwidth=bandwidth) for number in range(1, devices + 1)]
+    smallSimulator = F5Simulator(hostname="bigipsmall.simulator.local", ucsSize=SMALL_UCS_SIZE, \
+    saveSeconds=saveSeconds, latency=latency, bandwidth=bandwidth)
+    with tempfile.TemporaryDirectory() as workDir:
+        try:
+            for simulator in simulators + [smallSimulator]:
+                simulator.start()
+            downloadDir = os.path.join(workDir, "download")
+            smallDir = os.path.join(workDir, "download_small")
+            taskDir = os.path.join(workDir, "task")
+            fleetDir = os.path.join(workDir, "fleet")
+            for directory in (downloadDir, smallDir, taskDir, fleetDir):
+                os.makedirs(directory)
+            results.update(bench_download(simulators[0], downloadDir, repeat))
+            results.update(bench_download(smallSimulator, smallDir, repeat, "download_small"))
+            results.update(bench_task_poll(simulators[0], taskDir, repeat))
+            results.update(bench_fleet(simulators, fleetDir))
+        finally:
+            for simulator in simulators + [smallSimulator]:
+                simulator.stop()
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares 'results' with 'baseline' (both metric name:value). MB/s metrics
+    are better higher, all others better lower.
+
+    Returns:
+    list of regression strings, empty if none
+    """
+
+    regressions = []
+    for metric, value in results.items():
+        if metric not in baseline:
+            continue
+        base = baseline[metric]
+        if metric.endswith("MBps"):
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance) and value - base > 0.001
+        if worse:
+            regressions.append(f'REGRESSION {metric} {value:0.3f} vs baseline {base:0.3f}')
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """returns 'results' as a plain text table, with the baseline value if given"""
+    baseline = baseline or {}
+    lines = [f'{"metric":<36}{"value":>12}{"baseline":>12}']
+    for metric, value in results.items():
+        base = f'{baseline[metric]:>12.3f}' if metric in baseline else f'{"":>12}'
+        lines.append(f'{metric:<36}{value:>12.3f}{base}')
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark F5Archive against local F5 simulators")
+    parser.add_argument("--ucs-size", type=float, default=32, help="UCS size in MB")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s per simulator, 0 unlimited")
+    parser.add_argument("--save-seconds", type=float, default=0.5)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction worse than baseline allowed")
+    args = parser.parse_args()
+
+    results = run_benchmarks(int(args.ucs_size * 1024 * 1024), args.latency, \
+    args.bandwidth * 1024 * 1024 or None, args.save_seconds, args.devices, args.repeat)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+    print(format_results(results, baseline))
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump(results, jsonFile, indent=2)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(regression)
+    sys.exit(1 if regressions else 0)
@@ -1,52 +1,37 @@
 #! python3
 #git at cloudsecurity period nz
-from f5Archive import F5Archive as F5A
-import logging
+from fleetArchives import fleet_backup, fleet_backup_summary
+import sys, os, logging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from replication import S3Replicator
 """
 This is a sample script to create and download a UCS archive,
-verify download integrity with checksum and delete UCS' older than X days.
-All using the F5Archive class.
+verify download integrity with checksum and delete UCS' older than X days
+for every F5 in the inventory, using the fleetArchives pipeline (which uses
+the F5Archive class). New archives are then replicated to an S3 compatible
+bucket if one is set (see backup_store/replication.py).
 
 Returns:
-String with concatenated status of each method call
-Could extend script by sending status string as email update or log to file.
+Dictionary of per device results from fleet_backup, and a plain text summary
+Could extend script by sending summary string as email update or log to file.
 """
 
 
-#Instantiate F5Archive
-archive = F5A("10.9.8.7", 'admin', 'somepassword')
-ucs = ""
-downloadNewUcs = ""
-status = ""
-newUcs = archive.generate_ucs()
-#if UCS created successfully, get ucs name and add to status string
-if newUcs.endswith('seconds'):
-    status = newUcs
-    ucs = newUcs.split()[0]
-    downloadNewUcs = archive.download_ucs(ucs)
-    #if UCS downloaded successfully, get details and add to status string
-    if downloadNewUcs.endswith("UCSSUCCESS"):
-        status = status+" "+downloadNewUcs
-        checksum = archive.get_ucs_checksums(ucs)
-        #if checksums successfully match, get details and add to status string
-        if checksum.startswith("Remote"):
-            status = status+" "+checksum
-            deleteUcs = archive.cleanup_ucs(7)
-            #if old UCS' successfully deleted, get details and add to status string
-            if deleteUcs.startswith('DELETED'):
-                status = status+" "+deleteUcs
-            #else print status and exception string
-            else:
-                status = status+" "+deleteUcs
-        #else print status and exception string
-        else:
-            status = status+" "+checksum
-    #else print status and exception string
-    else:
-        status = status+" "+downloadNewUcs
-#else print exception string
-else:
-    status = newUcs
+#one dictionary per F5 device to back up
+inventory = [
+    {"host": "10.9.8.7", "username": "admin", "password": "somepassword"},
+    {"host": "10.9.8.8", "username": "admin", "password": "somepassword", "isLarge": True},
+]
+
+results = fleet_backup(inventory, deleteOlder=7, downloadWorkers=4)
 
 #do something with status string
-print(status)
+print(fleet_backup_summary(results))
+
+#S3 compatible bucket (and endpoint for eg MinIO, None for AWS) to copy the
+#new archives to, empty to skip replication
+replicationBucket = ""
+replicationEndpoint = None
+if replicationBucket:
+    with S3Replicator(replicationBucket, replicationEndpoint) as replicator:
+        print(replicator.replicate())
@@ -0,0 +1,108 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Incremental config snapshots for a fleet of F5 devices between full UCS
+backups, using F5Archive.snapshot_config.
+
+A UCS takes the box minutes to save and is large to transfer, so is only
+taken nightly (see fleetArchives.py). A snapshot reads just the text config
+(bigip_base.conf and bigip.conf) in one API call and is only stored when its
+digest differs from the device's last snapshot, so running every few minutes
+gives a near continuous config history at a small fraction of the cost.
+
+Each round snapshots every device concurrently, bounded by 'maxParallel'.
+The F5Archive of each device (its pooled connections and auth token) is kept
+for the following rounds.
+
+Usage:
+python configSnapshots.py [intervalSeconds]
+"""
+import sys, time, logging
+from concurrent.futures import ThreadPoolExecutor
+from f5Archive import F5Archive, CONFIG_FILES
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#default seconds between snapshot rounds
+SNAPSHOT_INTERVAL = 900
+
+
+def snapshot_fleet(archives, maxParallel=8, configFiles=CONFIG_FILES, saveFirst=False):
+    """
+    Takes one config snapshot of every device in 'archives'
+
+    Parameters:
+    archives - dictionary of device host:F5Archive
+    maxParallel - integer, devices snapshotted at once, default=8
+    configFiles - tuple of on box config files, see F5Archive.snapshot_config
+    saveFirst - boolean, 'tmsh save sys config' before reading the files
+
+    Returns:
+    dictionary of device host:status string from snapshot_config
+    """
+
+    def snapshot(archive):
+        try:
+            return archive.snapshot_config(configFiles, saveFirst)
+        except Exception as e:
+            #unexpected error (eg local disk) must not stop the rest of the fleet
+            return f'ERROR snapshot_config raised {e!r}'
+
+    with ThreadPoolExecutor(max_workers=maxParallel, thread_name_prefix="snapshot") as pool:
+        statuses = pool.map(snapshot, archives.values())
+        return dict(zip(archives, statuses))
+
+
+def run_snapshots(inventory, interval=SNAPSHOT_INTERVAL, rounds=None, maxParallel=8, \
+configFiles=CONFIG_FILES, saveFirst=False, ucsDir=None, catalog=None):
+    """
+    Generator snapshotting every device in 'inventory' every 'interval'
+    seconds, yielding the results of each round
+
+    Parameters:
+    inventory - list of dictionaries, one per device, with keys 'host',
+    'username' and 'password'
+    interval - seconds from the start of one round to the start of the next
+    rounds - integer, number of rounds to run, default None runs until interrupted
+    maxParallel, configFiles, saveFirst - see snapshot_fleet
+    ucsDir - string, local directory, snapshots go in its ConfigSnapshots
+    subdirectory, default is the F5Archive default
+    catalog - BackupCatalog the snapshots are recorded in and compared against,
+    default is the F5Archive default
+
+    Yields:
+    dictionary of device host:status string, once per round
+    """
+
+    archives = {device["host"]: F5Archive(device["host"], device["username"], device["password"], \
+    poolSize=1, catalog=catalog, ucsDir=ucsDir) for device in inventory}
+    count = 0
+    try:
+        while rounds is None or count < rounds:
+            startTime = time.monotonic()
+            results = snapshot_fleet(archives, maxParallel, configFiles, saveFirst)
+            for host, status in results.items():
+                logging.debug(f'DEBUG {host} {status}')
+            yield results
+            count += 1
+            if rounds is None or count < rounds:
+                time.sleep(max(0, interval - (time.monotonic() - startTime)))
+    finally:
+        for archive in archives.values():
+            archive.close()
+
+
+if __name__ == "__main__":
+    inventory = [
+        {"host": "IP1", "username": "username", "password": "password"},
+        {"host": "IP2", "username": "username", "password": "password"},
+    ]
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else SNAPSHOT_INTERVAL
+    try:
+        for results in run_snapshots(inventory, interval):
+            for host, status in results.items():
+                print(f'{time.strftime("%Y-%m-%d %H:%M:%S")} {host}: {status}')
+    except KeyboardInterrupt:
+        pass
@@ -8,8 +8,21 @@ Reference Guide:https://cdn.f5.com/websites/devcentral.f5.com/
 downloads/icontrol-rest-api-user-guide-14-1-0.pdf
 Command examples: https://support.f5.com/csp/article/K13225405
 """
-import requests, json, time, datetime, os, hashlib, logging, random
+import sys, requests, json, time, datetime, os, hashlib, logging, random, threading, shutil, zlib, sqlite3, \
+gzip, difflib, struct
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from taskPoller import TaskPoller
+from ucsDelta import write_delta, apply_delta, read_delta_header
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from backupCatalog import BackupCatalog, UCS, CONFIG
+from masterKeyring import MasterKeyring
+from archiveCrypto import EncryptingWriter, ArchiveDecryptError, ENC_SUFFIX, decrypt_chunks, decrypt_file
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_common"))
+from f5Auth import F5TokenAuth
+from f5DeviceCache import default_cache
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -17,6 +30,142 @@ logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
 {message} ({filename}:{lineno})", style="{")
 logging.disable(logging.CRITICAL)
 
+#limits for download_ucs(adaptive=True), range sizes are multiples of 64KB
+ADAPTIVE_MIN_CHUNK = 256 * 1024
+ADAPTIVE_MAX_CHUNK = 64 * 1024 * 1024
+#time each range should take at the measured throughput
+ADAPTIVE_TARGET_SECONDS = 2
+#failed ranges retried at a smaller size before the download is abandoned
+ADAPTIVE_RANGE_RETRIES = 3
+#socket (connect, read) timeouts for each range request
+RANGE_TIMEOUT = (10, 60)
+#seconds past the task deadline generate_ucs waits for the poller's answer
+TASK_RESULT_GRACE = 120
+#on box text config read by snapshot_config
+CONFIG_FILES = ("/config/bigip_base.conf", "/config/bigip.conf")
+
+class _RangeHasher:
+    """
+    Hashes a file in a single pass from byte ranges that arrive out of order.
+
+    Ranges handed to update() are fed to the hash objects strictly in file
+    order. Ranges that arrive ahead of the current position are held in memory
+    until the gap before them is filled, so callers should bound how far ahead
+    of 'position' they download. Ranges already on disk from a resumed download
+    ('done' dictionary of start:end offsets) are read back from 'fileName' as
+    the position reaches them. If given, 'sink' is called with each range
+    after it is hashed, in file order, eg to encrypt the stream.
+    """
+
+    def __init__(self, algorithms, fileName, fileSize, done=None, sink=None):
+        self.hashes = {name: hashlib.new(name) for name in algorithms}
+        self.fileName, self.fileSize = fileName, fileSize
+        self.done = dict(done or {})
+        self.sink = sink
+        self.position = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        with self._lock:
+            self._drain()
+
+    def update(self, start, data):
+        """adds range 'data' found at offset 'start' of the file"""
+        with self._lock:
+            self._pending[start] = data
+            self._drain()
+
+    def resume(self, data):
+        """hashes 'data' at the current position, already passed to the sink by an earlier run"""
+        with self._lock:
+            for h in self.hashes.values():
+                h.update(data)
+            self.position += len(data)
+
+    def _drain(self):
+        #hash every range contiguous with the current position
+        while self.position < self.fileSize:
+            if self.position in self._pending:
+                data = self._pending.pop(self.position)
+            elif self.position in self.done:
+                with open(self.fileName, 'rb') as f:
+                    f.seek(self.position)
+                    data = f.read(self.done[self.position] - self.position + 1)
+            else:
+                break
+            for h in self.hashes.values():
+                h.update(data)
+            if self.sink:
+                self.sink(data)
+            self.position += len(data)
+
+    def hexdigests(self):
+        """returns dict of algorithm:hexdigest, or None if file not fully hashed"""
+        if self.position != self.fileSize:
+            return None
+        return {name: h.hexdigest() for name, h in self.hashes.items()}
+
+
+def _plan_ranges(fileSize, done, sizer):
+    """
+    Generator of (start, end) byte ranges, end inclusive as per Content-Range,
+    covering 'fileSize' bytes apart from the ranges in 'done' (dictionary of
+    start:end). 'sizer' is called for the size of each range as it is
+    planned, so a changed chunk size applies from the next range on. Ranges
+    are clamped to the file size and to the start of the next done range.
+    """
+
+    doneStarts = sorted(done)
+    position, index = 0, 0
+    while position < fileSize:
+        if index < len(doneStarts) and doneStarts[index] <= position:
+            position = max(position, done[doneStarts[index]] + 1)
+            index += 1
+            continue
+        limit = doneStarts[index] if index < len(doneStarts) else fileSize
+        end = min(position + sizer(), limit) - 1
+        yield position, end
+        position = end + 1
+
+
+class _ChunkTuner:
+    """
+    Sizes download ranges from the throughput and latency measured per range.
+
+    The throughput of each completed range is folded into a moving average
+    and the chunk size set so a range takes about 'targetSeconds' at that
+    rate. On fast links ranges grow, so the per request round trip is paid
+    fewer times, while on slow or congested links they shrink before they
+    time out. Each step at most doubles or halves the size, which is kept
+    between 'minChunk' and 'maxChunk' in multiples of 64KB. A failed range
+    halves the size.
+    """
+
+    def __init__(self, chunkSize, minChunk=ADAPTIVE_MIN_CHUNK, maxChunk=ADAPTIVE_MAX_CHUNK, \
+    targetSeconds=ADAPTIVE_TARGET_SECONDS):
+        self.minChunk, self.maxChunk, self.targetSeconds = minChunk, maxChunk, targetSeconds
+        self.chunkSize = self._clamp(chunkSize)
+        self.throughput, self.latency = None, None
+        self._lock = threading.Lock()
+
+    def _clamp(self, size):
+        size = max(self.minChunk, min(self.maxChunk, int(size)))
+        return max(64 * 1024, size - size % (64 * 1024))
+
+    def observe(self, size, seconds, latency):
+        """records a range of 'size' bytes fetched in 'seconds', first byte after 'latency'"""
+        with self._lock:
+            rate = size / max(seconds, 0.001)
+            self.throughput = rate if self.throughput is None else 0.7 * self.throughput + 0.3 * rate
+            self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+            ideal = self.throughput * self.targetSeconds
+            self.chunkSize = self._clamp(min(max(ideal, self.chunkSize / 2), self.chunkSize * 2))
+
+    def failed(self):
+        """records a failed range"""
+        with self._lock:
+            self.chunkSize = self._clamp(self.chunkSize / 2)
+
+
 class F5Archive:
     """
     This class uses API calls with the requests module to create a UCS archive,
@@ -31,33 +180,119 @@ class F5Archive:
         returns:
         -ucs name in format: 'hostname_YYYY-MM-DD_XXX.ucs' where XXX= random int
         -time taken to create UCS as string
-    - download_ucs - downloads the ucs to local directory.
+    - download_ucs - downloads the ucs to local directory. Optionally splits the
+        ucs into byte ranges fetched concurrently by a bounded pool of workers,
+        optionally sizing the ranges from the measured throughput of the F5.
+        Progress is journaled so an interrupted download resumes where it stopped.
+        The ucs is hashed (md5 and optionally others) as it is downloaded and,
+        if an encryption key is set, encrypted in the same pass.
     - get_ucs_checksums - creates a checksum of the on box ucs and a checksum of the
-        (same) downloaded ucs and compares them to verify no corruption in download
-    - get_f5mk - gets the F5 configuration masterkey, compares it to that stored in
-        local file and appends if different. Useful for standalone F5 deployments.
-    - cleanup_ucs - creates a list of UCS' on box and deletes any older than X days
+        (same) downloaded ucs and compares them to verify no corruption in download.
+        Uses the digests stored by download_ucs when available.
+    - store_ucs_delta - replaces a downloaded ucs with a binary delta against the
+        previous ucs from the same hostname, keeping a full base every N days
+    - restore_ucs - rebuilds a ucs from its delta chain, or decrypts it, and
+        verifies its checksum
+    - snapshot_config - stores a compressed copy of the text config (bigip.conf,
+        bigip_base.conf) if it changed since the last snapshot. Cheap enough to
+        run at short intervals between full UCS backups.
+    - get_f5mk - gets the F5 configuration masterkey, compares it to the current
+        key of this F5 in the keyring and records it if different. Useful for
+        standalone F5 deployments.
+    - cleanup_ucs - creates a list of UCS' on box and deletes any older than X days.
+        Deletes run concurrently (bounded per F5) and the on box listing is cached.
+    - close - closes the pooled connections to the F5. The class can also be
+        used as a context manager, ie 'with F5Archive(...) as archive:'
 
     Instance Attributes:
     The following attributes are instantiated for use by the different methods:
     -self.F5IP - the IP or hostname of the target F5 device
     -self.username - username used to authenticate to the target F5
     -self.password - password used to authenticate to the target F5
+    -self.ucsDir - local directory UCS' are downloaded to, default is
+        F5Backups in the working directory
+    -self.snapshotDir - local directory config snapshots are written to,
+        ConfigSnapshots in self.ucsDir
+    -self.session - requests Session shared by all methods. Keeps a pool of
+        up to 'poolSize' keep-alive connections to the F5, so each API call (and
+        each download chunk) reuses an established TLS connection. Requests
+        carry an X-F5-Auth-Token (see f5_common/f5Auth.py) rather than basic
+        auth, so the F5 authenticates the user once, not per request. Idempotent
+        calls (GET, PUT, DELETE) that fail to connect or return 502/503/504
+        are retried up to 'retries' times with exponential backoff.
+    -self.taskPoller - TaskPoller used to watch asynchronous iControl tasks.
+        Defaults to the process wide poller, so the tasks of every F5Archive
+        instance are polled from one thread.
+    -self.catalog - BackupCatalog every downloaded UCS is recorded in, along
+        with its digests, download time and throughput. Checksum verification
+        and delta storage are recorded against the same entry. Defaults to the
+        catalog file in the working directory.
+    -self.encryptKey - 32 byte key (see backup_store/archiveCrypto.py). If set,
+        UCS' are stored encrypted as 'ucsName'.enc and the plain UCS is never
+        written to disk. Default None stores UCS' unencrypted.
+    -self.keyring - MasterKeyring the masterkey of the F5 is recorded in by
+        get_f5mk, keyed by self.F5IP. Defaults to the keyring file in the
+        working directory.
+    -self.deviceCache - DeviceCache (see f5_common/f5DeviceCache.py) the
+        hostname used to name UCS' is read from, so it is only fetched from
+        the F5 when the cached entry has expired. Defaults to the cache
+        shared in the process (f5DeviceCache.default_cache).
 
     """
 
-    def __init__(self, F5IP, username, password):
+    def __init__(self, F5IP, username, password, poolSize=10, retries=3, taskPoller=None, catalog=None, \
+    ucsDir=None, encryptKey=None, keyring=None, deviceCache=None):
         self.F5IP = F5IP
         self.username = username
         self.password = password
-        self.ucsDir = os.getcwd()+"\\F5Backups\\"
+        self.ucsDir = os.path.join(ucsDir, "") if ucsDir else os.getcwd()+"\\F5Backups\\"
+        self.snapshotDir = os.path.join(self.ucsDir, "ConfigSnapshots", "")
+        #one pooled session for every API call made by this instance
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504), \
+        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.auth = F5TokenAuth(self.F5IP, self.username, self.password)
+        self.session.verify = False
+        #environment CA bundles or .netrc would otherwise override verify and auth
+        #above, set self.session.proxies if a proxy is needed to reach the F5
+        self.session.trust_env = False
+        self.taskPoller = taskPoller or TaskPoller.shared()
+        self.catalog = catalog or BackupCatalog()
+        self.encryptKey = encryptKey
+        self.keyring = keyring
+        self.deviceCache = deviceCache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """closes all pooled connections held by self.session"""
+        self.session.close()
+
+    def _catalog(self, method, *args, **kwargs):
+        """
+        Calls BackupCatalog 'method' on self.catalog. A catalog failure is logged
+        but does not fail the backup, the archive can be cataloged later with
+        'backupCatalog.py import'.
+        """
+
+        try:
+            getattr(self.catalog, method)(*args, **kwargs)
+        except (sqlite3.Error, OSError) as e:
+            logging.debug(f'DEBUG catalog {method} failed error: {e}')
 
-    def generate_ucs(self, isLarge=False):
+    def generate_ucs(self, isLarge=False, taskDeadline=1800):
         """
         Creates a UCS archive on the F5
 
         Functionality:
-        -Makes an API call to get the hostname
+        -Gets the hostname from self.deviceCache, which only makes an API call
+        if the cached entry has expired
         -Makes an API call to create the UCS name based off the hostname, the
         date and a random integer.
         -If 'isLarge' parameter default (false), then an API call will be made to
@@ -66,7 +301,9 @@ class F5Archive:
         -If basic POST call fails, or if isLarge=True, a new API call will be
         made to create an asynchronous task to generate the ucs. iControl API
         asynchronous tasks are not subject to the same API call timeouts as
-        non-task POST iControl calls.
+        non-task POST iControl calls. The task status is polled by
+        self.taskPoller with exponential backoff until it completes or
+        'taskDeadline' passes.
 
         Attributes:
         The following instance attributes are used in API calls:
@@ -77,6 +314,8 @@ class F5Archive:
         Parameters:
         islarge - boolean, indicates that asynchronous task should be used to
         download the UCS archive. Default=False
+        taskDeadline - integer, seconds to wait for the asynchronous task to
+        complete before giving up. Default=1800
 
         Exceptions:
         exceptions are caught for an requests module API calls and stored as
@@ -91,27 +330,23 @@ class F5Archive:
         #create error log variable
         status = ""
         ucsName = ""
-        hostnameUrl = "https://"+self.F5IP+"/mgmt/tm/sys/global-settings"
-        #set query string so it only return the hostname param in JSON
-        hostnameParam = "$select=hostname"
         #fetch todays date
         currentDate = str(datetime.date.today())
 
 
         try:
-            #send GET to retireve hostname of F5 device
-            hostnameResp = requests.get(hostnameUrl, auth=(self.username,self.password), \
-            params=hostnameParam, verify=False)
-            hostnameResp.raise_for_status()
-        except requests.exceptions.RequestException as e:
+            #the shared cache is opened on first use, like the keyring
+            if self.deviceCache is None:
+                self.deviceCache = default_cache()
+            #cached hostname of F5 device, only fetched if expired
+            hostname = self.deviceCache.hostname(self.F5IP, self.session)
+        except (requests.exceptions.RequestException, ValueError, KeyError, sqlite3.Error) as e:
             #create exception text to use later in error report
             logging.debug(f"DEBUG exception {e}")
             status = f'ERROR generate_ucs GET call failed: {e}'
         else:
             #if hostname successfully retrieved, create UCS name
-            ucsName = json.loads(hostnameResp.text)
-            ucsName = ucsName["hostname"].split('.')[0]
-            ucsName = ucsName+"_"+currentDate+"_" \
+            ucsName = hostname+"_"+currentDate+"_" \
             +str(random.randint(100,300))+".ucs"
 
         #create JSON payload with comand to save ucs and name of ucs
@@ -123,8 +358,7 @@ class F5Archive:
             try:
                 #send POST request to create UCS.
                 startTime = time.perf_counter()
-                resp = requests.post(ucsUrl, auth=(self.username,self.password), \
-                json=payload, verify=False)
+                resp = self.session.post(ucsUrl, json=payload)
                 resp.raise_for_status()
             except requests.exceptions.RequestException as e:
                 logging.debug(f"DEBUG exception {e}")
@@ -145,8 +379,7 @@ class F5Archive:
                 startTime = time.perf_counter()
                 #create asynchronous task and locate '_taskId' in response,
                 #remove any params
-                createResp = requests.post(ucsUrl, auth=(self.username, self.password), \
-                json=payload, verify=False)
+                createResp = self.session.post(ucsUrl, json=payload)
                 createResp.raise_for_status()
             except requests.exceptions.RequestException as e:
                 status = f'ERROR generate_ucs TASK POST call failed: {e}'
@@ -163,8 +396,7 @@ class F5Archive:
                 ###specify 'VALIDATING' as '_taskstate' property
                 startPayload = {"_taskState":"VALIDATING"}
                 try:
-                    startResp = requests.put(ucsUrl+taskId,auth=(self.username, self.password), \
-                    json=startPayload, verify=False)
+                    startResp = self.session.put(ucsUrl+taskId, json=startPayload)
                     startResp.raise_for_status()
                 except requests.exceptions.RequestException as e:
                     status = f'ERROR generate_ucs TASK PUT call failed: {e}'
@@ -179,29 +411,19 @@ class F5Archive:
                     #verify task executing: in response look for "message" : "Task will execute
                     ##asynchronously"
                     if taskExe == "Task will execute asynchronously.":
-                        #periodically send GET to monitor status of task, use while loop wait period
-                        ##look for: "_taskState":"COMPLETED"
-                        while True:
-                            time.sleep(2)
-                            try:
-                                statusResp = requests.get(ucsUrl+taskId, \
-                                auth=(self.username, self.password), verify=False)
-                                statusResp.raise_for_status()
-                            except requests.exceptions.RequestException as e:
-                                status = f'ERROR generate_ucs TASK GET status call failed: {e}'
-                                #any other errors, send email alert and abort
-                                logging.debug(f'DEBUG GET task status failed error: {e}')
-                            else:
-                                #200 response - verify if "COMPLETED" status
-                                statusJson = json.loads(statusResp.text)
-                                logging.debug(f'DEBUG GET status STATUS{statusResp.status_code}')
-                                if len(statusJson) != 0 and statusJson["_taskState"] == "COMPLETED":
-                                    break
+                        #hand the task to the shared poller, which polls with backoff
+                        ##until "_taskState":"COMPLETED" or the deadline passes
+                        future = self.taskPoller.watch(self.session, ucsUrl+taskId, taskDeadline)
+                        try:
+                            statusJson, status = future.result(timeout=taskDeadline + TASK_RESULT_GRACE)
+                        except FutureTimeoutError:
+                            status = f'no task result within {taskDeadline + TASK_RESULT_GRACE} seconds'
+                        if status:
+                            status = f'ERROR generate_ucs {status}'
                 if not status:
                     #when task completed,make GET to enpoint with /result
                     try:
-                        resultResp = requests.get(ucsUrl+taskId+"/result", \
-                        auth=(self.username, self.password), verify=False)
+                        resultResp = self.session.get(ucsUrl+taskId+"/result")
                         resultResp.raise_for_status()
                     except requests.exceptions.RequestException as e:
                         status = f'ERROR generate_ucs TASK GET result call failed: {e}'
@@ -220,8 +442,7 @@ class F5Archive:
                         #should only need to send one DELETE to remove the result
                         try:
                             #send DELETE to remove result
-                            delResultResp = requests.delete(ucsUrl+taskId+"/result", \
-                            auth=(self.username, self.password), verify=False)
+                            delResultResp = self.session.delete(ucsUrl+taskId+"/result")
                             delResultResp.raise_for_status()
                         except requests.exceptions.HTTPError:
                             #if response is 400, then result has been deleted
@@ -241,8 +462,7 @@ class F5Archive:
                         if not status:
                             #once we have successully deleted the result, we should DELETE the task
                             try:
-                                delTaskResp = requests.delete(ucsUrl+taskId, \
-                                auth=(self.username, self.password), verify=False)
+                                delTaskResp = self.session.delete(ucsUrl+taskId)
                                 delTaskResp.raise_for_status()
                             except requests.exceptions.HTTPError:
                                 #if task not found - then it has been deleted
@@ -250,7 +470,7 @@ class F5Archive:
                                 if len(delTaskJson) != 0 and delTaskJson["message"].startswith("Task not found"):
                                     logging.debug(f'DEBUG Task Deleted')
                                     pass
-                            except requests.exeptions.RequestException as e:
+                            except requests.exceptions.RequestException as e:
                                 status = f'ERROR generate_ucs TASK DELETE task call failed: {e}'
                                 #any other errors, send email alert and abort
                                 logging.debug(f'DEBUG Some major error {e}')
@@ -263,17 +483,48 @@ class F5Archive:
         stopTime = time.perf_counter()
         if not status:
             status =  f'{ucsName} created in {stopTime - startTime:0.4f} seconds'
+            #add the new UCS to the cached on box listing used by cleanup_ucs
+            self._update_ucs_listing({"/var/local/ucs/"+ucsName: \
+            [datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), ""]})
 
         #return the name of UCS file or return error code dictionary
         return status
 
-    def download_ucs(self, ucsName, chunk_size=(512 * 1024)):
+    def download_ucs(self, ucsName, chunk_size=(512 * 1024), workers=1, hashes=("md5",), adaptive=False):
         """
         Downloads UCS to local directory
 
         Functionality:
         -The function will make an API call to GET a specified UCS file.
-        file is buffered with specific chunk size.
+        file is requested as a series of Content-Range chunks of 'chunk_size'.
+        -If 'workers' is greater than 1, the chunks are fetched concurrently by
+        a pool of 'workers' threads and written at their offset in a
+        preallocated local file. workers=1 fetches one chunk after another.
+        -Every chunk written and verified is recorded in a sidecar journal
+        ('ucsName'.journal in self.ucsDir). If the download fails part way, the
+        journal is kept and the next call for the same UCS re-verifies the
+        journaled chunks on disk and only downloads those still missing. The
+        journal is removed once the download completes.
+        -The UCS is hashed with each algorithm in 'hashes' as chunks arrive, so
+        no second pass over the local file is needed. Chunks are never fetched
+        more than 2 x 'workers' chunks ahead of the hashing position, which
+        bounds the memory held for out of order chunks.
+        -If 'hashes' includes md5, the on box md5sum is requested (see
+        _remote_ucs_md5) while the transfer is still running.
+        -If 'adaptive', the size of each range is tuned from the throughput
+        and latency of the ranges before it (see _ChunkTuner), starting from
+        the size tuned for this F5 by the previous download (stored in
+        '<F5IP>.tuning.json' in self.ucsDir), else 'chunk_size'. A failed range
+        is retried at half the size, up to ADAPTIVE_RANGE_RETRIES times.
+        -If self.encryptKey is set, the ranges are encrypted as they are hashed,
+        in file order, and written to 'ucsName'.enc (see archiveCrypto.py), so
+        encryption costs no extra pass over the file and the plain UCS never
+        reaches the disk. Ranges held for hashing are bounded as above. An
+        interrupted encrypted download resumes after the last complete frame.
+        -Local digests, and the remote md5 if retrieved, are stored alongside
+        the archive in 'ucsName'.digest (JSON) for use by get_ucs_checksums.
+        The digests are of the plain UCS, plus 'encryptedSha256' of the .enc file.
+        -The downloaded UCS is recorded in self.catalog.
 
         Attributes:
         The following instance attributes are used in API calls:
@@ -283,16 +534,24 @@ class F5Archive:
 
         Parameters:
         ucsName - string, the name of the ucs file to verify
-        chunk_size - integer, download chunk size, default=(512 * 1024)
+        chunk_size - integer, download chunk (or range) size, default=(512 * 1024).
+        Ignored when resuming, the chunk size recorded in the journal is used.
+        With adaptive=True, only the starting size for an F5 with no tuned size.
+        workers - integer, number of concurrent chunk downloads, default=1
+        (keep at or below the poolSize given to F5Archive so connections are reused)
+        hashes - tuple of hashlib algorithm names to digest the UCS with,
+        default=("md5",) to match the F5 md5sum. eg ("md5", "sha256")
+        adaptive - boolean, tune the range size to the link, default=False
 
         Exceptions:
         exceptions are caught for an requests module API calls and stored as
-        a string to be returned for error logging
+        a string to be returned for error logging. No further chunks are
+        requested after the first failure (after the retries, if adaptive).
 
         Returns:
         A string indicating download status of UCS: if downloaded successfully,
-        return string includes name, size and time to download. If unsuccessful
-        download, return string contains relevant exception error string.
+        return string includes name, size, time to download and throughput. If
+        unsuccessful download, return string contains relevant exception error string.
 
         Note:
         Most of this download content taken from here:
@@ -303,74 +562,313 @@ class F5Archive:
 
         #create error log variable
         status = ""
-        fileSize = ""
-        url = "https://"+self.F5IP+"/mgmt/shared/file-transfer/ucs-downloads/"
+        url = "https://"+self.F5IP+"/mgmt/shared/file-transfer/ucs-downloads/"+ucsName
+        ucsFile = self.ucsDir+ucsName
+        journalFile = ucsFile+".journal"
+        headers = {
+                'Content-Type': 'application/octet-stream',
+                'Content-Range': f'0-{chunk_size - 1}/0'
+            }
+        startTime = time.perf_counter()
+        #first call is only used to find the total size of the ucs
+        try:
+            resp = self.session.get(url, headers=headers, stream=True)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            #if API connection error, send status error message
+            logging.debug(f'ERROR download UCS GET issue {e}')
+            return f'ERROR download_ucs GET failure {e}'
+        #eg, Content-Range: bytes 200-1000/67589
+        fileSize = int(resp.headers['Content-Range'].split('/')[-1])
+        resp.close()
+
+        tuner = _ChunkTuner(self._tuned_chunk_size(chunk_size)) if adaptive else None
+        writer = None
+        if self.encryptKey:
+            #ranges go to the file encrypted, via the in order hasher
+            hasher = _RangeHasher(hashes, ucsFile, fileSize)
+            chunk_size, writer = self._open_encrypted_ucs(ucsFile, fileSize, chunk_size, hasher)
+            hasher.sink = writer.write
+            done = {0: writer.plainBytes - 1} if writer.plainBytes else {}
+        else:
+            #reuse chunks from a previous failed run, else start a new journal
+            chunk_size, done = self._read_ucs_journal(ucsFile, fileSize, chunk_size)
+            if not done:
+                #preallocate local file so each chunk can be written at its offset
+                with open(ucsFile, 'wb') as f:
+                    f.truncate(fileSize)
+                with open(journalFile, 'w') as journal:
+                    journal.write(json.dumps({"fileSize": fileSize, "chunkSize": chunk_size})+"\n")
+            hasher = _RangeHasher(hashes, ucsFile, fileSize, done)
+
+        #(start, end) byte ranges, planned as they are needed so an adaptive
+        #size applies straight away. If the file is smaller than the chunk
+        #size, BIG-IP will return an HTTP 400, so the last range is always
+        #clamped to the file size
+        #an adaptive range is never so large that it leaves workers idle
+        workerShare = max(ADAPTIVE_MIN_CHUNK, -(-fileSize // (workers * 64 * 1024)) * 64 * 1024)
+        sizer = (lambda: min(tuner.chunkSize, workerShare)) if tuner else (lambda: chunk_size)
+        planned = _plan_ranges(fileSize, done, sizer)
+        retryRanges = []
+        rangeCount, failures = 0, 0
+        journalLock = threading.Lock()
+
+        #one extra thread so the on box md5sum runs alongside the chunk workers
+        with ThreadPoolExecutor(max_workers=workers + 1) as pool:
+            remoteFuture = pool.submit(self._remote_ucs_md5, ucsName) if "md5" in hashes else None
+            nextRange = next(planned, None)
+            inflight = {}
+            while (nextRange or retryRanges or inflight) and not status:
+                #keep 'workers' chunks in flight, within the window ahead of the hasher.
+                #The adaptive size changes under us as workers finish, so it is read
+                #once per range and a split range never leaves a gap or overlap
+                while len(inflight) < workers:
+                    size = sizer()
+                    if not (retryRanges or (nextRange and nextRange[0] < hasher.position + 2 * workers * size)):
+                        break
+                    if retryRanges:
+                        #failed ranges are refetched first, at the current size
+                        start, end = retryRanges.pop()
+                        if end - start + 1 > size:
+                            retryRanges.append((start + size, end))
+                            end = start + size - 1
+                    else:
+                        start, end = nextRange
+                        nextRange = next(planned, None)
+                    inflight[pool.submit(self._download_ucs_range, url, ucsFile, start, end, \
+                    fileSize, journalLock, hasher, tuner, writer is not None)] = (start, end)
+                    rangeCount += 1
+                finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    byteRange = inflight.pop(future)
+                    error = future.result()
+                    if error and tuner and failures < ADAPTIVE_RANGE_RETRIES:
+                        failures += 1
+                        tuner.failed()
+                        retryRanges.append(byteRange)
+                    elif error and not status:
+                        status = error
+            remoteHash, remoteError = remoteFuture.result() if remoteFuture else ("", "")
+        if writer:
+            #the last frame marks the file complete, a failed download stays resumable
+            writer.close(final=not status)
+        stopTime = time.perf_counter()
+        if tuner:
+            self._save_tuned_chunk_size(tuner)
+        doneBytes = sum(end - start + 1 for start, end in done.items())
+
+        if not status:
+            os.remove(journalFile)
+            digests = hasher.hexdigests()
+            if remoteHash:
+                digests["remoteMd5"] = remoteHash
+            if writer:
+                digests["encryptedSha256"] = writer.sha256.hexdigest()
+            with open(ucsFile+".digest", 'w') as digestFile:
+                json.dump(digests, digestFile)
+            self._catalog("record", self.F5IP, UCS, writer.path if writer else ucsFile, \
+            ucsName.rsplit('_', 2)[0], digests, stopTime - startTime)
+            status = f'{ucsName}, size {fileSize}bytes, downloaded in {stopTime - startTime:0.4f} seconds' \
+            f' ({self._throughput(fileSize - doneBytes, stopTime - startTime)}'
+            if workers > 1:
+                status += f', {rangeCount} ranges, {workers} workers'
+            if tuner:
+                status += f', adaptive chunk {sizer() // 1024}KB'
+                if tuner.latency is not None:
+                    status += f' latency {tuner.latency * 1000:0.0f}ms'
+                if failures:
+                    status += f' after {failures} range retries'
+            if done:
+                status += f', resumed {len(done)} journaled ranges' if not writer else \
+                f', resumed {doneBytes}bytes encrypted'
+            if writer:
+                status += f', stored encrypted as {os.path.basename(writer.path)}'
+            status += ') UCSSUCCESS'
+        else:
+            status += f' (progress journaled to {os.path.basename(journalFile)}, rerun to resume)'
+
+        return status
+
+    def _download_ucs_range(self, url, ucsFile, start, end, fileSize, journalLock, hasher, tuner=None, \
+    encrypted=False):
+        """
+        Downloads a single byte range of a UCS, writes it at its offset in the
+        (preallocated) local file, passes it to 'hasher' and, once flushed to
+        disk, appends the range and its md5 to the journal. Used as the worker
+        for download_ucs. If 'encrypted', the range is only passed to 'hasher',
+        which encrypts and writes it in file order.
+
+        Returns:
+        empty string on success, otherwise exception error string
+        """
+
         headers = {
-                'Content-Type': 'application/octet-stream'
+                'Content-Type': 'application/octet-stream',
+                'Content-Range': f'{start}-{end}/{fileSize}'
             }
-        #ucsDir = os.getcwd()+"\\F5Backups\\"
-        with open(self.ucsDir+ucsName, 'wb') as f:
-            start = 0
-            end = chunk_size -1
-            size = 0
-            current_bytes = 0
-            startTime = time.perf_counter()
-            while True:
-                content_range = f'{start}-{end}/{size}'
-                headers['Content-Range'] = content_range
-                logging.debug(f'DEBUG Content Range = {headers["Content-Range"]}')
-                #stream=True tells requests that file will be buffered using
-                #iter_content to control flow with specific chunk size
+        logging.debug(f'DEBUG Content Range = {headers["Content-Range"]}')
+        data = bytearray()
+        requestTime = time.perf_counter()
+        try:
+            #stream=True tells requests that file will be buffered using
+            #iter_content to control flow with specific chunk size
+            resp = self.session.get(url, headers=headers, stream=True, timeout=RANGE_TIMEOUT)
+            resp.raise_for_status()
+            latency = time.perf_counter() - requestTime
+            for chunk in resp.iter_content(64 * 1024):
+                data += chunk
+        except requests.exceptions.RequestException as e:
+            logging.debug(f'ERROR download UCS GET range {start}-{end} issue {e}')
+            return f'ERROR download_ucs GET range {start}-{end} failure {e}'
+        if len(data) != end - start + 1:
+            return f'ERROR download_ucs range {start}-{end} short read {len(data)}bytes'
+        if tuner:
+            tuner.observe(len(data), time.perf_counter() - requestTime, latency)
+        if encrypted:
+            hasher.update(start, bytes(data))
+            return ""
+        #each worker uses its own file handle so seek/write do not interleave
+        with open(ucsFile, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        hasher.update(start, bytes(data))
+        #only journal the range once its bytes are on disk
+        with journalLock, open(ucsFile+".journal", 'a') as journal:
+            journal.write(json.dumps({"start": start, "end": end, \
+            "md5": hashlib.md5(data).hexdigest()})+"\n")
+        return ""
+
+    def _read_ucs_journal(self, ucsFile, fileSize, chunk_size):
+        """
+        Loads the sidecar journal of a previously interrupted download_ucs.
+
+        Functionality:
+        -The journal is only trusted if it describes a UCS of the same size as
+        the one now on the F5 and the partial local file is still present.
+        -Each journaled range is read back from the local file and its md5
+        compared with the journal, so only ranges verified on disk are skipped.
+
+        Returns:
+        tuple of the chunk size to use and a dictionary of start:end offsets
+        of verified ranges. The dictionary is empty if there is nothing to resume.
+        """
+
+        journalFile = ucsFile+".journal"
+        done = {}
+        if not (os.path.isfile(journalFile) and os.path.isfile(ucsFile)):
+            return chunk_size, done
+        header, entries = {}, []
+        with open(journalFile) as journal:
+            for line in journal:
                 try:
-                    resp = requests.get(url+ucsName, headers=headers, \
-                    auth=(self.username, self.password), verify=False, stream=True)
-                    resp.raise_for_status()
-                except requests.exceptions.RequestException as e:
-                    #if API connection error, break and send status error message
-                    logging.debug(f'ERROR download UCS GET issue {e}')
-                    status = f'ERROR download_ucs GET failure {e}'
+                    record = json.loads(line)
+                except ValueError:
+                    #a crash can leave the last line part written, ignore the rest
                     break
+                if not header:
+                    header = record
                 else:
-                    # If the size is zero, then this is the first time through the
-                    # loop and we don't want to write data because we haven't yet
-                    # figured out the total size of the file.
-                    if size > 0:
-                        current_bytes += chunk_size
-                        for chunk in resp.iter_content(chunk_size):
-                            f.write(chunk)
-
-                    # Once we've downloaded the entire file, we can break out of
-                    # the loop
-                    if end == size:
-                        break
-                crange = resp.headers['Content-Range']
-                fileSize = crange.split('/')[-1]
-                # Determine the total number of bytes to read
-                if size == 0:
-                    #eg, Content-Range: bytes 200-1000/67589
-                    size = int(crange.split('/')[-1]) - 1
-
-                    # If the file is smaller than the chunk size, BIG-IP will
-                    # return an HTTP 400. So adjust the chunk_size down to the
-                    # total file size...
-                    if chunk_size > size:
-                        end = size
-
-                    # ...and pass on the rest of the code
-                    continue
-                start += chunk_size
-
-                if (current_bytes + chunk_size) > size:
-                    end = size
-                else:
-                    end = start + chunk_size - 1
+                    entries.append(record)
+        if header.get("fileSize") != fileSize or os.path.getsize(ucsFile) != fileSize:
+            logging.debug(f'DEBUG journal {journalFile} does not match UCS, restarting')
+            return chunk_size, done
+        with open(ucsFile, 'rb') as f:
+            for entry in entries:
+                f.seek(entry["start"])
+                data = f.read(entry["end"] - entry["start"] + 1)
+                if hashlib.md5(data).hexdigest() == entry["md5"]:
+                    done[entry["start"]] = entry["end"]
+        logging.debug(f'DEBUG journal {journalFile} resuming {len(done)} ranges')
+        return header["chunkSize"], done
+
+    def _open_encrypted_ucs(self, ucsFile, fileSize, chunk_size, hasher):
+        """
+        Opens 'ucsFile'.enc for an encrypted download_ucs. If the journal of an
+        interrupted encrypted download of the same size UCS exists, the file is
+        reopened after its last complete frame and the plain data of the
+        frames is fed to 'hasher', otherwise a new file and journal are started.
 
-            stopTime = time.perf_counter()
+        Returns:
+        tuple of the chunk size to use and an EncryptingWriter
+        """
 
-        if not status:
-            status = f'{ucsName}, size {fileSize}bytes, downloaded in {stopTime - startTime:0.4f} seconds UCSSUCCESS'
+        journalFile = ucsFile+".journal"
+        header = {}
+        if os.path.isfile(journalFile):
+            with open(journalFile) as journal:
+                try:
+                    header = json.loads(journal.readline())
+                except ValueError:
+                    header = {}
+            #a partial unencrypted download is not resumed encrypted
+            if not header.get("encrypted") and os.path.isfile(ucsFile):
+                os.remove(ucsFile)
+        if header.get("encrypted") and header.get("fileSize") == fileSize and os.path.isfile(ucsFile+ENC_SUFFIX):
+            try:
+                return header["chunkSize"], EncryptingWriter.resume(ucsFile+ENC_SUFFIX, self.encryptKey, \
+                hasher.resume)
+            except (ArchiveDecryptError, OSError) as e:
+                logging.debug(f'DEBUG cannot resume {ucsFile}{ENC_SUFFIX}, restarting: {e}')
+        with open(journalFile, 'w') as journal:
+            journal.write(json.dumps({"fileSize": fileSize, "chunkSize": chunk_size, "encrypted": True})+"\n")
+        return chunk_size, EncryptingWriter(ucsFile+ENC_SUFFIX, self.encryptKey)
+
+    def _stored_ucs(self, ucsName):
+        """returns the path of the local UCS, 'ucsName'.enc if it is stored encrypted"""
+        if not os.path.isfile(self.ucsDir+ucsName) and os.path.isfile(self.ucsDir+ucsName+ENC_SUFFIX):
+            return self.ucsDir+ucsName+ENC_SUFFIX
+        return self.ucsDir+ucsName
+
+    def _tuning_file(self):
+        """returns path of the file holding the tuned download chunk size for this F5"""
+        return self.ucsDir+self.F5IP.replace(":", "_")+".tuning.json"
+
+    def _tuned_chunk_size(self, default):
+        """returns the chunk size tuned by the last adaptive download from this F5, or 'default'"""
+        try:
+            with open(self._tuning_file()) as tuningFile:
+                return int(json.load(tuningFile)["chunkSize"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug(f'DEBUG no tuned chunk size for {self.F5IP}: {e}')
+            return default
+
+    def _save_tuned_chunk_size(self, tuner):
+        tuning = {"chunkSize": tuner.chunkSize, "throughput": tuner.throughput, \
+        "latency": tuner.latency, "updated": str(datetime.datetime.now())}
+        with open(self._tuning_file()+".tmp", 'w') as tuningFile:
+            json.dump(tuning, tuningFile)
+        os.replace(self._tuning_file()+".tmp", self._tuning_file())
+
+    @staticmethod
+    def _throughput(fileSize, seconds):
+        """returns transfer rate of 'fileSize' bytes over 'seconds' as MB/s string"""
+        if not seconds:
+            return "n/a MB/s"
+        return f'{int(fileSize) / seconds / (1024 * 1024):0.2f} MB/s'
+
+    def _remote_ucs_md5(self, ucsName):
+        """
+        Runs md5sum against the on box UCS via /mgmt/tm/util/bash/
 
-        return status
+        Returns:
+        tuple of (md5 hex string, error string), one of which is empty.
+        """
+
+        payload = {"command":"run", "utilCmdArgs":" -c 'md5sum /var/local/ucs/"+ucsName+"'"}
+        #define the /util/bash path - need to be admin to run bash
+        url = "https://"+self.F5IP+"/mgmt/tm/util/bash/"
+        headers = {"Content-type" : "application/json"}
+        #call API to get md5sum of on box ucs
+        try:
+            resp = self.session.post(url, headers=headers, json=payload)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.debug(f'DEBUG POST md5sum call failed error: {e}')
+            return "", f'ERROR get_ucs_checksums POST call failed: {e}'
+        respDict = json.loads(resp.text)
+        return respDict["commandResult"].split()[0], ""
 
     def get_ucs_checksums(self, ucsName):
         """
@@ -378,10 +876,17 @@ class F5Archive:
         and checks for a match, thus ensuring data integrity
 
         Functionality:
-        -The function will make an API call to get the checksum. This call
-        is a POST to /mgmt/tm/util/bash/ to call the md5sum utility.
-        -A checksum command is run against the local (previously downloaded)
-        version of the UCS and the two checksum values compared for parity.
+        -If download_ucs stored a 'ucsName'.digest file alongside the UCS, the
+        local md5 and (if retrieved during the download) the remote md5 are
+        taken from it, so the local file is not read again.
+        -Otherwise the function will make an API call to get the checksum. This
+        call is a POST to /mgmt/tm/util/bash/ to call the md5sum utility.
+        -Otherwise a checksum is calculated against the local (previously
+        downloaded) version of the UCS, reading it in blocks rather than
+        loading the whole file into memory. An encrypted UCS is decrypted
+        as it is read, with self.encryptKey.
+        -The two checksum values are compared for parity. Matching checksums
+        are recorded in 'ucsName'.digest and the UCS marked verified in self.catalog.
 
         Attributes:
         The following instance attributes are used in API calls:
@@ -398,7 +903,7 @@ class F5Archive:
 
         Returns:
         string of the remote (on F5 box) and local (downloaded) checksums.
-        If exception raised, exception string returned.
+        If exception raised or checksums differ, error string returned.
 
         Authentication:
         Requires admin account to run /bash commands
@@ -406,45 +911,329 @@ class F5Archive:
 
         #create error log variable
         status = ""
+        digests = {}
+        if os.path.isfile(self.ucsDir+ucsName+".digest"):
+            with open(self.ucsDir+ucsName+".digest") as digestFile:
+                digests = json.load(digestFile)
 
-        payload = {"command":"run", "utilCmdArgs":" -c 'md5sum /var/local/ucs/"+ucsName+"'"}
-        #define the /util/bash path - need to be admin to run bash
-        url = "https://"+self.F5IP+"/mgmt/tm/util/bash/"
-        headers = {"Content-type" : "application/json"}
-        remoteHash = ""
-        #call API to get md5sum of on box ucs
-        try:
-            resp = requests.post(url, auth=(self.username, self.password),headers=headers, \
-            json=payload, verify=False)
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.debug(f'DEBUG POST md5sum call failed error: {e}')
-            status = f'ERROR get_ucs_checksums POST call failed: {e}'
-        else:
-            respDict = json.loads(resp.text)
-            remoteHash = respDict["commandResult"].split()[0]
+        remoteHash = digests.get("remoteMd5", "")
+        if not remoteHash:
+            remoteHash, status = self._remote_ucs_md5(ucsName)
 
-        localHash = ""
+        localHash = digests.get("md5", "")
         #if status empty (no exceptions to API call) and remoteHash contains a string
-        if not status and remoteHash:
-            #set current directory
-            curPath = os.getcwd()
+        if not status and remoteHash and not localHash:
             #if local UCS exists, get checksum of local UCS copy
             if os.path.isfile(self.ucsDir+ucsName):
+                localMd5 = hashlib.md5()
                 with open(self.ucsDir+ucsName, 'rb') as f:
-                    data = f.read()
-                    localHash = hashlib.md5(data).hexdigest()
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        localMd5.update(block)
+                localHash = localMd5.hexdigest()
+            elif os.path.isfile(self.ucsDir+ucsName+ENC_SUFFIX) and self.encryptKey:
+                localMd5 = hashlib.md5()
+                try:
+                    with open(self.ucsDir+ucsName+ENC_SUFFIX, 'rb') as f:
+                        for block in decrypt_chunks(f, self.encryptKey):
+                            localMd5.update(block)
+                    localHash = localMd5.hexdigest()
+                except ArchiveDecryptError as e:
+                    status = f'ERROR get_ucs_checksums {ucsName}{ENC_SUFFIX} {e}'
             else:
                 status = "ERROR local file doesnt exist"
 
         #compare on-box and local copies of UCS, if they match return success string
-        if remoteHash == localHash:
+        if not status and remoteHash == localHash:
             logging.debug(f": {remoteHash}:{localHash}")
             status = f"Remotehash:Localhash {remoteHash}:{localHash}"
+            #record the verified checksum for later restores (see restore_ucs)
+            if digests.get("remoteMd5") != remoteHash:
+                digests.update({"md5": localHash, "remoteMd5": remoteHash})
+                with open(self.ucsDir+ucsName+".digest", 'w') as digestFile:
+                    json.dump(digests, digestFile)
+            self._catalog("update", self._stored_ucs(ucsName), md5=localHash, verified=True)
+        elif not status:
+            status = f"ERROR get_ucs_checksums mismatch Remotehash:Localhash {remoteHash}:{localHash}"
 
         return status
 
 
+    def _ucs_chain(self, ucsName):
+        """
+        Returns list of UCS names from the full base to 'ucsName', following
+        the base named in each '.delta' header. A full UCS is its own chain.
+        """
+
+        chain = [ucsName]
+        while not os.path.isfile(self.ucsDir+chain[0]):
+            chain.insert(0, read_delta_header(self.ucsDir+chain[0]+".delta")["base"])
+        return chain
+
+    def _previous_ucs(self, ucsName):
+        """
+        Returns the name of the newest UCS (full or delta) in self.ucsDir from
+        the same hostname as 'ucsName', or empty string if there is none
+        """
+
+        hostname = ucsName.rsplit('_', 2)[0]
+        candidates = []
+        for fileName in os.listdir(self.ucsDir):
+            name = fileName[:-len(".delta")] if fileName.endswith(".ucs.delta") else fileName
+            if name != ucsName and name.endswith(".ucs") and name.rsplit('_', 2)[0] == hostname:
+                candidates.append((os.path.getmtime(self.ucsDir+fileName), name))
+        return max(candidates)[1] if candidates else ""
+
+    def store_ucs_delta(self, ucsName, fullEvery=7):
+        """
+        Replaces a downloaded UCS with a binary delta against the previous UCS
+        from the same hostname
+
+        Functionality:
+        -Finds the previous UCS (full or delta) of the same hostname in
+        self.ucsDir. If there is none, or the full base at the start of its
+        delta chain is 'fullEvery' days old or more, the UCS is kept in full
+        and becomes the base of a new chain.
+        -Otherwise the previous UCS is rebuilt (if it is itself a delta) and a
+        delta of the new UCS against it is written to 'ucsName'.delta
+        (see ucsDelta.py). The delta is applied back, hashing the rebuilt
+        bytes without writing them, and checked against the recorded md5
+        before the full UCS is deleted.
+
+        Parameters:
+        ucsName - string, the name of the downloaded ucs
+        fullEvery - integer, days after which a new full base is kept, default=7
+
+        Exceptions:
+        file, zlib and delta format errors are caught, the partial delta is
+        removed and the full UCS kept, and the error returned as a string
+
+        Returns:
+        string indicating if UCS kept in full or stored as delta with sizes,
+        or error string
+
+        Note:
+        Requires the md5 recorded in 'ucsName'.digest by download_ucs. UCS'
+        stored encrypted are always kept in full.
+        """
+
+        ucsFile = self.ucsDir+ucsName
+        if self._stored_ucs(ucsName) != ucsFile:
+            return f'{ucsName} kept in full, encrypted UCS\' are not stored as deltas'
+        digests = {}
+        if os.path.isfile(ucsFile+".digest"):
+            with open(ucsFile+".digest") as digestFile:
+                digests = json.load(digestFile)
+        if "md5" not in digests:
+            return f'ERROR store_ucs_delta no recorded checksum for {ucsName}'
+
+        previous = self._previous_ucs(ucsName)
+        if not previous:
+            return f'{ucsName} kept as full base, no previous UCS'
+        try:
+            chain = self._ucs_chain(previous)
+        except (OSError, ValueError) as e:
+            return f'{ucsName} kept as full base, previous UCS chain unreadable: {e}'
+        if ucsName in chain:
+            return f'{ucsName} kept in full, it is the base of {previous}'
+        baseAge = datetime.datetime.now() - datetime.datetime.fromtimestamp( \
+        os.path.getmtime(self.ucsDir+chain[0]))
+        if baseAge >= datetime.timedelta(days=fullEvery):
+            return f'{ucsName} kept as full base, previous base {chain[0]} is {baseAge.days} days old'
+
+        basePath = self.ucsDir+previous
+        tempBase = ""
+        if len(chain) > 1:
+            #previous is a delta itself, rebuild it to a temporary file
+            tempBase = basePath+".base.tmp"
+            status = self.restore_ucs(previous, tempBase)
+            if status.startswith("ERROR"):
+                return f'ERROR store_ucs_delta rebuilding {previous}: {status}'
+            basePath = tempBase
+        header = {"base": previous, "size": os.path.getsize(ucsFile)}
+        header.update({k: v for k, v in digests.items() if k in ("md5", "sha256")})
+        try:
+            copied, literal = write_delta(basePath, ucsFile, ucsFile+".delta", header)
+            #prove the delta rebuilds the UCS before deleting the full copy, the
+            #rebuilt bytes are only hashed so nothing is written
+            rebuilt = apply_delta(basePath, ucsFile+".delta", os.devnull)
+        except (OSError, zlib.error, ValueError, struct.error) as e:
+            logging.debug(f'DEBUG store_ucs_delta {ucsName} failed error: {e}')
+            if os.path.isfile(ucsFile+".delta"):
+                os.remove(ucsFile+".delta")
+            return f'ERROR store_ucs_delta {ucsName} failed, kept in full: {e}'
+        finally:
+            if tempBase and os.path.isfile(tempBase):
+                os.remove(tempBase)
+        if rebuilt["md5"] != digests["md5"]:
+            os.remove(ucsFile+".delta")
+            return f'ERROR store_ucs_delta {ucsName} delta does not rebuild recorded md5'
+        os.remove(ucsFile)
+        self._catalog("update", ucsFile, delta=True)
+        return f'{ucsName} stored as delta of {previous}: {os.path.getsize(ucsFile+".delta")}bytes ' \
+        f'for {header["size"]}bytes UCS ({copied}bytes from base, {literal}bytes new)'
+
+    def restore_ucs(self, ucsName, destination):
+        """
+        Rebuilds a UCS stored by store_ucs_delta, or copies a full UCS, to
+        'destination' and verifies it against the md5 recorded for it
+
+        Functionality:
+        -Follows the delta chain back to the full base UCS
+        -Applies each delta in turn, from the base forward, using temporary
+        files for the intermediate UCS'
+        -A UCS stored encrypted ('ucsName'.enc) is decrypted to 'destination'
+        with self.encryptKey as it is read, every frame authenticated
+        -Compares the md5 of the result with the md5 in 'ucsName'.digest (the
+        checksum verified against the F5 by download_ucs/get_ucs_checksums)
+
+        Parameters:
+        ucsName - string, the name of the ucs to restore
+        destination - string, path of the file to write
+
+        Returns:
+        string with restored UCS details, or error string
+        """
+
+        digests = {}
+        if self._stored_ucs(ucsName) != self.ucsDir+ucsName:
+            if not self.encryptKey:
+                return f'ERROR restore_ucs {ucsName} is encrypted and no key was given'
+            try:
+                digests = decrypt_file(self._stored_ucs(ucsName), destination, self.encryptKey)
+            except (ArchiveDecryptError, OSError) as e:
+                return f'ERROR restore_ucs decrypting {ucsName}: {e}'
+            chain = [ucsName]
+        else:
+            try:
+                chain = self._ucs_chain(ucsName)
+            except (OSError, ValueError) as e:
+                return f'ERROR restore_ucs {ucsName} chain unreadable: {e}'
+        current = self.ucsDir+chain[0]
+        for step, name in enumerate(chain[1:], 1):
+            output = destination if step == len(chain) - 1 else f'{destination}.{step}.tmp'
+            try:
+                digests = apply_delta(current, self.ucsDir+name+".delta", output)
+            except (OSError, ValueError, zlib.error) as e:
+                return f'ERROR restore_ucs applying {name}.delta: {e}'
+            if current != self.ucsDir+chain[0]:
+                os.remove(current)
+            current = output
+        if len(chain) == 1 and not digests:
+            shutil.copyfile(current, destination)
+            md5 = hashlib.md5()
+            with open(destination, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(block)
+            digests = {"md5": md5.hexdigest()}
+
+        recorded = {}
+        if os.path.isfile(self.ucsDir+ucsName+".digest"):
+            with open(self.ucsDir+ucsName+".digest") as digestFile:
+                recorded = json.load(digestFile)
+        if recorded.get("md5") != digests["md5"]:
+            return f'ERROR restore_ucs {ucsName} md5 {digests["md5"]} does not match recorded {recorded.get("md5")}'
+        return f'{ucsName} restored to {destination} from {len(chain) - 1} deltas, md5 {digests["md5"]} verified'
+
+    def _snapshot_file(self, path):
+        """returns the decompressed text of config snapshot 'path', empty string if unreadable"""
+        try:
+            with gzip.open(path, 'rt', encoding="utf-8") as snapshotFile:
+                return snapshotFile.read()
+        except OSError as e:
+            logging.debug(f'DEBUG read config snapshot {path} failed error: {e}')
+            return ""
+
+    def snapshot_config(self, configFiles=CONFIG_FILES, saveFirst=False):
+        """
+        Takes a text snapshot of the F5 configuration, stored only if the
+        configuration changed since the last snapshot
+
+        Functionality:
+        -Makes one API call, a POST to /mgmt/tm/util/bash/, to read
+        'configFiles' (bigip_base.conf and bigip.conf by default). If
+        'saveFirst' is True 'tmsh save sys config' is run in the same call so
+        that changes not yet saved to the files are included.
+        -A sha256 digest of the returned text is compared with that of the
+        newest config snapshot of this device in self.catalog. If they match
+        nothing is written.
+        -Otherwise the text is written gzip compressed to self.snapshotDir as
+        'F5IP_YYYY-MM-DD_HHMMSS.conf.gz', recorded in self.catalog and the
+        number of lines added and removed since the previous snapshot reported.
+        A snapshot is a few hundred KB read from files already on the box, so
+        can be taken every few minutes between the nightly UCS backups.
+
+        Attributes:
+        The following instance attributes are used in API calls:
+        -self.F5IP
+        -self.username
+        -self.password
+
+        Parameters:
+        configFiles - tuple of the on box config file paths to read
+        saveFirst - boolean, save the running config to the files first
+
+        Exceptions:
+        exceptions are caught for an requests module API calls and stored as
+        a string to be returned for error logging
+
+        Returns:
+        string, the snapshot name and lines changed, or 'config unchanged since'
+        the previous snapshot. If exception raised, error string returned.
+
+        Authentication:
+        Requires admin account to run /bash commands
+        """
+
+        command = "tail -v -n +1 "+" ".join(configFiles)
+        if saveFirst:
+            command = "tmsh save sys config >/dev/null && "+command
+        url = "https://"+self.F5IP+"/mgmt/tm/util/bash/"
+        payload = {"command":"run", "utilCmdArgs":" -c '"+command+"'"}
+        headers = {"Content-type" : "application/json"}
+        try:
+            resp = self.session.post(url, headers=headers, json=payload)
+            resp.raise_for_status()
+            config = json.loads(resp.text).get("commandResult", "")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.debug(f'DEBUG POST config snapshot failed error: {e}')
+            return f'ERROR snapshot_config POST call failed: {e}'
+        #tail prints a '==> file <==' header before each file it could read
+        missing = [name for name in configFiles if f'==> {name} <==' not in config]
+        if missing:
+            return f'ERROR snapshot_config could not read {", ".join(missing)}: {config.strip()[:200]}'
+
+        digest = hashlib.sha256(config.encode("utf-8")).hexdigest()
+        try:
+            previous = self.catalog.latest(self.F5IP, CONFIG)
+        except sqlite3.Error as e:
+            logging.debug(f'DEBUG catalog latest failed error: {e}')
+            previous = None
+        if previous and previous["sha256"] == digest:
+            return f'config unchanged since {previous["name"]}'
+
+        timeNow = datetime.datetime.now()
+        snapshotName = f'{self.F5IP.replace(":", "_")}_{timeNow.strftime("%Y-%m-%d_%H%M%S")}.conf.gz'
+        try:
+            os.makedirs(self.snapshotDir, exist_ok=True)
+            with gzip.open(self.snapshotDir+snapshotName, 'wt', encoding="utf-8") as snapshotFile:
+                snapshotFile.write(config)
+        except OSError as e:
+            logging.debug(f'DEBUG write config snapshot failed error: {e}')
+            return f'ERROR snapshot_config write failed: {e}'
+        self._catalog("record", self.F5IP, CONFIG, self.snapshotDir+snapshotName, \
+        digests={"sha256": digest}, verified=True, taken=timeNow)
+
+        if not previous:
+            return f'{snapshotName} first config snapshot, {config.count(chr(10))} lines'
+        previousConfig = self._snapshot_file(os.path.join(previous["directory"], previous["name"]))
+        added = removed = 0
+        for line in difflib.unified_diff(previousConfig.splitlines(), config.splitlines(), n=0):
+            if line.startswith("+") and not line.startswith("+++"):
+                added += 1
+            elif line.startswith("-") and not line.startswith("---"):
+                removed += 1
+        return f'{snapshotName} config changed since {previous["name"]}, +{added} -{removed} lines'
+
     def get_f5mk(self):
         """
         Retrieves the string value of the master key from the F5
@@ -452,9 +1241,12 @@ class F5Archive:
         Functionality:
         -Makes an API call to the F5 to get the master key value. This call
         is a POST to /mgmt/tm/util/bash/ to call the f5mku utility.
-        -The local file storing the masterkey is opened and the key resuting
-        from the API call is compared to it. If the last line in the local file
-        doesnt have a key match, the new masterkey is appended to the local file.
+        -The key is compared with the current key of self.F5IP in self.keyring
+        (see backup_store/masterKeyring.py), a single indexed lookup. If it
+        differs it becomes the current key and the old key is kept as history,
+        otherwise only the time it was last seen is updated.
+        -The device hostname from self.deviceCache is recorded with the key, so
+        the key can be looked up by hostname when the device is replaced.
 
         Attributes:
         The following instance attributes are used in API calls:
@@ -463,65 +1255,160 @@ class F5Archive:
         -self.password
 
         Exceptions:
-        exceptions are caught for an requests module API calls and stored as
-        a string to be returned for error logging
+        exceptions are caught for an requests module API calls and keyring
+        errors and stored as a string to be returned for error logging. A
+        failed hostname lookup does not fail the backup, the key is recorded
+        without a hostname.
 
         Returns:
-        string indicating if masterkey was updated to local file or if masterkey
-        is same as previous file entry. If exception raised, exception string
+        string indicating if a new masterkey was recorded or if masterkey
+        is same as previously recorded. If exception raised, exception string
         returned.
 
         Authentication:
         Requires admin account to run /bash commands
         """
 
-        #create error log variable
-        status = ""
-
-        timeNow = datetime.datetime.now()
         url = "https://"+self.F5IP+"/mgmt/tm/util/bash/"
         payload = {"command":"run", "utilCmdArgs":" -c 'f5mku -K'"}
         headers = {"Content-type" : "application/json"}
-        masterKey = ""
         try:
-            resp = requests.post(url, auth=(self.username, self.password),headers=headers, \
-            json=payload, verify=False)
+            resp = self.session.post(url, headers=headers, json=payload)
             resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.debug(f'DEBUG POST to get f5mku: {e}')
-            status = f'ERROR get_f5mk POST call failed: {e}'
-        else:
             #get f5mk from JSON response and save as string
             masterKey = json.loads(resp.text)["commandResult"].split()[0]
-        #bool to use in conditional to determine file write
-        exists = False
-        #open file in append+read mode, set current read postion to start of file
-        #read in last line and compare to current masterkey returned b API call
-        if not status and masterKey:
-            with open("f5mk.txt", 'a+') as keyfile:
-                keyfile.seek(0,0)
-                lastline = (list(keyfile)[-1])
-                if lastline.split("/")[-1] == masterKey:
-                    #if masterkey already exists in file, do nothing
-                    exists = True
-                    status = f'f5mk same as previous on: {lastline.split("/")[0]}'
-                #if current key different than masterkeys in file, append current to file
-                if not exists:
-                    keyfile.write(f'\n{timeNow}/{masterKey}')
-                    status = f'new f5mk appended'
+        except requests.exceptions.RequestException as e:
+            logging.debug(f'DEBUG POST to get f5mku: {e}')
+            return f'ERROR get_f5mk POST call failed: {e}'
+        except (ValueError, KeyError, IndexError) as e:
+            return f'ERROR get_f5mk no masterkey in response: {e}'
 
-        return status
+        try:
+            if self.deviceCache is None:
+                self.deviceCache = default_cache()
+            #cached hostname, usually already fetched by generate_ucs
+            hostname = self.deviceCache.hostname(self.F5IP, self.session)
+        except (requests.exceptions.RequestException, ValueError, KeyError, sqlite3.Error) as e:
+            logging.debug(f'DEBUG get_f5mk hostname lookup failed: {e}')
+            hostname = None
+
+        #the keyring is opened on first use, so instances that never call
+        #get_f5mk do not create a keyring file
+        if self.keyring is None:
+            self.keyring = MasterKeyring()
+        try:
+            changed, previous = self.keyring.record(self.F5IP, masterKey, hostname)
+        except sqlite3.Error as e:
+            logging.debug(f'DEBUG keyring record failed error: {e}')
+            return f'ERROR get_f5mk keyring record failed: {e}'
+        if not changed:
+            return f'f5mk same as previous on: {previous["first_seen"]}'
+        if previous:
+            return f'new f5mk recorded, replaces key current since {previous["first_seen"]}'
+        return 'new f5mk recorded'
+
+    def _ucs_listing_file(self):
+        """returns path of the local cache of the on box UCS listing"""
+        return self.ucsDir+self.F5IP.replace(":", "_")+".ucslist.json"
+
+    def _save_ucs_listing(self, ucsDict, fetched):
+        with open(self._ucs_listing_file()+".tmp", 'w') as listFile:
+            json.dump({"fetched": fetched, "ucs": ucsDict}, listFile)
+        os.replace(self._ucs_listing_file()+".tmp", self._ucs_listing_file())
+
+    def _update_ucs_listing(self, added=None, removed=()):
+        """
+        Applies known changes to the cached on box UCS listing, if there is one,
+        keeping its fetch time so it still expires on schedule
+
+        Parameters:
+        added - dictionary of UCS path:[creation date, size] now on the F5
+        removed - list of UCS paths deleted from the F5
+        """
 
-    def cleanup_ucs(self, deleteOlder):
+        try:
+            with open(self._ucs_listing_file()) as listFile:
+                cached = json.load(listFile)
+        except (OSError, ValueError):
+            return
+        cached["ucs"].update(added or {})
+        for ucsPath in removed:
+            cached["ucs"].pop(ucsPath, None)
+        self._save_ucs_listing(cached["ucs"], cached["fetched"])
+
+    def _ucs_listing(self, listingMaxAge):
+        """
+        Returns the on box UCS listing as a dictionary of UCS path:[creation
+        date, size], from the local cache if it is less than 'listingMaxAge'
+        seconds old, else from a GET to /mgmt/tm/sys/ucs (which refreshes the
+        cache). generate_ucs and cleanup_ucs keep the cache up to date.
+
+        Returns:
+        tuple of (ucs dictionary, error string)
+        """
+
+        if os.path.isfile(self._ucs_listing_file()):
+            try:
+                with open(self._ucs_listing_file()) as listFile:
+                    cached = json.load(listFile)
+                if time.time() - cached["fetched"] < listingMaxAge:
+                    logging.debug(f'DEBUG using cached ucs listing {self._ucs_listing_file()}')
+                    return cached["ucs"], ""
+            except (OSError, ValueError, KeyError):
+                pass
+
+        url = "https://"+self.F5IP+"/mgmt/tm/sys/ucs"
+        #create dictionary to store on box ucs name,size,age
+        ucsDict = {}
+        try:
+            resp = self.session.get(url)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            #any other errors, send email alert and abort
+            logging.debug(f'DEBUG GET ucs list failed error: {e}')
+            return ucsDict, f'ERROR cleanup_ucs GET call failed: {e}'
+        #from resp, create dict with filename:list of creation date and size
+        for item in json.loads(resp.text).get('items', []):
+            value = item.get('apiRawValues')
+            if value:
+                ucsDict[value["filename"]] = [value["file_created_date"], value['file_size']]
+        if os.path.isdir(self.ucsDir):
+            self._save_ucs_listing(ucsDict, time.time())
+        return ucsDict, ""
+
+    def _delete_ucs(self, ucsPath):
+        """
+        Sends DELETE for one on box UCS, used as the worker for cleanup_ucs
+
+        Returns:
+        error string, empty if deleted or already gone (404)
+        """
+
+        #split the name of the ucs from its path
+        url = "https://"+self.F5IP+"/mgmt/tm/sys/ucs/"+ucsPath.split('/')[-1]
+        try:
+            delResp = self.session.delete(url)
+            if delResp.status_code != 404:
+                delResp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.debug(f'DEBUG DELETE ucs failed error: {e}')
+            return f'ERROR cleanup_ucs DELETE call failed: {e}'
+        return ""
+
+    def cleanup_ucs(self, deleteOlder, maxParallel=4, listingMaxAge=(24 * 3600)):
         """
         Delete UCS archives older than 'deleteOlder' from the F5
 
         Functionality:
-        -Makes an API call to get a list of UCS' and parse
-        them into a dictionary with keywords as UCS hostnames and the
-        values as lists containing the UCS filesize and creation date
-        -Then loops through the dictionary of UCS files and sends
-        an API call to DELETE any older than argument 'deleteOlder' days
+        -Gets the list of UCS' on the F5 as a dictionary with keywords as UCS
+        paths and the values as lists containing the UCS creation date and
+        filesize. The list is read from a local cache (see _ucs_listing) unless
+        it is more than 'listingMaxAge' seconds old, in which case an API call
+        is made to refresh it.
+        -Builds the list of UCS' older than argument 'deleteOlder' days and sends
+        their DELETE API calls concurrently, at most 'maxParallel' at a time for
+        this F5. A UCS already missing from the F5 (404) counts as deleted.
+        -Removes deleted UCS' from the cached listing
 
         Attributes:
         The following instance attributes are used in API calls:
@@ -532,6 +1419,9 @@ class F5Archive:
         Parameters:
         deleteOlder - integer, determines age in days for which UCS archives
         older than will be deleted
+        maxParallel - integer, maximum concurrent DELETE calls to this F5, default=4
+        listingMaxAge - integer, seconds a cached UCS listing is used before it
+        is fetched again, default=(24 * 3600)
 
         Exceptions:
         exceptions are caught for an requests module API calls and stored as
@@ -543,30 +1433,7 @@ class F5Archive:
         timestamp returned. If exception raised, exception string retruned.
         """
 
-        url = "https://"+self.F5IP+"/mgmt/tm/sys/ucs"
-        #create dictionary to store on box ucs name,size,age
-        ucsDict = {}
-        #create error log variable
-        status = ""
-        try:
-            resp = requests.get(url, auth=(self.username,self.password), verify=False)
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            #any other errors, send email alert and abort
-            logging.debug(f'DEBUG GET ucs list failed error: {e}')
-            status = f'ERROR cleanup_ucs GET call failed: {e}'
-        else:
-            #from resp, create dict with filename:list of size and creation date
-            for k,v in json.loads(resp.text).items():
-                if k == 'items':
-                    for value in v:
-                        dict1 = value
-                        for key, value in dict1.items():
-                            if key == 'apiRawValues':
-                                ucsList = []
-                                ucsList.append(value["file_created_date"])
-                                ucsList.append(value['file_size'])
-                                ucsDict[value["filename"]] = ucsList
+        ucsDict, status = self._ucs_listing(listingMaxAge)
         logging.debug(f'DEBUG {ucsDict} status = {status}')
         #if no exceptions so far and ucsDict is not empty, evaluate for deletion
         if status == "" and ucsDict:
@@ -574,8 +1441,7 @@ class F5Archive:
             now = datetime.datetime.utcnow()
             #delta = age in days after which ucs' will be deleted
             delta = datetime.timedelta(days=deleteOlder)
-            #set bool to use to determine if anything deleted
-            deletedUcs = False
+            deletePlan = []
             for k,v in ucsDict.items():
                 #setup datetime object for relative date comparison
                 ucsYear, ucsMonth, ucsDay, ucsHour, ucsMin = v[0][0:4], v[0][5:7], \
@@ -583,19 +1449,23 @@ class F5Archive:
                 ageUcs = datetime.datetime(int(ucsYear), int(ucsMonth), \
                 int(ucsDay), int(ucsHour), int(ucsMin))
                 if (ageUcs+delta) < now:
-                    #split the name of the ucs from its path and store in ucsDel
-                    ucsDel = "/"+k.split('/')[-1]
-                    try:
-                        delResp = requests.delete(url+ucsDel, auth=(self.username,self.password), \
-                        verify=False)
-                        delResp.raise_for_status()
-                    except requests.exceptions.RequestException as e:
-                        logging.debug(f'DEBUG DELETE ucs failed error: {e}')
-                        status = f'ERROR cleanup_ucs DELETE call failed: {e}'
+                    deletePlan.append((k, ageUcs))
+            #send the DELETEs for this F5 concurrently, bounded by maxParallel
+            if deletePlan:
+                with ThreadPoolExecutor(max_workers=maxParallel) as pool:
+                    errors = list(pool.map(self._delete_ucs, [k for k, _ in deletePlan]))
+                deleted = []
+                for (k, ageUcs), error in zip(deletePlan, errors):
+                    if error:
+                        status = status+error+'; '
                     else:
-                        deletedUcs = True
-                        status = status+f'DELETED: {ucsDel} created on {ageUcs}; '
-            #meaningful message if no exception raised nor UCS successfully deleted
-            if not status:
-                        status = f'Nothing to Delete {now}'
+                        deleted.append(k)
+                        status = status+f'DELETED: /{k.split("/")[-1]} created on {ageUcs}; '
+                self._update_ucs_listing(removed=deleted)
+                #report errors first so callers checking startswith('ERROR') see them
+                if 'ERROR' in status:
+                    status = 'ERROR cleanup_ucs '+status
+        #meaningful message if no exception raised nor UCS successfully deleted
+        if not status:
+            status = f'Nothing to Delete {datetime.datetime.utcnow()}'
         return status
@@ -0,0 +1,598 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Local stand-in for the BIG-IP iControl REST endpoints used by F5Archive, so
+the backup code can be tuned and benchmarked without touching a production
+F5.
+
+Endpoints:
+-GET /mgmt/tm/sys/global-settings - hostname, honours $select
+-GET /mgmt/shared/identified-devices/config/device-info - hostname, version,
+    platform and failover state in one document
+-POST /mgmt/tm/sys/ucs - synchronous UCS save
+-GET /mgmt/tm/sys/ucs - UCS listing (apiRawValues)
+-DELETE /mgmt/tm/sys/ucs/<name>
+-POST/PUT/GET/DELETE /mgmt/tm/task/sys/ucs[/<taskId>[/result]] - asynchronous
+    UCS save task: CREATED, VALIDATING after the PUT, COMPLETED 'saveSeconds' later
+-GET /mgmt/shared/file-transfer/ucs-downloads/<name> - Content-Range downloads.
+    As on BIG-IP, the '0-<n>/0' size probe is answered even for a file smaller
+    than the range, and any other range ending past the end gets an HTTP 400
+-POST /mgmt/tm/util/bash - 'md5sum /var/local/ucs/<name>', 'f5mku -K',
+    'tmsh save sys config' and 'tail -v -n +1 <config files>'
+-POST /mgmt/shared/authn/login - issues an X-F5-Auth-Token valid for 'tokenTimeout'
+-GET the stats read by f5_daily_checks - /mgmt/tm/cm/failover-status,
+    /mgmt/tm/sys/host-info, /mgmt/tm/sys/cpu/stats, /mgmt/tm/net/interface/stats,
+    /mgmt/tm/sys/hardware/stats, /mgmt/tm/gtm/datacenter[/<name>]/stats,
+    /mgmt/tm/gtm/server/stats and /mgmt/tm/gtm/pool|wideip/<type>/stats,
+    honouring $select and $top/$skip paging (with a 'nextLink'), with 'cpus',
+    'interfaces', 'datacenters', 'gtmServers', 'gtmPools' and 'wideIps'
+    objects (pools and wide IPs are type A)
+
+Requests need basic auth with the simulator's username and password, or a
+token from the login endpoint.
+
+Each UCS is the same random base bytes with a few small regions changed per
+save, as successive UCS' from one device are mostly unchanged, so delta and
+dedup storage behave as they would against a real F5.
+
+Link behaviour is configurable: 'latency' seconds added before every
+response, 'bandwidth' bytes/s shared by all responses (a token bucket), and
+failure injection, 'failureRate' probability of an HTTP 503 and 'dropRate'
+probability of closing the connection half way through a response body.
+
+Usage:
+python f5Simulator.py [--port 8443] [--ucs-size MB] [--save-seconds N]
+    [--latency S] [--bandwidth MB/s] [--failure-rate P] [--drop-rate P]
+    [--cert FILE --key FILE]
+Without --cert and --key a temporary self signed certificate is made with the
+openssl command.
+"""
+import os, json, time, random, hashlib, threading, argparse, base64, ssl, subprocess, tempfile, \
+datetime, logging, itertools, gzip
+import http.server
+from urllib.parse import urlsplit, parse_qs
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#bytes sent between bandwidth and drop checks
+SEND_BLOCK = 64 * 1024
+
+
+class _Link:
+    """token bucket limiting the bytes/s sent across every connection, None is unlimited"""
+
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+        self._available = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            #allow at most a quarter second of burst
+            self._available = min(self.bandwidth / 4, self._available + (now - self._updated) * self.bandwidth)
+            self._updated = now
+            self._available -= size
+            wait = -self._available / self.bandwidth if self._available < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _F5Handler(http.server.BaseHTTPRequestHandler):
+    """routes each request to the F5Simulator attached to the server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f'DEBUG simulator {self.address_string()} {format % args}')
+
+    def _reply(self, code, body=None, headers=None):
+        data = json.dumps({} if body is None else body).encode()
+        self.server.simulator._count("jsonBytes", len(data))
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        #as restjavad, large JSON bodies are compressed if the client accepts gzip
+        if len(data) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, 6)
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self._send_body(data)
+
+    def _send_body(self, data):
+        simulator = self.server.simulator
+        #an injected drop stops half way through the body
+        limit = len(data) // 2 if random.random() < simulator.dropRate else len(data)
+        try:
+            for offset in range(0, limit, SEND_BLOCK):
+                block = data[offset:min(offset + SEND_BLOCK, limit)]
+                simulator.link.consume(len(block))
+                self.wfile.write(block)
+        except (ConnectionError, ssl.SSLError) as e:
+            #client closed early, eg download_ucs only reads the headers of its size probe
+            logging.debug(f'DEBUG simulator client closed connection: {e}')
+            self.close_connection = True
+            return
+        simulator._count("bytesSent", limit)
+        if limit < len(data):
+            simulator._count("dropped")
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+    def _begin(self):
+        """
+        Reads the request body, applies latency, authentication and injected
+        failures. Returns (path, query dict, body dict), or None if the request
+        has already been answered.
+        """
+
+        simulator = self.server.simulator
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        simulator._count("requests")
+        if simulator.latency:
+            time.sleep(simulator.latency)
+        parts = urlsplit(self.path)
+        login = parts.path == "/mgmt/shared/authn/login"
+        if not login and not simulator._authorised(self.headers):
+            self._reply(401, {"code": 401, "message": "Authorization failed"})
+            return None
+        if random.random() < simulator.failureRate:
+            simulator._count("failed")
+            self._reply(503, {"code": 503, "message": "Service Unavailable (injected)"})
+            return None
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            self._reply(400, {"code": 400, "message": "invalid JSON body"})
+            return None
+        return parts.path.rstrip("/"), parse_qs(parts.query), body
+
+    def do_GET(self):
+        request = self._begin()
+        if request:
+            self.server.simulator._get(self, *request)
+
+    def do_POST(self):
+        request = self._begin()
+        if request:
+            self.server.simulator._post(self, *request)
+
+    def do_PUT(self):
+        request = self._begin()
+        if request:
+            self.server.simulator._put(self, *request)
+
+    def do_DELETE(self):
+        request = self._begin()
+        if request:
+            self.server.simulator._delete(self, *request)
+
+
+class F5Simulator:
+    """
+    This class runs a simulated BIG-IP iControl REST API on a local port.
+
+    Methods:
+    - start - starts serving HTTPS in a background thread
+    - stop - stops serving
+    - save_ucs - creates a UCS as if saved on box, returns its name
+    - change_config - changes the running config, written to the config
+        files by the next 'tmsh save sys config'
+    The class can also be used as a context manager, ie
+    'with F5Simulator() as sim: F5Archive(sim.address, "admin", "admin")'
+
+    Instance Attributes:
+    -self.hostname - hostname returned by global-settings
+    -self.username, self.password - basic auth credentials accepted
+    -self.ucsSize - size in bytes of every UCS
+    -self.saveSeconds - time a UCS save takes, synchronous or as a task
+    -self.latency - seconds added before every response
+    -self.link - bandwidth limit shared by all responses, see 'bandwidth'
+    -self.failureRate - probability (0-1) of answering a request with a 503
+    -self.dropRate - probability (0-1) of dropping a response body part way
+    -self.ucs - dictionary of UCS name:{'created', 'patches', 'md5'}
+    -self.config - dictionary of on box config file path:saved text
+    -self.runningConfig - dictionary of config file path:running config text
+    -self.taskCompleted - dictionary of task id:time.perf_counter() when each
+        UCS save task reached COMPLETED, used to measure task polling delay
+    -self.tokens - dictionary of issued token:expiry time
+    -self.stats - dictionary of request counters, including 'basicAuth'
+        (requests authenticated with a password), 'logins' and 'jsonBytes'
+        (JSON reply bodies before any compression)
+    -self.cpus - number of CPUs reported in the cpu stats
+    -self.interfaces, self.datacenters, self.gtmServers, self.gtmPools,
+        self.wideIps - dictionaries of object name:status reported in the
+        stats endpoints
+    -self.address - 'host:port' to give F5Archive once started
+    """
+
+    def __init__(self, port=0, hostname="bigip1.simulator.local", username="admin", password="admin", \
+    ucsSize=(64 * 1024 * 1024), saveSeconds=2, latency=0, bandwidth=None, failureRate=0, dropRate=0, \
+    certFile=None, keyFile=None, changeBytes=(64 * 1024), tokenTimeout=1200, cpus=4, interfaces=8, \
+    datacenters=("DC1", "DC2"), gtmServers=4, gtmPools=4, wideIps=4):
+        self.port = port
+        self.hostname = hostname
+        self.username, self.password = username, password
+        self.ucsSize = ucsSize
+        self.saveSeconds = saveSeconds
+        self.latency = latency
+        self.link = _Link(bandwidth)
+        self.failureRate, self.dropRate = failureRate, dropRate
+        self.certFile, self.keyFile = certFile, keyFile
+        self.changeBytes = changeBytes
+        self.tokenTimeout = tokenTimeout
+        self.tokens = {}
+        self.ucs = {}
+        self.tasks = {}
+        self.taskCompleted = {}
+        self.stats = {}
+        self.masterKey = base64.b64encode(os.urandom(16)).decode()
+        self.runningConfig = {
+            "/config/bigip_base.conf": "#TMSH-VERSION: 14.1.2.3\n\nsys global-settings {\n" \
+            f'    hostname {hostname}\n}}\n',
+            "/config/bigip.conf": "#TMSH-VERSION: 14.1.2.3\n\n" + "".join(f'ltm pool /Common/pool{number} ' \
+            f'{{\n    members {{\n        /Common/10.0.{number // 250}.{number % 250}:80 {{ }}\n    }}\n}}\n' \
+            for number in range(200)),
+        }
+        self.config = dict(self.runningConfig)
+        self.cpus = cpus
+        self.interfaces = {f'1.{number}': "up" if number % 3 else "down" for number in range(1, interfaces + 1)}
+        self.interfaces["mgmt"] = "up"
+        self.datacenters = {name: "available" for name in datacenters}
+        self.gtmServers = {f'server{number}': "available" for number in range(1, gtmServers + 1)}
+        self.gtmPools = {f'pool{number}': "available" for number in range(1, gtmPools + 1)}
+        self.wideIps = {f'www{number}.example.com': "available" for number in range(1, wideIps + 1)}
+        self.address = ""
+        self._base = os.urandom(ucsSize)
+        self._lock = threading.Lock()
+        self._taskIds = itertools.count(1000)
+        self._server = None
+        self._tempDir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """starts the HTTPS server thread, returns self"""
+        if not (self.certFile and self.keyFile):
+            self.certFile, self.keyFile = self._self_signed()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certFile, self.keyFile)
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), _F5Handler)
+        self._server.daemon_threads = True
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._server.simulator = self
+        self.address = f'127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, name="F5Simulator", daemon=True).start()
+        return self
+
+    def stop(self):
+        """stops the server and removes any temporary certificate"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._tempDir:
+            self._tempDir.cleanup()
+            self._tempDir = None
+
+    def _self_signed(self):
+        #ssl cannot make certificates, so use the openssl command line
+        self._tempDir = tempfile.TemporaryDirectory()
+        certFile = os.path.join(self._tempDir.name, "cert.pem")
+        keyFile = os.path.join(self._tempDir.name, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", \
+        "-subj", "/CN=localhost", "-keyout", keyFile, "-out", certFile], check=True, capture_output=True)
+        return certFile, keyFile
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def _authorised(self, headers):
+        token = headers.get("X-F5-Auth-Token")
+        if token:
+            return self.tokens.get(token, 0) > time.time()
+        expected = "Basic "+base64.b64encode(f'{self.username}:{self.password}'.encode()).decode()
+        if headers.get("Authorization") == expected:
+            #every password authenticated request costs BIG-IP a full authentication
+            self._count("basicAuth")
+            return True
+        return False
+
+    def _login(self, handler, body):
+        if body.get("username") != self.username or body.get("password") != self.password:
+            handler._reply(401, {"code": 401, "message": "Authentication failed."})
+            return
+        self._count("logins")
+        token = base64.b32encode(os.urandom(15)).decode()
+        self.tokens[token] = time.time() + self.tokenTimeout
+        handler._reply(200, {"username": self.username, "loginProviderName": body.get("loginProviderName", \
+        "tmos"), "token": {"token": token, "name": token, "userName": self.username, \
+        "timeout": self.tokenTimeout, "expirationMicros": int(self.tokens[token] * 1000000)}})
+
+    def save_ucs(self, name):
+        """creates UCS 'name' from the base bytes with a few regions changed, returns name"""
+        patches = []
+        for _ in range(4):
+            size = max(1, self.changeBytes // 4)
+            offset = random.randrange(0, max(1, self.ucsSize - size))
+            patches.append((offset, os.urandom(min(size, self.ucsSize))))
+        with self._lock:
+            self.ucs[name] = {"created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), \
+            "patches": patches, "md5": None}
+        return name
+
+    def change_config(self, path="/config/bigip.conf", text=None):
+        """appends 'text' (default a new pool) to running config file 'path'"""
+        with self._lock:
+            text = text or f'ltm pool /Common/pool_{time.time_ns()} {{ }}\n'
+            self.runningConfig[path] = self.runningConfig.get(path, "") + text
+
+    def _ucs_bytes(self, name, start, end):
+        """returns bytes start-end (inclusive) of UCS 'name'"""
+        data = bytearray(self._base[start:end + 1])
+        for offset, patch in self.ucs[name]["patches"]:
+            low, high = max(start, offset), min(end + 1, offset + len(patch))
+            if low < high:
+                data[low - start:high - start] = patch[low - offset:high - offset]
+        return bytes(data)
+
+    def _ucs_md5(self, name):
+        if self.ucs[name]["md5"] is None:
+            md5 = hashlib.md5()
+            for start in range(0, self.ucsSize, 8 * 1024 * 1024):
+                md5.update(self._ucs_bytes(name, start, min(start + 8 * 1024 * 1024, self.ucsSize) - 1))
+            self.ucs[name]["md5"] = md5.hexdigest()
+        return self.ucs[name]["md5"]
+
+    def _complete_task(self, taskId):
+        time.sleep(self.saveSeconds)
+        task = self.tasks.get(taskId)
+        if task:
+            self.save_ucs(task["name"])
+            task["_taskState"] = "COMPLETED"
+            self.taskCompleted[taskId] = time.perf_counter()
+
+    def _get(self, handler, path, query, body):
+        if path == "/mgmt/tm/sys/global-settings":
+            settings = {"kind": "tm:sys:global-settings:global-settingsstate", "hostname": self.hostname, \
+            "guiSetup": "disabled", "mgmtDhcp": "enabled"}
+            select = query.get("$select", [""])[0]
+            if select:
+                settings = {key: value for key, value in settings.items() if key in select.split(",")}
+            handler._reply(200, settings)
+        elif path == "/mgmt/shared/identified-devices/config/device-info":
+            handler._reply(200, {"kind": "shared:resolver:device-groups:deviceinfostate", \
+            "hostname": self.hostname, "version": "14.1.2.3", "build": "0.0.5", "product": "BIG-IP", \
+            "platform": "Z100", "platformMarketingName": "BIG-IP Virtual Edition", \
+            "failoverState": "active", "managementAddress": self.address.rsplit(":", 1)[0]})
+        elif path == "/mgmt/tm/sys/ucs":
+            items = [{"kind": "tm:sys:ucs:ucsstate", "apiRawValues": {"filename": "/var/local/ucs/"+name, \
+            "file_created_date": ucs["created"], "file_size": f'{self.ucsSize} (in bytes)'}} \
+            for name, ucs in self.ucs.items()]
+            handler._reply(200, {"kind": "tm:sys:ucs:ucscollectionstate", "items": items})
+        elif path.startswith("/mgmt/tm/task/sys/ucs/"):
+            parts = path.split("/")
+            task = self.tasks.get(parts[6])
+            if not task:
+                handler._reply(404, {"code": 404, "message": f'Task not found - ID: {parts[6]}'})
+            else:
+                handler._reply(200, dict(task))
+        elif path.startswith("/mgmt/shared/file-transfer/ucs-downloads/"):
+            self._download(handler, path.split("/")[-1])
+        else:
+            stats = self._stats(path, query)
+            if stats is None:
+                handler._reply(404, {"code": 404, "message": f'URI path {path} not registered'})
+            else:
+                handler._reply(200, stats)
+
+    def _stats(self, path, query):
+        """returns the iControl stats document for 'path', None if not simulated"""
+
+        def nested(link, fields, *children):
+            entries = {key: {"value": value} if isinstance(value, int) else {"description": value} \
+            for key, value in fields.items()}
+            for child in children:
+                entries.update(child)
+            return {"https://localhost/mgmt/tm/"+link: {"nestedStats": {"entries": entries}}}
+
+        def merged(*parts):
+            entries = {}
+            for part in parts:
+                entries.update(part)
+            return entries
+
+        memoryTotal = 16 * 1024 * 1024 * 1024
+        if path == "/mgmt/tm/cm/failover-status":
+            entries = nested("cm/failover-status/0", {"color": "green", "status": "ACTIVE", \
+            "summary": "1/1 active"})
+        elif path == "/mgmt/tm/sys/host-info":
+            entries = nested("sys/host-info/0", {"memoryTotal": memoryTotal, "memoryUsed": \
+            int(memoryTotal * random.uniform(0.2, 0.6)), "activeCpuCount": self.cpus, "cpuCount": self.cpus, \
+            "hostId": "0"})
+        elif path == "/mgmt/tm/sys/cpu/stats":
+            entries = nested("sys/cpu/0/stats", {"hostId": "0"}, nested("sys/cpu/0/cpuInfo/stats", {}, \
+            *[nested(f'sys/cpu/0/cpuInfo/{number}/stats', {"cpuId": number, "fiveMinAvgIdle": \
+            random.randint(50, 99), "oneMinAvgIdle": random.randint(50, 99), "fiveSecAvgIdle": \
+            random.randint(50, 99)}) for number in range(self.cpus)]))
+        elif path == "/mgmt/tm/net/interface/stats":
+            entries = merged(*[nested(f'net/interface/{name}/stats', {"tmName": name, "status": status, \
+            "counters.bitsIn": random.randint(0, 2**40), "counters.bitsOut": random.randint(0, 2**40), \
+            "counters.dropsAll": 0, "counters.errorsAll": 0, "mediaActive": "10000T-FD"}) \
+            for name, status in self.interfaces.items()])
+        elif path == "/mgmt/tm/sys/hardware/stats":
+            index = "sys/hardware/chassis-{}-status-index"
+            entries = merged(nested(index.format("fan")+"/stats", {}, *[nested(index.format("fan")+ \
+            f'/{number}/stats', {"index": number, "fanSpeed": 11000, "status": "up"}) for number in range(1, 5)]), \
+            nested(index.format("power-supply")+"/stats", {}, *[nested(index.format("power-supply")+ \
+            f'/{number}/stats', {"index": number, "status": "up"}) for number in range(1, 3)]), \
+            nested(index.format("temperature")+"/stats", {}, nested(index.format("temperature")+"/1/stats", \
+            {"index": 1, "hiLimit": 53, "location": "Inlet air temp", "temperature": 28})))
+        elif path.startswith("/mgmt/tm/gtm/datacenter/~Common~") and path.endswith("/stats"):
+            name = path[len("/mgmt/tm/gtm/datacenter/~Common~"):-len("/stats")]
+            if name not in self.datacenters:
+                return None
+            entries = nested(f'gtm/datacenter/~Common~{name}/stats', {"status.availabilityState": \
+            self.datacenters[name], "status.enabledState": "enabled", "tmName": "/Common/"+name})
+        elif path in ("/mgmt/tm/gtm/datacenter/stats", "/mgmt/tm/gtm/server/stats"):
+            kind = path.split("/")[4]
+            objects = self.datacenters if kind == "datacenter" else self.gtmServers
+            entries = merged(*[nested(f'gtm/{kind}/~Common~{name}/stats', {"status.availabilityState": status, \
+            "status.enabledState": "enabled", "tmName": "/Common/"+name}) for name, status in objects.items()])
+        elif path.startswith(("/mgmt/tm/gtm/pool/", "/mgmt/tm/gtm/wideip/")) and path.count("/") == 6 \
+        and path.endswith("/stats"):
+            kind, recordType = path.split("/")[4:6]
+            objects = (self.gtmPools if kind == "pool" else self.wideIps) if recordType == "a" else {}
+            entries = merged(*[nested(f'gtm/{kind}/{recordType}/~Common~{name}:{recordType.upper()}/stats', \
+            {"status.availabilityState": status, "status.enabledState": "enabled", "tmName": "/Common/"+name}) \
+            for name, status in objects.items()])
+        else:
+            return None
+        #$select keeps only the named stats of each top level object
+        select = query.get("$select", [""])[0]
+        if select:
+            for value in entries.values():
+                value["nestedStats"]["entries"] = {key: stat for key, stat in value["nestedStats"]["entries"].items() \
+                if key in select.split(",")}
+        document = {"kind": "tm:"+path[len("/mgmt/tm/"):].replace("/", ":")+"state", "selfLink": \
+        "https://localhost"+path+"?ver=14.1.2.3", "entries": entries}
+        #$top/$skip return one page of the objects, with a link to the next
+        if "$top" in query:
+            top, skip = int(query["$top"][0]), int(query.get("$skip", ["0"])[0])
+            document["entries"] = dict(list(entries.items())[skip:skip + top])
+            document.update({"totalItems": len(entries), "currentItemCount": len(document["entries"]), \
+            "itemsPerPage": top, "startIndex": skip + 1})
+            if skip + top < len(entries):
+                document["nextLink"] = "https://localhost"+path+"?"+"&".join([f'$select={select}'] * bool(select) \
+                + [f'$top={top}', f'$skip={skip + top}', "ver=14.1.2.3"])
+        return document
+
+    def _download(self, handler, name):
+        if name not in self.ucs:
+            handler._reply(404, {"code": 404, "message": f'{name} not found'})
+            return
+        try:
+            byteRange, total = handler.headers["Content-Range"].split("/")
+            start, end = (int(value) for value in byteRange.split("-"))
+        except (AttributeError, ValueError):
+            handler._reply(400, {"code": 400, "message": "Content-Range header required"})
+            return
+        #a total of 0 is the client's size probe, answered with as much of the
+        #range as the file has. BIG-IP rejects any other range ending beyond
+        #the file, clients must clamp the last range
+        if total == "0" and start < self.ucsSize:
+            end = min(end, self.ucsSize - 1)
+        if end >= self.ucsSize or start > end:
+            handler._reply(400, {"code": 400, "message": f'Content-Range {start}-{end} outside file ' \
+            f'of size {self.ucsSize}'})
+            return
+        data = self._ucs_bytes(name, start, end)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/octet-stream")
+        handler.send_header("Content-Range", f'{start}-{end}/{self.ucsSize}')
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler._send_body(data)
+
+    def _post(self, handler, path, query, body):
+        if path == "/mgmt/shared/authn/login":
+            self._login(handler, body)
+        elif path == "/mgmt/tm/sys/ucs" and body.get("command") == "save":
+            time.sleep(self.saveSeconds)
+            self.save_ucs(body["name"])
+            handler._reply(200, {"kind": "tm:sys:ucs:runstate", "command": "save", "name": body["name"]})
+        elif path == "/mgmt/tm/task/sys/ucs" and body.get("command") == "save":
+            taskId = str(next(self._taskIds))
+            self.tasks[taskId] = {"_taskId": taskId, "_taskState": "CREATED", "command": "save", \
+            "name": body["name"]}
+            handler._reply(200, dict(self.tasks[taskId]))
+        elif path == "/mgmt/tm/util/bash":
+            handler._reply(200, {"kind": "tm:util:bash:runstate", "command": "run", \
+            "utilCmdArgs": body.get("utilCmdArgs", ""), "commandResult": self._bash(body.get("utilCmdArgs", ""))})
+        else:
+            handler._reply(404, {"code": 404, "message": f'URI path {path} not registered'})
+
+    def _bash(self, args):
+        if "md5sum /var/local/ucs/" in args:
+            name = args.split("/var/local/ucs/")[1].strip("' ")
+            if name not in self.ucs:
+                return f'md5sum: /var/local/ucs/{name}: No such file or directory\n'
+            return f'{self._ucs_md5(name)}  /var/local/ucs/{name}\n'
+        if "f5mku -K" in args:
+            return self.masterKey+"\n"
+        output = ""
+        if "tmsh save sys config" in args:
+            with self._lock:
+                self.config = dict(self.runningConfig)
+        if "tail -v -n +1 " in args:
+            for path in args.split("tail -v -n +1 ")[1].strip("' ").split():
+                if path in self.config:
+                    output += f'==> {path} <==\n{self.config[path]}\n'
+                else:
+                    output += f"tail: cannot open '{path}' for reading: No such file or directory\n"
+        return output
+
+    def _put(self, handler, path, query, body):
+        parts = path.split("/")
+        if path.startswith("/mgmt/tm/task/sys/ucs/") and len(parts) == 7 and parts[6] in self.tasks \
+        and body.get("_taskState") == "VALIDATING":
+            self.tasks[parts[6]]["_taskState"] = "VALIDATING"
+            threading.Thread(target=self._complete_task, args=(parts[6],), daemon=True).start()
+            handler._reply(202, {"_taskId": parts[6], "message": "Task will execute asynchronously."})
+        else:
+            handler._reply(404, {"code": 404, "message": f'URI path {path} not registered'})
+
+    def _delete(self, handler, path, query, body):
+        parts = path.split("/")
+        if path.startswith("/mgmt/tm/sys/ucs/"):
+            if self.ucs.pop(parts[-1], None) is None:
+                handler._reply(404, {"code": 404, "message": f'{parts[-1]} not found'})
+            else:
+                handler._reply(200)
+        elif path.startswith("/mgmt/tm/task/sys/ucs/"):
+            if len(parts) == 7 and self.tasks.pop(parts[6], None) is not None:
+                handler._reply(200)
+            elif len(parts) == 8 and parts[6] in self.tasks:
+                handler._reply(200)
+            else:
+                handler._reply(404, {"code": 404, "message": f'Task not found - ID: {parts[6]}'})
+        else:
+            handler._reply(404, {"code": 404, "message": f'URI path {path} not registered'})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated BIG-IP iControl REST API for F5Archive")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--hostname", default="bigip1.simulator.local")
+    parser.add_argument("--ucs-size", type=float, default=64, help="UCS size in MB")
+    parser.add_argument("--save-seconds", type=float, default=2)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s shared by all responses, 0 unlimited")
+    parser.add_argument("--failure-rate", type=float, default=0, help="probability of an HTTP 503")
+    parser.add_argument("--drop-rate", type=float, default=0, help="probability of a dropped response")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+    simulator = F5Simulator(args.port, args.hostname, ucsSize=int(args.ucs_size * 1024 * 1024), \
+    saveSeconds=args.save_seconds, latency=args.latency, bandwidth=args.bandwidth * 1024 * 1024 or None, \
+    failureRate=args.failure_rate, dropRate=args.drop_rate, certFile=args.cert, keyFile=args.key)
+    with simulator:
+        print(f'F5 simulator on https://{simulator.address} (admin/admin), Ctrl+C to stop')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
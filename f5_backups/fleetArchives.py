@@ -0,0 +1,186 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Pipelined UCS backups for a fleet of F5 devices using the F5Archive class.
+
+Each device passes through the stages generate -> download -> checksum ->
+delta -> cleanup -> masterkey (delta only does work when deltaFullEvery is
+set, masterkey when masterKeys is True). Every
+stage has its own bounded pool of worker threads and a device moves to the
+next stage's pool as soon as its current stage completes, so the stages
+overlap across the fleet, ie UCS generation on device B runs while the UCS
+from device A is downloading. Slow on-box saves no longer hold up downloads
+and vice versa.
+
+A failure at any stage stops the pipeline for that device only.
+"""
+import sys, os, time, logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from f5Archive import F5Archive
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from masterKeyring import MasterKeyring
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#order of the pipeline stages
+STAGES = ("generate", "download", "checksum", "delta", "cleanup", "masterkey")
+#default number of devices allowed in each stage at once
+STAGE_WORKERS = {"generate": 16, "download": 4, "checksum": 16, "delta": 2, "cleanup": 16, "masterkey": 16}
+
+
+def _run_stage(archive, stage, device, ucsName, options):
+    """
+    Runs a single pipeline stage for one device, in a stage pool thread
+
+    Returns:
+    tuple of (ok boolean, status string from the F5Archive method, seconds taken)
+    """
+
+    startTime = time.perf_counter()
+    if stage == "generate":
+        status = archive.generate_ucs(device.get("isLarge", False))
+        ok = status.endswith("seconds")
+    elif stage == "download":
+        status = archive.download_ucs(ucsName, options["chunkSize"], options["downloadWorkers"], \
+        options["hashes"], options["adaptiveChunks"])
+        ok = status.endswith("UCSSUCCESS")
+    elif stage == "checksum":
+        status = archive.get_ucs_checksums(ucsName)
+        ok = status.startswith("Remote")
+    elif stage == "delta":
+        if options["deltaFullEvery"] is None:
+            status = "delta not enabled"
+        else:
+            status = archive.store_ucs_delta(ucsName, options["deltaFullEvery"])
+        ok = not status.startswith("ERROR")
+    elif stage == "cleanup":
+        status = archive.cleanup_ucs(options["deleteOlder"])
+        ok = not status.startswith("ERROR")
+    else:
+        #every device shares the keyring, which serialises the writes
+        status = archive.get_f5mk() if options["masterKeys"] else "masterkey not enabled"
+        ok = not status.startswith("ERROR")
+    return ok, status, time.perf_counter() - startTime
+
+
+def fleet_backup(inventory, stageWorkers=None, deleteOlder=7, downloadWorkers=1, \
+chunkSize=(512 * 1024), hashes=("md5",), deltaFullEvery=None, adaptiveChunks=False, ucsDir=None, catalog=None, \
+encryptKey=None, masterKeys=False, keyring=None, deviceCache=None):
+    """
+    Backs up every device in 'inventory' as a pipeline of bounded stages
+
+    Functionality:
+    -Creates one F5Archive (and so one pooled session) per device
+    -Submits every device to the generate stage pool. Whenever a stage
+    completes for a device, its result is recorded and, if successful, the
+    device is submitted to the next stage pool
+    -Closes each device's F5Archive once its pipeline ends
+
+    Parameters:
+    inventory - list of dictionaries, one per device, with keys 'host',
+    'username', 'password' and optionally 'isLarge' (see generate_ucs)
+    stageWorkers - dictionary of stage name:max concurrent devices, missing
+    stages use STAGE_WORKERS
+    deleteOlder - integer, days passed to cleanup_ucs, default=7
+    downloadWorkers - integer, concurrent range requests per download, default=1
+    chunkSize - integer, download range size in bytes, default=(512 * 1024)
+    hashes - tuple of hashlib algorithms computed during download, default=("md5",)
+    deltaFullEvery - integer, if set each verified UCS is stored as a delta of
+    the previous UCS from the same device, with a full base kept every
+    'deltaFullEvery' days (see F5Archive.store_ucs_delta). Default=None, full UCS'
+    adaptiveChunks - boolean, tune each device's download range size to its
+    link, remembered between runs (see F5Archive.download_ucs). Default=False
+    ucsDir - string, local directory for the UCS', default is the F5Archive default
+    catalog - BackupCatalog the UCS' are recorded in, default is the F5Archive default
+    encryptKey - 32 byte key to store the UCS' encrypted as they download (see
+    F5Archive.download_ucs), default None stores them unencrypted
+    masterKeys - boolean, record each device's masterkey in the keyring, default=False
+    keyring - MasterKeyring shared by every device, default is the F5Archive default
+    deviceCache - DeviceCache the hostnames are read from, default is the
+    F5Archive default
+
+    Returns:
+    dictionary keyed by device host. Each value is a dictionary with:
+    -'state' - 'done' or 'failed'
+    -'ucs' - name of the UCS created, empty if generate failed
+    -'stages' - dictionary of stage name:{'ok', 'status', 'seconds'} for each
+    stage run
+    -'error' - status string of the failed stage, empty if none
+    -'seconds' - total time from first stage start to pipeline end
+    """
+
+    workers = dict(STAGE_WORKERS, **(stageWorkers or {}))
+    options = {"deleteOlder": deleteOlder, "downloadWorkers": downloadWorkers, \
+    "chunkSize": chunkSize, "hashes": hashes, "deltaFullEvery": deltaFullEvery, \
+    "adaptiveChunks": adaptiveChunks, "masterKeys": masterKeys}
+    pools = {stage: ThreadPoolExecutor(max_workers=workers[stage], thread_name_prefix=stage) \
+    for stage in STAGES}
+    results, archives, started, futures = {}, {}, {}, {}
+    if masterKeys and keyring is None:
+        keyring = MasterKeyring()
+    fleetStart = time.perf_counter()
+
+    try:
+        for device in inventory:
+            host = device["host"]
+            #pool must hold the parallel download ranges plus the remote md5sum call
+            archives[host] = F5Archive(host, device["username"], device["password"], \
+            poolSize=max(10, downloadWorkers + 1), catalog=catalog, ucsDir=ucsDir, encryptKey=encryptKey, \
+            keyring=keyring, deviceCache=deviceCache)
+            results[host] = {"state": "generate", "ucs": "", "stages": {}, "error": "", "seconds": 0}
+            started[host] = time.perf_counter()
+            futures[pools["generate"].submit(_run_stage, archives[host], "generate", device, \
+            "", options)] = (device, "generate")
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                device, stage = futures.pop(future)
+                host = device["host"]
+                result = results[host]
+                try:
+                    ok, status, seconds = future.result()
+                except Exception as e:
+                    #unexpected error (eg local disk) must not stop the rest of the fleet
+                    ok, status, seconds = False, f'ERROR {stage} raised {e!r}', 0
+                result["stages"][stage] = {"ok": ok, "status": status, "seconds": seconds}
+                logging.debug(f'DEBUG {host} {stage} ok={ok} {status}')
+                if ok and stage == "generate":
+                    result["ucs"] = status.split()[0]
+                nextStage = STAGES.index(stage) + 1
+                if ok and nextStage < len(STAGES):
+                    result["state"] = STAGES[nextStage]
+                    futures[pools[STAGES[nextStage]].submit(_run_stage, archives[host], \
+                    STAGES[nextStage], device, result["ucs"], options)] = (device, STAGES[nextStage])
+                    continue
+                #pipeline has ended for this device
+                result["state"] = "done" if ok else "failed"
+                result["error"] = "" if ok else status
+                result["seconds"] = time.perf_counter() - started[host]
+                archives[host].close()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+        for archive in archives.values():
+            archive.close()
+
+    logging.debug(f'DEBUG fleet backup of {len(inventory)} devices took ' \
+    f'{time.perf_counter() - fleetStart:0.4f} seconds')
+    return results
+
+
+def fleet_backup_summary(results):
+    """
+    Formats the dictionary returned by fleet_backup into a plain text summary,
+    one line per device, failed devices listed first. Usable as an email body.
+    """
+
+    lines = []
+    for host, result in sorted(results.items(), key=lambda r: (r[1]["state"] == "done", r[0])):
+        if result["state"] == "done":
+            lines.append(f'OK     {host} {result["ucs"]} in {result["seconds"]:0.1f} seconds')
+        else:
+            lines.append(f'FAILED {host} {result["error"]}')
+    return "\n".join(lines)
@@ -0,0 +1,154 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Polls iControl REST asynchronous tasks, eg /mgmt/tm/task/sys/ucs/<taskId>,
+until they finish.
+
+A single TaskPoller thread watches every outstanding task, across any number
+of devices, from a heap ordered by next poll time, and hands each due poll to
+a small pool of workers, so one slow device's status GET does not delay the
+polls of the others. Each task is polled with exponential backoff and jitter,
+so quick saves are seen quickly while slow boxes are not flooded with GETs,
+and has a hard deadline so a task stuck in a non-COMPLETED state cannot be
+polled forever. Any unexpected error polling a task resolves that task's
+future with an error, so no caller is left waiting and the poller keeps
+running.
+
+Usage:
+future = TaskPoller.shared().watch(session, taskUrl, deadline=1800)
+taskJson, error = future.result()
+"""
+import requests, json, time, random, heapq, threading, itertools, logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+
+class TaskPoller:
+    """
+    This class polls iControl asynchronous tasks from one background thread.
+
+    Methods:
+    - watch - adds a task to be polled, returns a concurrent.futures.Future
+        resolved with a tuple of (last task JSON dict, error string). The
+        error string is empty if the task reached a done state.
+    - shared - class method returning a poller shared by the whole process
+
+    Instance Attributes:
+    -self.initialDelay - seconds before the first poll of a new task
+    -self.maxDelay - largest delay in seconds between polls of one task
+    -self.factor - multiplier applied to the delay after every poll
+    -self.jitter - fraction (0-1) of each delay randomly removed, so tasks
+        started together do not poll in lock step
+    -self.timeout - requests timeout in seconds for each status GET
+    -self.workers - status GETs made at once, so one unresponsive device
+        cannot stall the polling of the others
+    """
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self, initialDelay=0.5, maxDelay=15, factor=2, jitter=0.5, timeout=10, workers=8):
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.workers = workers
+        #heap of (next poll time, sequence, task dict)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    @classmethod
+    def shared(cls):
+        """returns the process wide poller, creating it on first use"""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def watch(self, session, url, deadline=1800, doneStates=("COMPLETED",), failStates=("FAILED",)):
+        """
+        Adds an asynchronous task to be polled
+
+        Parameters:
+        session - requests Session (with auth) used for the status GETs
+        url - string, the task URL, eg https://<F5>/mgmt/tm/task/sys/ucs/<taskId>
+        deadline - seconds from now after which the task is given up on
+        doneStates - tuple of '_taskState' values meaning success
+        failStates - tuple of '_taskState' values meaning the task failed
+
+        Returns:
+        concurrent.futures.Future, result is a tuple of (task JSON dict, error string)
+        """
+
+        future = Future()
+        now = time.monotonic()
+        task = {"session": session, "url": url, "deadline": now + deadline, "attempt": 0, \
+        "doneStates": doneStates, "failStates": failStates, "future": future}
+        self._schedule(now + self.initialDelay, task)
+        return future
+
+    def _schedule(self, when, task):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), task))
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="TaskPoll")
+                self._thread = threading.Thread(target=self._run, name="TaskPoller", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        #wait for the earliest due task, hand its poll to a worker, repeat
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                due = self._heap[0][0] - time.monotonic()
+                if due > 0:
+                    self._condition.wait(due)
+                    continue
+                task = heapq.heappop(self._heap)[2]
+            self._pool.submit(self._safe_poll, task)
+
+    def _safe_poll(self, task):
+        """polls 'task', resolving its future with an error on any unexpected exception"""
+        try:
+            self._poll(task)
+        except Exception as e:
+            #eg a status response which is not a JSON object
+            logging.debug(f'DEBUG task {task["url"]} poll raised {e!r}')
+            if not task["future"].done():
+                task["future"].set_result(({}, f'ERROR TASK poll failed: {e!r}'))
+
+    def _poll(self, task):
+        """makes a single status GET for 'task' and resolves or reschedules it"""
+        future = task["future"]
+        try:
+            resp = task["session"].get(task["url"], timeout=self.timeout)
+            resp.raise_for_status()
+            taskJson = json.loads(resp.text)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.debug(f'DEBUG GET task status failed error: {e}')
+            future.set_result(({}, f'ERROR TASK GET status call failed: {e}'))
+            return
+
+        state = taskJson.get("_taskState", "")
+        logging.debug(f'DEBUG task {task["url"]} state {state} attempt {task["attempt"]}')
+        now = time.monotonic()
+        if state in task["doneStates"]:
+            future.set_result((taskJson, ""))
+        elif state in task["failStates"]:
+            future.set_result((taskJson, f'ERROR TASK state {state}'))
+        elif now >= task["deadline"]:
+            future.set_result((taskJson, f'ERROR TASK deadline exceeded, last state {state}'))
+        else:
+            task["attempt"] += 1
+            delay = min(self.maxDelay, self.initialDelay * self.factor ** task["attempt"])
+            delay *= 1 - self.jitter * random.random()
+            self._schedule(min(now + delay, task["deadline"]), task)
@@ -0,0 +1,128 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Binary delta encoding of a file against a base file, used by F5Archive to
+store successive UCS archives from the same F5 as deltas.
+
+Both files are split into content defined chunks (see backup_store/dedupStore.py).
+Chunks of the new file also found in the base are written as copy records
+(offset and length in the base), all other chunks as zlib compressed literal
+records.
+
+Delta file format:
+-line 1: b"UCSDELTA1"
+-line 2: JSON header, eg {"base": <base ucs name>, "size": ..., "md5": ...}
+-records until EOF:
+    b"C" + 8 byte base offset + 4 byte length
+    b"L" + 4 byte compressed length + compressed bytes
+"""
+import sys, os, json, struct, zlib, hashlib
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from dedupStore import content_chunks
+
+MAGIC = b"UCSDELTA1\n"
+#largest copy record length, merged copies of an unchanged multi GB UCS are
+#split into records of at most this many bytes
+MAX_COPY = 0xFFFFFFFF
+#bytes of a copy record read from the base at once
+COPY_BLOCK = 8 * 1024 * 1024
+
+
+def write_delta(basePath, newPath, deltaPath, header):
+    """
+    Writes the delta of file 'newPath' against file 'basePath' to 'deltaPath'
+
+    Parameters:
+    basePath - string, base file path
+    newPath - string, new file path
+    deltaPath - string, delta file to write
+    header - dictionary stored as the delta header, eg base name and digests
+
+    Returns:
+    tuple of (bytes copied from base, literal bytes stored)
+    """
+
+    #index every chunk of the base by sha256
+    baseIndex = {}
+    offset = 0
+    with open(basePath, 'rb') as base:
+        for chunk in content_chunks(base):
+            baseIndex.setdefault(hashlib.sha256(chunk).digest(), (offset, len(chunk)))
+            offset += len(chunk)
+
+    copied, literal = 0, 0
+    pendingCopy = None
+    with open(newPath, 'rb') as new, open(deltaPath, 'wb') as delta:
+        delta.write(MAGIC)
+        delta.write(json.dumps(header).encode()+b"\n")
+        for chunk in content_chunks(new):
+            match = baseIndex.get(hashlib.sha256(chunk).digest())
+            if match:
+                copied += match[1]
+                #merge copies of adjacent base chunks into one record
+                if pendingCopy and pendingCopy[0] + pendingCopy[1] == match[0] \
+                and pendingCopy[1] + match[1] <= MAX_COPY:
+                    pendingCopy = (pendingCopy[0], pendingCopy[1] + match[1])
+                    continue
+                if pendingCopy:
+                    delta.write(b"C"+struct.pack(">QI", *pendingCopy))
+                pendingCopy = match
+                continue
+            if pendingCopy:
+                delta.write(b"C"+struct.pack(">QI", *pendingCopy))
+                pendingCopy = None
+            compressed = zlib.compress(chunk)
+            delta.write(b"L"+struct.pack(">I", len(compressed))+compressed)
+            literal += len(chunk)
+        if pendingCopy:
+            delta.write(b"C"+struct.pack(">QI", *pendingCopy))
+    return copied, literal
+
+
+def read_delta_header(deltaPath):
+    """returns the JSON header dictionary of delta file 'deltaPath'"""
+    with open(deltaPath, 'rb') as delta:
+        if delta.readline() != MAGIC:
+            raise ValueError(f'{deltaPath} is not a UCS delta file')
+        return json.loads(delta.readline())
+
+
+def apply_delta(basePath, deltaPath, outPath):
+    """
+    Rebuilds the new file from 'basePath' and 'deltaPath' into 'outPath'
+
+    Returns:
+    dictionary of md5 and sha256 hexdigests of the rebuilt file
+    """
+
+    hashes = {"md5": hashlib.md5(), "sha256": hashlib.sha256()}
+    with open(basePath, 'rb') as base, open(deltaPath, 'rb') as delta, open(outPath, 'wb') as out:
+        if delta.readline() != MAGIC:
+            raise ValueError(f'{deltaPath} is not a UCS delta file')
+        delta.readline()
+        while True:
+            recordType = delta.read(1)
+            if not recordType:
+                break
+            if recordType == b"C":
+                offset, length = struct.unpack(">QI", delta.read(12))
+                base.seek(offset)
+                #a copy can be GBs, so it is streamed in blocks
+                while length:
+                    data = base.read(min(length, COPY_BLOCK))
+                    if not data:
+                        raise ValueError(f'{deltaPath} copy past the end of {basePath}')
+                    length -= len(data)
+                    out.write(data)
+                    for h in hashes.values():
+                        h.update(data)
+                continue
+            elif recordType == b"L":
+                length, = struct.unpack(">I", delta.read(4))
+                data = zlib.decompress(delta.read(length))
+            else:
+                raise ValueError(f'{deltaPath} corrupt record type {recordType!r}')
+            out.write(data)
+            for h in hashes.values():
+                h.update(data)
+    return {name: h.hexdigest() for name, h in hashes.items()}
@@ -0,0 +1,151 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Token based iControl REST authentication shared by the F5 scripts.
+
+With HTTP basic auth BIG-IP runs a full (remote or PAM) authentication for
+every request, which is slow and loads the management plane when many
+requests are made, eg chunked UCS downloads or daily checks across a fleet.
+F5TokenAuth instead gets an X-F5-Auth-Token once from /mgmt/shared/authn/login
+and sends it with every request. Tokens are cached per device and credentials
+for the whole process, so every script, session and thread talking to the
+same F5 shares one token, until shortly before it expires. A 401 response
+(eg token deleted on box) gets a new token and the request is sent again
+once.
+
+If the login endpoint itself fails (not a 401), eg on versions without it,
+requests to that device fall back to basic auth for FALLBACK_SECONDS.
+
+Usage:
+session.auth = F5TokenAuth(host, username, password)
+or per request: requests.get(url, auth=F5TokenAuth(host, username, password), verify=False)
+"""
+import requests, json, time, threading, hashlib, logging
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#a token is replaced this many seconds before BIG-IP would expire it
+EXPIRY_MARGIN = 60
+#seconds basic auth is used after a failed login before login is tried again
+FALLBACK_SECONDS = 300
+LOGIN_TIMEOUT = (10, 30)
+
+#(host, username, password digest):{"token", "expires"} shared by every
+#F5TokenAuth in the process. The password digest is part of the key so a
+#caller with the wrong password never gets another caller's token
+_tokens = {}
+_tokensLock = threading.Lock()
+#one lock per key so concurrent requests wait for a single login
+_loginLocks = {}
+
+
+def invalidate(host, username=None):
+    """drops cached tokens for 'host' (all usernames if None), eg after a password change"""
+    with _tokensLock:
+        for key in [key for key in _tokens if key[0] == host and username in (None, key[1])]:
+            del _tokens[key]
+
+
+class F5TokenAuth(requests.auth.AuthBase):
+    """
+    This class is a requests auth handler sending a cached X-F5-Auth-Token.
+
+    Methods:
+    - token - returns the cached token for the device, logging in if there
+        is none, it is near expiry or was rejected. Empty string while falling
+        back to basic auth.
+
+    Instance Attributes:
+    -self.host - F5 management IP or hostname, optionally with :port
+    -self.username, self.password - credentials used to log in
+    -self.loginProvider - BIG-IP login provider name, 'tmos' for local and
+        the default remote provider
+    -self.verify - TLS verification for the login request, as requests 'verify'
+    -self.timeout - (connect, read) seconds for the login request
+    """
+
+    def __init__(self, host, username, password, loginProvider="tmos", verify=False, timeout=LOGIN_TIMEOUT):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.loginProvider = loginProvider
+        self.verify = verify
+        self.timeout = timeout
+        self._basic = requests.auth.HTTPBasicAuth(username, password)
+
+    def _key(self):
+        return (self.host, self.username, hashlib.sha256(self.password.encode()).hexdigest())
+
+    def token(self, stale=None):
+        """
+        returns a valid token for self.host, logging in if there is none, it
+        is near expiry or it is 'stale' (rejected with a 401). Concurrent
+        callers with the same stale token share one new login.
+        """
+        key = self._key()
+        with _tokensLock:
+            lock = _loginLocks.setdefault(key, threading.Lock())
+        with lock:
+            with _tokensLock:
+                cached = _tokens.get(key)
+            if cached and cached["expires"] > time.time() and (not stale or cached["token"] != stale):
+                return cached["token"]
+            cached = self._login()
+            with _tokensLock:
+                _tokens[key] = cached
+            return cached["token"]
+
+    def _login(self):
+        """
+        POSTs the credentials to /mgmt/shared/authn/login
+
+        Returns:
+        dictionary with 'token' and the time it 'expires', token empty if the
+        login failed (basic auth is then used until 'expires')
+        """
+
+        url = "https://"+self.host+"/mgmt/shared/authn/login"
+        payload = {"username": self.username, "password": self.password, \
+        "loginProviderName": self.loginProvider}
+        try:
+            resp = requests.post(url, json=payload, verify=self.verify, timeout=self.timeout)
+            resp.raise_for_status()
+            tokenJson = json.loads(resp.text)["token"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            logging.debug(f'DEBUG token login to {self.host} failed, using basic auth: {e}')
+            return {"token": "", "expires": time.time() + FALLBACK_SECONDS}
+        logging.debug(f'DEBUG new token for {self.username}@{self.host} timeout {tokenJson.get("timeout")}')
+        return {"token": tokenJson["token"], \
+        "expires": time.time() + int(tokenJson.get("timeout", 1200)) - EXPIRY_MARGIN}
+
+    def __call__(self, request):
+        token = self.token()
+        if not token:
+            return self._basic(request)
+        request.headers["X-F5-Auth-Token"] = token
+        request.register_hook("response", self._handle_401)
+        return request
+
+    def _handle_401(self, resp, **kwargs):
+        """on a 401 gets a new token and resends the request once"""
+        if resp.status_code != 401 or getattr(resp.request, "_f5TokenRetried", False):
+            return resp
+        token = self.token(stale=resp.request.headers.get("X-F5-Auth-Token"))
+        #consume the body so the connection can be reused
+        resp.content
+        resp.close()
+        retry = resp.request.copy()
+        retry._f5TokenRetried = True
+        if token:
+            retry.headers["X-F5-Auth-Token"] = token
+        else:
+            retry.headers.pop("X-F5-Auth-Token", None)
+            self._basic(retry)
+        newResp = resp.connection.send(retry, **kwargs)
+        newResp.history.append(resp)
+        newResp.request = retry
+        return newResp
@@ -0,0 +1,196 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+On disk cache of F5 device metadata shared by the F5 scripts.
+
+generate_ucs, f5_daily_checks and ssl_cert_expiry each started by asking
+the device for its hostname, and version, platform and HA role were fetched
+again whenever needed. DeviceCache keeps one row per management IP with the
+hostname, version, platform and HA role, read in a single call to
+/mgmt/shared/identified-devices/config/device-info, and every script reads
+the row while it is younger than the TTL. Orchestrators can also plan from
+the cache, eg list the standby units, without touching the devices.
+
+A row is refreshed once it is older than the TTL (or a caller's stricter
+'maxAge'), and can be dropped explicitly with invalidate() or the
+'invalidate' command, eg after a hostname change or an upgrade. The HA role
+changes on failover without notice, so scripts that read the failover
+status anyway (f5_daily_checks) write it back with update_role().
+
+Like the backup catalog each call opens its own short lived SQLite
+connection, so one DeviceCache can be shared by threads and processes.
+
+Usage:
+python f5DeviceCache.py list
+python f5DeviceCache.py invalidate [host]
+"""
+import sys, os, time, sqlite3, logging
+from f5Stats import loads, parse_failover
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+CACHE_FILE = os.path.join(os.getcwd(), "f5devices.cache.sqlite")
+#seconds a row is used before it is fetched again
+DEVICE_TTL = 24 * 3600
+#(connect, read) seconds for the metadata calls
+REQUEST_TIMEOUT = (5, 30)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    host TEXT PRIMARY KEY,
+    hostname TEXT,
+    version TEXT,
+    build TEXT,
+    platform TEXT,
+    ha_role TEXT,
+    fetched REAL NOT NULL
+);
+"""
+
+
+class DeviceCache:
+    """
+    This class caches the metadata of F5 devices in a SQLite file.
+
+    Methods:
+    - get - the cached row of a device, None if missing or too old
+    - lookup - the cached row, fetched from the device first if needed
+    - hostname - the short hostname of a device, via lookup
+    - update_role - records a HA role read by the caller
+    - invalidate - drops the row of a device, or of every device
+    - devices - the rows of every device, optionally of one HA role
+
+    Rows are dictionaries with keys 'host', 'hostname', 'version', 'build',
+    'platform', 'ha_role' and 'fetched' (unix time).
+
+    Instance Attributes:
+    -self.path - the cache database file
+    -self.ttl - seconds a row is used before it is fetched again
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=DEVICE_TTL):
+        self.path = path
+        self.ttl = ttl
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _execute(self, sql, args=()):
+        db = self._connect()
+        try:
+            with db:
+                return [dict(row) for row in db.execute(sql, args).fetchall()]
+        finally:
+            db.close()
+
+    def get(self, host, maxAge=None):
+        """
+        returns the cached row of 'host', None if there is none or it is older
+        than self.ttl, or 'maxAge' seconds if given
+        """
+        maxAge = self.ttl if maxAge is None else min(maxAge, self.ttl)
+        rows = self._execute("SELECT * FROM devices WHERE host=? AND fetched>=?", (host, time.time() - maxAge))
+        return rows[0] if rows else None
+
+    def lookup(self, host, session, maxAge=None, timeout=REQUEST_TIMEOUT):
+        """
+        Returns the metadata of 'host', from the cache if fresh enough,
+        otherwise fetched from the device and cached
+
+        Parameters:
+        host - string, F5 management IP (optionally :port), the cache key
+        session - authenticated requests.Session used if the device has to
+        be called
+        maxAge - seconds, stricter than self.ttl for this call
+        timeout - (connect, read) seconds for the call
+
+        Exceptions:
+        requests.exceptions.RequestException, ValueError or KeyError if the
+        device has to be called and the call fails, nothing is cached
+
+        Returns:
+        dictionary, the device row
+        """
+
+        row = self.get(host, maxAge)
+        if row:
+            return row
+        row = self._fetch(host, session, timeout)
+        self._execute("""INSERT OR REPLACE INTO devices (host, hostname, version, build, platform, ha_role, fetched)
+        VALUES (:host, :hostname, :version, :build, :platform, :ha_role, :fetched)""", row)
+        logging.debug(f'DEBUG device cache fetched {row}')
+        return row
+
+    def _fetch(self, host, session, timeout):
+        #device-info has everything in one call, older versions only global-settings
+        resp = session.get("https://"+host+"/mgmt/shared/identified-devices/config/device-info", timeout=timeout)
+        if resp.status_code == 404:
+            resp = session.get("https://"+host+"/mgmt/tm/sys/global-settings?$select=hostname", timeout=timeout)
+            resp.raise_for_status()
+            info = {"hostname": loads(resp.text)["hostname"]}
+            failover = session.get("https://"+host+"/mgmt/tm/cm/failover-status", timeout=timeout)
+            if failover.ok:
+                info["failoverState"] = parse_failover(failover.text).status
+        else:
+            resp.raise_for_status()
+            info = loads(resp.text)
+        return {"host": host, "hostname": info["hostname"], "version": info.get("version"), \
+        "build": info.get("build"), "platform": info.get("platformMarketingName") or info.get("platform"), \
+        "ha_role": (info.get("failoverState") or "").lower() or None, "fetched": time.time()}
+
+    def hostname(self, host, session, maxAge=None, timeout=REQUEST_TIMEOUT):
+        """returns the hostname of 'host' without its domain, see lookup for exceptions"""
+        return self.lookup(host, session, maxAge, timeout)["hostname"].split('.')[0]
+
+    def update_role(self, host, role):
+        """records HA 'role' (eg 'active', 'standby') of a cached device, read by the caller"""
+        self._execute("UPDATE devices SET ha_role=? WHERE host=?", (role.lower(), host))
+
+    def invalidate(self, host=None):
+        """drops the row of 'host', or of every device if None, so the next lookup fetches it"""
+        if host is None:
+            self._execute("DELETE FROM devices")
+        else:
+            self._execute("DELETE FROM devices WHERE host=?", (host,))
+
+    def devices(self, haRole=None, maxAge=None):
+        """returns the rows of every device younger than the TTL (or 'maxAge'), optionally only of 'haRole'"""
+        maxAge = self.ttl if maxAge is None else min(maxAge, self.ttl)
+        rows = self._execute("SELECT * FROM devices WHERE fetched>=? ORDER BY host", (time.time() - maxAge,))
+        return [row for row in rows if haRole is None or row["ha_role"] == haRole.lower()]
+
+
+#cache of CACHE_FILE shared by the callers not given one, opened on first use
+_defaultCache = None
+
+
+def default_cache():
+    """
+    returns the DeviceCache of CACHE_FILE shared by every caller in the
+    process, so its schema is set up once rather than on every call
+    """
+    global _defaultCache
+    if _defaultCache is None:
+        _defaultCache = DeviceCache()
+    return _defaultCache
+
+
+if __name__ == "__main__":
+    cache = DeviceCache()
+    if len(sys.argv) == 2 and sys.argv[1] == "list":
+        for row in cache.devices():
+            print(f'{row["host"]} {row["hostname"]} {row["platform"]} v{row["version"]} {row["ha_role"]} ' \
+            f'fetched {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["fetched"]))}')
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "invalidate":
+        cache.invalidate(*sys.argv[2:])
+    else:
+        print(__doc__)
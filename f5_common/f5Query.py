@@ -0,0 +1,115 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Payload minimising iControl REST queries, shared by the F5 scripts.
+
+Each check declares the endpoint it reads and the stats fields it needs as a
+Query. coalesce() merges the queries for the same endpoint into a single
+request whose $select is the union of their fields, so eg memoryTotal and
+memoryUsed are read from host-info in one call, and BIG-IP only sends back
+the selected fields of each object. A query with fields None needs the
+whole document (eg the multi level cpu and hardware stats, which $select
+would strip of their nested objects) and turns $select off for its
+endpoint.
+
+Very large collections (eg GTM servers or wide IPs across a sync group) can
+be read in pages with get_paged(), which follows BIG-IP's $top/$skip
+'nextLink' and returns the pages merged into one document.
+"""
+import json, logging
+from dataclasses import dataclass
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#record types of the GTM pools and wide IPs read by the F5 scripts, eg add "cname", "mx"
+GTM_RECORD_TYPES = ("a", "aaaa")
+
+
+@dataclass
+class Query:
+    __slots__ = ("name", "path", "fields")
+    name: str
+    path: str
+    fields: tuple
+
+
+def select_path(path, fields):
+    """returns 'path' with a $select of 'fields', 'path' unchanged if fields is None"""
+    if fields is None:
+        return path
+    return path+("&" if "?" in path else "?")+"$select="+",".join(fields)
+
+
+def coalesce(queries):
+    """
+    Merges 'queries' reading the same endpoint into one request
+
+    Parameters:
+    queries - iterable of Query
+
+    Returns:
+    dictionary of request path (with the combined $select):list of the
+    names of the queries it answers, in the order the endpoints were first
+    queried
+    """
+
+    endpoints = {}
+    for query in queries:
+        names, fields = endpoints.get(query.path, ([], ()))
+        names.append(query.name)
+        if fields is None or query.fields is None:
+            fields = None
+        else:
+            fields += tuple(field for field in query.fields if field not in fields)
+        endpoints[query.path] = (names, fields)
+    return {select_path(path, fields): names for path, (names, fields) in endpoints.items()}
+
+
+def get_paged(get, path, pageSize):
+    """
+    Reads collection 'path' 'pageSize' objects at a time
+
+    Parameters:
+    get - function taking a request path, returning the response text or a
+    string starting 'ERROR' on failure
+    path - string, request path, may already have a query string
+    pageSize - integer, objects per request ($top)
+
+    Returns:
+    string, the response text if the collection fits in one page, otherwise
+    a document with the 'entries' of every page. The first 'ERROR' string
+    returned by 'get' if any page fails.
+    """
+
+    text = get(path+("&" if "?" in path else "?")+f'$top={pageSize}')
+    #a single page is returned as is, without decoding it here
+    if text.startswith("ERROR") or '"nextLink"' not in text:
+        return text
+    page = json.loads(text)
+    entries = dict(page.get("entries", {}))
+    #follow BIG-IP's link to each next page, relative to the device
+    while page.get("nextLink") and page.get("entries"):
+        text = get("/mgmt/"+page["nextLink"].split("/mgmt/", 1)[1])
+        if text.startswith("ERROR"):
+            return text
+        page = json.loads(text)
+        entries.update(page.get("entries", {}))
+    logging.debug(f'DEBUG {path} read {len(entries)} objects in pages of {pageSize}')
+    return json.dumps({"kind": page.get("kind"), "entries": entries})
+
+
+def stats_session(auth, poolSize=4):
+    """
+    returns a requests.Session for iControl stats calls, authenticated with
+    'auth' and 'poolSize' pooled connections
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize))
+    session.auth = auth
+    session.verify = False
+    session.trust_env = False
+    return session
@@ -0,0 +1,213 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Typed records parsed from iControl REST stats responses, shared by the F5
+scripts (f5_daily_checks and the metrics exporter).
+
+iControl stats documents nest every object under 'entries' keyed by its self
+link, eg 'https://localhost/mgmt/tm/sys/cpu/0/cpuInfo/1/stats', with the
+object's own stats under 'nestedStats' -> 'entries' and each stat either
+{'value': number} or {'description': string}. Rather than walking literal
+self link key chains (which differ between objects and versions), each
+response is decoded once and walked generically: a child entry is named by
+the last segment of its self link and a stat is reduced to its value or
+description. The results are small records with __slots__, so hundreds of
+devices worth of stats hold no decoded JSON documents.
+
+JSON is decoded with orjson if installed (pip install orjson), which is
+several times faster than the json module on large stats documents, and the
+json module otherwise.
+"""
+import json, logging
+from dataclasses import dataclass
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#decoder used for every response, bytes or string
+loads = orjson.loads if orjson else json.loads
+
+
+@dataclass
+class FailoverStatus:
+    __slots__ = ("color", "status", "summary")
+    color: str
+    status: str
+    summary: str
+
+
+@dataclass
+class MemoryStats:
+    __slots__ = ("total", "used")
+    total: int
+    used: int
+
+    @property
+    def percentUsed(self):
+        return round(self.used / (0.01 * self.total))
+
+
+@dataclass
+class CpuStats:
+    __slots__ = ("cpuId", "fiveMinAvgIdle")
+    cpuId: int
+    fiveMinAvgIdle: int
+
+    @property
+    def fiveMinAvgUsed(self):
+        return 100 - self.fiveMinAvgIdle
+
+
+@dataclass
+class InterfaceStats:
+    __slots__ = ("name", "status")
+    name: str
+    status: str
+
+
+@dataclass
+class FanStatus:
+    __slots__ = ("index", "status")
+    index: int
+    status: str
+
+
+@dataclass
+class PsuStatus:
+    __slots__ = ("index", "status")
+    index: int
+    status: str
+
+
+@dataclass
+class Temperature:
+    __slots__ = ("index", "temperature", "hiLimit")
+    index: int
+    temperature: int
+    hiLimit: int
+
+
+@dataclass
+class GtmStatus:
+    __slots__ = ("name", "availability")
+    name: str
+    availability: str
+
+
+def _link_name(selfLink):
+    #'https://localhost/mgmt/tm/sys/cpu/0/cpuInfo/1/stats' -> '1', '~Common~DC1' -> 'DC1'
+    name = selfLink.split("?")[0]
+    if name.endswith("/stats"):
+        name = name[:-len("/stats")]
+    return name.rstrip("/").rsplit("/", 1)[-1].rsplit("~", 1)[-1]
+
+
+def stats_entries(entries):
+    """
+    Splits one level of iControl stats 'entries' into its stats and children
+
+    Parameters:
+    entries - dictionary, the 'entries' of a stats document or nestedStats
+
+    Returns:
+    tuple of (dictionary of stat name:value or description, dictionary of
+    child name:child entries), child names are the last self link segment
+    """
+
+    fields, children = {}, {}
+    for key, value in entries.items():
+        if "nestedStats" in value:
+            children[_link_name(key)] = value["nestedStats"].get("entries", {})
+        elif "value" in value:
+            fields[key] = value["value"]
+        else:
+            fields[key] = value.get("description")
+    return fields, children
+
+
+def _objects(text):
+    #decodes a stats response into (child name, stats fields, children) per object
+    for name, entries in stats_entries(loads(text).get("entries", {}))[1].items():
+        fields, children = stats_entries(entries)
+        yield name, fields, children
+
+
+def _index(name):
+    return int(name) if name.isdigit() else name
+
+
+def parse_failover(text):
+    """returns the FailoverStatus of a /mgmt/tm/cm/failover-status response"""
+    for name, fields, children in _objects(text):
+        return FailoverStatus(fields["color"], fields["status"], fields["summary"])
+    raise ValueError("failover-status response has no entries")
+
+
+def parse_memory(*texts):
+    """
+    returns the MemoryStats of one or more /mgmt/tm/sys/host-info responses,
+    eg one selecting memoryTotal and one memoryUsed
+    """
+    memory = {}
+    for text in texts:
+        for name, fields, children in _objects(text):
+            memory.update(fields)
+    return MemoryStats(int(memory["memoryTotal"]), int(memory["memoryUsed"]))
+
+
+def parse_cpu(text):
+    """returns a list of CpuStats, one per CPU, from a /mgmt/tm/sys/cpu/stats response"""
+    cpus = []
+    for name, fields, children in _objects(text):
+        cpuInfo = stats_entries(children.get("cpuInfo", {}))[1]
+        for cpuName, entries in cpuInfo.items():
+            cpuFields = stats_entries(entries)[0]
+            cpus.append(CpuStats(int(cpuFields.get("cpuId", _index(cpuName))), int(cpuFields["fiveMinAvgIdle"])))
+    return sorted(cpus, key=lambda cpu: cpu.cpuId)
+
+
+def parse_interfaces(text):
+    """returns a list of InterfaceStats from a /mgmt/tm/net/interface/stats response"""
+    return [InterfaceStats(fields["tmName"], fields["status"]) for name, fields, children in _objects(text)]
+
+
+def parse_hardware(text):
+    """
+    returns a tuple of (list of FanStatus, list of PsuStatus, list of
+    Temperature) from a /mgmt/tm/sys/hardware/stats response, decoded once
+    """
+    fans, psus, temperatures = [], [], []
+    for name, fields, children in _objects(text):
+        for index, entries in children.items():
+            stats = stats_entries(entries)[0]
+            if name == "chassis-fan-status-index":
+                fans.append(FanStatus(_index(index), stats["status"]))
+            elif name == "chassis-power-supply-status-index":
+                psus.append(PsuStatus(_index(index), stats["status"]))
+            elif name == "chassis-temperature-status-index":
+                temperatures.append(Temperature(_index(index), int(stats["temperature"]), int(stats["hiLimit"])))
+    key = lambda record: str(record.index).zfill(8)
+    return sorted(fans, key=key), sorted(psus, key=key), sorted(temperatures, key=key)
+
+
+def _gtm_name(name, fields):
+    #tmName '/Common/www.example.com' if selected, else the self link name
+    #without the record type of pools and wide IPs, eg 'www.example.com:A'
+    if fields.get("tmName"):
+        return fields["tmName"].rsplit("/", 1)[-1]
+    return name.rsplit(":", 1)[0] if name.rsplit(":", 1)[-1].isupper() else name
+
+
+def parse_gtm(text):
+    """
+    returns a list of GtmStatus from a GTM stats response, either one object
+    (eg /mgmt/tm/gtm/datacenter/~Common~DC1/stats) or a collection (eg
+    /mgmt/tm/gtm/server/stats or /mgmt/tm/gtm/wideip/a/stats)
+    """
+    return [GtmStatus(_gtm_name(name, fields), fields["status.availabilityState"]) \
+    for name, fields, children in _objects(text)]
@@ -1,13 +1,53 @@
-import requests, json, re, datetime, logging
-  
-def f5_daily_checks(host, username, password):
+import requests, datetime, logging, sys, os, time, sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_common"))
+from f5Auth import F5TokenAuth
+from f5Stats import parse_failover, parse_memory, parse_cpu, parse_interfaces, parse_hardware, parse_gtm
+from f5Query import Query, coalesce, stats_session, get_paged, GTM_RECORD_TYPES
+from f5DeviceCache import default_cache
+
+#GTM collections are read this many objects per call
+GTM_PAGE_SIZE = 500
+#data read by f5_daily_checks, each with the fields it needs (None for the
+#whole document). Queries of the same endpoint are merged into one call
+CHECK_QUERIES = (
+    Query("health", "/mgmt/tm/cm/failover-status", None),
+    Query("memTotal", "/mgmt/tm/sys/host-info", ("memoryTotal",)),
+    Query("memUsed", "/mgmt/tm/sys/host-info", ("memoryUsed",)),
+    #cpu and hardware stats nest their objects, which $select would drop
+    Query("cpu", "/mgmt/tm/sys/cpu/stats", None),
+    Query("interface", "/mgmt/tm/net/interface/stats", ("tmName", "status")),
+    Query("hardware", "/mgmt/tm/sys/hardware/stats", None),
+    #GTM objects are discovered from their collections, one call per kind
+    #(and record type) however many objects there are
+    Query("gtmDatacenters", "/mgmt/tm/gtm/datacenter/stats", ("tmName", "status.availabilityState")),
+    Query("gtmServers", "/mgmt/tm/gtm/server/stats", ("tmName", "status.availabilityState")),
+) + tuple(Query(f'gtm{kind.capitalize()}s:{recordType}', f'/mgmt/tm/gtm/{kind}/{recordType}/stats', \
+("tmName", "status.availabilityState")) for kind in ("pool", "wideip") for recordType in GTM_RECORD_TYPES)
+#default number of calls in flight to one device
+MAX_PARALLEL = 4
+#(connect, read) seconds for each call
+REQUEST_TIMEOUT = (5, 30)
+#response of a call not answered before the device deadline
+TIMED_OUT = "ERROR TIMEOUT"
+
+def _section_error(section, *responses):
+    #report line for a section whose calls failed or timed out
+    if any(response.startswith(TIMED_OUT) for response in responses):
+        return f"\nTimed out getting {section}"
+    return f"\nError getting {section}"
+
+def f5_daily_checks(host, username, password, maxParallel=MAX_PARALLEL, latencies=None, \
+timeout=REQUEST_TIMEOUT, deadline=None, limiter=None, deviceCache=None):
     '''
     Uses iControl API to query various device stats to be used as part of
     daily network device checks. Designed to be used on hardware running v12.x -
     v14.x. Returns formatted string for use in body of email.
 
     Functionality:
-    -gets hostname
+    -gets hostname from the shared device cache, only calling the F5 if the
+    cached entry has expired. The HA role read with the health status is
+    written back to the cache
     -collects health status, active, online
     -collects current memory usage (TMM)
     -collects latest 5 min avergae CPU usage for all cpu's
@@ -16,15 +56,48 @@ def f5_daily_checks(host, username, password):
     -collects temp or F5 chassis
     -collects GTM/DNS DC status (ie available/unavailable)
     -collects GTM/DNS server object status (ie available/unavailable)
+    -collects GTM/DNS pool and wide IP status for GTM_RECORD_TYPES
+
+    CHECK_QUERIES are merged into one call per endpoint, selecting only the
+    fields the checks use (see f5_common/f5Query.py). Every call is issued concurrently, at most
+    'maxParallel' at a time over one pooled session, so the checks of a
+    device take about as long as the slowest call rather than the sum of
+    them. The result string is assembled once every response has arrived.
 
     Internal Function:
-    _api_request(host, path, username, password) - created for reusability for
-    various API calls
+    _api_request(path) - makes one GET, returns the response text (or error
+    string) and the seconds it took. GTM collections are read in pages of
+    GTM_PAGE_SIZE objects.
+
+    Each response is decoded once into typed records by the parsers in
+    f5_common/f5Stats.py.
+
+    With a 'deadline', calls still outstanding when it passes are abandoned
+    and their sections reported as timed out, the rest of the result string
+    is built from the calls that did complete. Every call also has a
+    'timeout', so an unreachable device cannot hang the caller. An abandoned
+    call keeps its 'limiter' slot until it finishes in the background, so
+    each call's timeouts (and the token login's) are cut to the time left
+    before the deadline, and slots are back soon after it rather than a
+    full 'timeout' later. The session is closed once those calls finish.
+
+    Authentication:
+    every call sends the device's cached X-F5-Auth-Token (see f5_common/f5Auth.py),
+    shared with the other F5 scripts, rather than basic auth
 
     Parameters:
     host - string, ip address of F5
     username - string
     password - string
+    maxParallel - integer, calls in flight to the F5 at once, default=MAX_PARALLEL
+    latencies - dictionary, if given it is filled with query name:seconds
+    timeout - (connect, read) seconds for each call, default=REQUEST_TIMEOUT
+    deadline - seconds from the start the device's checks must complete in,
+    default None waits for every call (each bounded by 'timeout')
+    limiter - threading.Semaphore held by each call while in flight, shared
+    by callers checking many devices to cap calls across all of them
+    deviceCache - DeviceCache (see f5_common/f5DeviceCache.py) the hostname
+    is read from, default is the one shared in the process (default_cache)
 
     Exceptions:
     exceptions are caught for any API call fails and indicative error added
@@ -34,33 +107,53 @@ def f5_daily_checks(host, username, password):
     string result collects these results and forms the body of the email
     '''
 
-    #GET hostname of the device from api call
-    path = "/mgmt/tm/sys/global-settings/?$select=hostname"
-    url = "https://"+host+path
-    try:
-        resp = requests.get(url, auth=(username, password), verify=False)
-        resp.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logging.debug(f'DEBUG GET request {path} failed error: {e}')
-        hostname = f'Host {host} api failed to get hostname'
-    else:
-        hostname = json.loads(resp.text)["hostname"].split('.')[0]
+    if deviceCache is None:
+        deviceCache = default_cache()
+    startTime = time.perf_counter()
+    deadlineAt = None if deadline is None else time.monotonic() + deadline
+    connectTimeout, readTimeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    #the token login runs inside the first call, so it keeps to the deadline too
+    loginTimeout = timeout if deadline is None else (min(connectTimeout, deadline), min(readTimeout, deadline))
+    #one session, pooled connections and token shared by every call to the device
+    session = stats_session(F5TokenAuth(host, username, password, timeout=loginTimeout), maxParallel)
 
-    #dashed lines for formatting result string which forms body of email
-    dashedLine = "\n--------------------------"
-    doubleDashedLine = "\n=========================="
+    #internal function to make API calls
+    def _api_request(path):
+        callStart = time.perf_counter()
+        if path.startswith("/mgmt/tm/gtm/"):
+            return get_paged(_get, path, GTM_PAGE_SIZE), time.perf_counter() - callStart
+        return _get(path), time.perf_counter() - callStart
 
-    #result string holds formatted text to be displayed in the body of the email
-    result = doubleDashedLine+"\n"+hostname.upper()+doubleDashedLine
-    hostname = host
+    #takes a limiter slot for a call, returns the timeout of the call or None
+    #if the deadline passes first. The timeouts are cut to the time left, so
+    #a call abandoned at the deadline soon gives its slot back
+    def _start_call():
+        #no point starting a call the deadline has already passed for
+        remaining = None if deadlineAt is None else max(0, deadlineAt - time.monotonic())
+        if limiter and not limiter.acquire(timeout=remaining):
+            return None
+        if deadlineAt is None:
+            return timeout
+        remaining = deadlineAt - time.monotonic()
+        if remaining <= 0:
+            if limiter:
+                limiter.release()
+            return None
+        return (min(connectTimeout, remaining), min(readTimeout, remaining))
 
-    #internal function to make API calls
-    def _api_request(host, path, username, password):
+    #one GET, each page of a paged collection is a separate call
+    def _get(path):
         status = ""
         url = "https://"+host+path
+        callTimeout = _start_call()
+        if callTimeout is None:
+            return f'{TIMED_OUT} GET request {path} not started before deadline'
         try:
-            resp = requests.get(url, auth=(username, password), verify=False)
+            resp = session.get(url, timeout=callTimeout)
             resp.raise_for_status()
+        except requests.exceptions.Timeout as e:
+            logging.debug(f'DEBUG GET request {path} timed out: {e}')
+            status = f'{TIMED_OUT} GET request {path}: {e}'
         except requests.exceptions.RequestException as e:
             #any other errors, alert and add info to status string
             logging.debug(f'DEBUG GET request {path} failed error: {e}')
@@ -70,154 +163,181 @@ def f5_daily_checks(host, username, password):
             if statusCode in range(200,230):
                 status = resp.text
             else:
-                status = resp
+                status = f'ERROR GET request {path} status {statusCode}'
+        finally:
+            if limiter:
+                limiter.release()
         return status
 
+    #hostname from the shared device cache, a call only if the entry has
+    #expired, which takes a limiter slot and keeps to the deadline like _get
+    def _hostname():
+        callStart = time.perf_counter()
+        callTimeout = None
+        try:
+            if deviceCache.get(host) is None:
+                callTimeout = _start_call()
+                if callTimeout is None:
+                    return f'{TIMED_OUT} hostname lookup not started before deadline', \
+                    time.perf_counter() - callStart
+            hostname = deviceCache.hostname(host, session, timeout=callTimeout or timeout)
+        except requests.exceptions.Timeout as e:
+            logging.debug(f'DEBUG hostname lookup timed out: {e}')
+            hostname = f'{TIMED_OUT} hostname lookup: {e}'
+        except (requests.exceptions.RequestException, ValueError, KeyError, sqlite3.Error) as e:
+            logging.debug(f'DEBUG hostname lookup failed error: {e}')
+            hostname = f'ERROR hostname lookup failed: {e}'
+        finally:
+            if callTimeout is not None and limiter:
+                limiter.release()
+        return hostname, time.perf_counter() - callStart
+
+    #issue every call at once, bounded per device, then build the result from
+    #whatever completed by the deadline
+    pool = ThreadPoolExecutor(max_workers=maxParallel, thread_name_prefix="f5check")
+    #the hostname first, it heads the report and is usually cached
+    calls = {"hostname": ["hostname"], **coalesce(CHECK_QUERIES)}
+    futures = {"hostname": pool.submit(_hostname)}
+    futures.update({path: pool.submit(_api_request, path) for path in calls if path != "hostname"})
+    done, notDone = wait(futures.values(), timeout=deadline)
+    running = [future for future in notDone if not future.cancel()]
+    #calls still in flight finish in the background and hold their limiter
+    #slots until then, their timeouts were cut to the deadline so not for
+    #long. Pages after the deadline are not requested. The session is closed
+    #once they have finished
+    if running:
+        pool.submit(lambda: (wait(running), session.close()))
+    else:
+        session.close()
+    pool.shutdown(wait=False)
+    #every query answered by a call gets that call's response
+    responses = {name: future.result() if future in done else \
+    (f'{TIMED_OUT} GET request {path} missed {deadline}s deadline', deadline) \
+    for path, future in futures.items() for name in calls[path]}
+    for name, (response, seconds) in responses.items():
+        logging.debug(f'DEBUG {host} {name} took {seconds:0.3f} seconds')
+        if latencies is not None:
+            latencies[name] = seconds
+    logging.debug(f'DEBUG {host} {len(calls)} calls took {time.perf_counter() - startTime:0.3f} seconds')
+    responses = {name: response for name, (response, seconds) in responses.items()}
+
+    #hostname of the device
+    if not responses["hostname"].startswith('ERROR'):
+        hostname = responses["hostname"]
+    elif responses["hostname"].startswith(TIMED_OUT):
+        hostname = f'Host {host} timed out getting hostname'
+    else:
+        hostname = f'Host {host} api failed to get hostname'
+
+    #dashed lines for formatting result string which forms body of email
+    dashedLine = "\n--------------------------"
+    doubleDashedLine = "\n=========================="
+
+    #result string holds formatted text to be displayed in the body of the email
+    result = doubleDashedLine+"\n"+hostname.upper()+doubleDashedLine
+    hostname = host
+
 
     #check if F5 unit online/healthy/active
-    pathHealth = "/mgmt/tm/cm/failover-status"
-    response = _api_request(host, pathHealth, username, password)
+    response = responses["health"]
     if not response.startswith('ERROR'):
         logging.debug(f'RESPONSE F5 unit health = {response}')
-        responseDict = (json.loads(response))["entries"] \
-        ["https://localhost/mgmt/tm/cm/failover-status/0"] \
-        ["nestedStats"]["entries"]
-        color = responseDict["color"]["description"]
-        status = responseDict["status"]["description"]
-        summary = responseDict["summary"]["description"]
-        result += f"\nDevice Status: {color.upper()}, {status}, {summary}{dashedLine}"
+        failover = parse_failover(response)
+        #keep the cached HA role current, it changes on failover
+        try:
+            deviceCache.update_role(host, failover.status)
+        except sqlite3.Error as e:
+            logging.debug(f'DEBUG device cache update failed error: {e}')
+        result += f"\nDevice Status: {failover.color.upper()}, {failover.status}, {failover.summary}{dashedLine}"
     else:
-        result += "\nError getting device Health/Active Status"
+        result += _section_error("device Health/Active Status", response)
 
 
     #check F5 memory status - current % usage
-    pathMemTotal = "/mgmt/tm/sys/host-info?$select=memoryTotal"
-    pathMemUsed = "/mgmt/tm/sys/host-info?$select=memoryUsed"
-    responseMemTotal = _api_request(host, pathMemTotal, username, password)
-    responseMemUsed = _api_request(host, pathMemUsed, username, password)
+    responseMemTotal = responses["memTotal"]
+    responseMemUsed = responses["memUsed"]
     if not responseMemUsed.startswith('ERROR') and not responseMemTotal.startswith('ERROR'):
-        logging.debug(f'RESPONSE F5 memory usage = {responseMemTotal} {responseMemTotal}')
-        responseMemTotalStr = (json.loads(responseMemTotal))["entries"] \
-        ["https://localhost/mgmt/tm/sys/host-info/0"]["nestedStats"]["entries"] \
-        ["memoryTotal"]["value"]
-        responseMemUsedStr = (json.loads(responseMemUsed))["entries"] \
-        ["https://localhost/mgmt/tm/sys/host-info/0"]["nestedStats"]["entries"] \
-        ["memoryUsed"]["value"]
-        result += f"\nResource Usage{dashedLine}\nCurrent Memory Usage: {round(int(responseMemUsedStr)/(0.01*int(responseMemTotalStr)))}%"
+        logging.debug(f'RESPONSE F5 memory usage = {responseMemTotal} {responseMemUsed}')
+        #one host-info call answers both, parse it once
+        memory = parse_memory(*{responseMemTotal, responseMemUsed})
+        result += f"\nResource Usage{dashedLine}\nCurrent Memory Usage: {memory.percentUsed}%"
     else:
-        result += "\nError getting memory usage"
+        result += _section_error("memory usage", responseMemTotal, responseMemUsed)
 
 
     #check F5 CPU status - last 5 mins usage
-    pathCpu = "/mgmt/tm/sys/cpu/stats"
-    cpu =  {}
-    responseCpu = _api_request(host, pathCpu, username, password)
+    responseCpu = responses["cpu"]
     if not responseCpu.startswith('ERROR'):
         logging.debug(f'RESPONSE CPU stats = {responseCpu}')
-        responseCpuDict = (json.loads(responseCpu))["entries"] \
-        ["https://localhost/mgmt/tm/sys/cpu/0/stats"] \
-        ["nestedStats"]["entries"]["https://localhost/mgmt/tm/sys/cpu/0/cpuInfo/stats"] \
-        ["nestedStats"]["entries"]
-        numCpus = len(responseCpuDict)
-        #loop through CPUs and add 5min avg to result string
-        for c in range(0, numCpus):
-            cpu[c] = responseCpuDict["https://localhost/mgmt/tm/sys/cpu/0/cpuInfo/"+str(c)+"/stats"] \
-            ["nestedStats"]["entries"]["fiveMinAvgIdle"]["value"]
-            result += "\nCPU-"+str(c)+" (5 Min Avg) "+" "+str(100-(cpu[c]))+"%"
+        #add 5min avg of each CPU to result string
+        for cpu in parse_cpu(responseCpu):
+            result += "\nCPU-"+str(cpu.cpuId)+" (5 Min Avg) "+" "+str(cpu.fiveMinAvgUsed)+"%"
     else:
-        result += "\nError getting CPU usage"
+        result += _section_error("CPU usage", responseCpu)
 
     #check F5 interface status
-    pathInt = "/mgmt/tm/net/interface/stats"
-    responseInt = _api_request(host, pathInt, username, password)
-    if not responseCpu.startswith('ERROR'):
+    responseInt = responses["interface"]
+    if not responseInt.startswith('ERROR'):
         logging.debug(f'RESPONSE Interface stats = {responseInt}')
-        responseIntDict = json.loads(responseInt)['entries']
         interfaces = 0
-        #loop through interfaces and add those with status 'up' to result string
-        for k,v in responseIntDict.items():
-            name  = v["nestedStats"]["entries"]["tmName"]["description"]
-            intStatus = v["nestedStats"]["entries"]["status"]["description"]
-            if intStatus == "up" and name != "mgmt":
+        #add interfaces with status 'up' to result string
+        for interface in parse_interfaces(responseInt):
+            if interface.status == "up" and interface.name != "mgmt":
                 if interfaces == 0:
                     result += f'{dashedLine}\nInterface Status{dashedLine}'
-                result += f"\nInterface {name} UP"
+                result += f"\nInterface {interface.name} UP"
             interfaces += 1
     else:
-        result += "\nError getting Interface status"
+        result += _section_error("Interface status", responseInt)
 
 
     #Check F5 hardware: Fans, PSU and Temp status
-    pathHardware = "/mgmt/tm/sys/hardware/stats"
-    tempHiLimit, tempCurrent = "", ""
-    fans, psu = {}, {}
-    responseHardware = _api_request(host, pathHardware, username, password)
+    responseHardware = responses["hardware"]
     if not responseHardware.startswith('ERROR'):
         logging.debug(f'RESPONSE Hardware stats = {responseHardware}')
-        responseFansDict = (json.loads(responseHardware))["entries"] \
-        ["https://localhost/mgmt/tm/sys/hardware/chassis-fan-status-index/stats"] \
-        ["nestedStats"]["entries"]
-        numFans = len(responseFansDict)
-        #loop through fans and add status to Fan dict
-        for f in range(1, numFans+1):
-            fans[f] = responseFansDict["https://localhost/mgmt/tm/sys/hardware/chassis-fan-status-index/"+str(f)+"/stats"] \
-            ["nestedStats"]["entries"]["status"]["description"]
-        responsePsuDict = (json.loads(responseHardware))["entries"] \
-        ["https://localhost/mgmt/tm/sys/hardware/chassis-power-supply-status-index/stats"] \
-        ["nestedStats"]["entries"]
-        numPsu = len(responsePsuDict)
-        #loop through PSU's and add status to PSU dict
-        for p in range(1, numPsu+1):
-            psu[p] = responsePsuDict["https://localhost/mgmt/tm/sys/hardware/chassis-power-supply-status-index/"+str(p)+"/stats"] \
-            ["nestedStats"]["entries"]["status"]["description"]
-        responseTempDict = (json.loads(responseHardware))["entries"] \
-        ["https://localhost/mgmt/tm/sys/hardware/chassis-temperature-status-index/stats"] \
-        ["nestedStats"]["entries"]["https://localhost/mgmt/tm/sys/hardware/chassis-temperature-status-index/1/stats"] \
-        ["nestedStats"]["entries"]
-        tempHiLimit = responseTempDict["hiLimit"]["value"]
-        tempCurrent = responseTempDict["temperature"]["value"]
+        fans, psus, temperatures = parse_hardware(responseHardware)
         #add values to result string
         result += dashedLine+"\nHardware Status"+dashedLine
-        for i in range(1, len(fans)+1):
-            result += "\nFan"+str(i)+" "+fans[i].upper()
-        for j in range(1, len(psu)+1):
-            result += "\nPSU"+str(j)+" "+psu[j].upper()
-        result += "\nChassis Temp Max"+" "+str(tempHiLimit)+"C"
-        result += "\nChassis Temp Current"+" "+str(tempCurrent)+"C"
+        for fan in fans:
+            result += "\nFan"+str(fan.index)+" "+fan.status.upper()
+        for psu in psus:
+            result += "\nPSU"+str(psu.index)+" "+psu.status.upper()
+        if temperatures:
+            result += "\nChassis Temp Max"+" "+str(temperatures[0].hiLimit)+"C"
+            result += "\nChassis Temp Current"+" "+str(temperatures[0].temperature)+"C"
     else:
-        result += "\nError getting Fans/PSU/Temp status"
+        result += _section_error("Fans/PSU/Temp status", responseHardware)
 
 
     #check GTM DCs status
-    #adjust as necessary for number of DCs..
-    DC1Status, DC2Status = "", ""
-    pathDC1GtmStatus = "/mgmt/tm/gtm/datacenter/~Common~DC1/stats?$select=status.availabilityState"
-    pathDC2GtmStatus = "/mgmt/tm/gtm/datacenter/~Common~DC2/stats?$select=status.availabilityState"
-    responseDC1GtmStatus = _api_request(host, pathDC1GtmStatus, username, password)
-    responseDC2GtmStatus = _api_request(host, pathDC2GtmStatus, username, password)
-    if not responseDC1GtmStatus.startswith('ERROR') and not responseDC2GtmStatus.startswith('ERROR'):
-        logging.debug(f'RESPONSE GTM DCs = {responseDC1GtmStatus}')
-        DC1Status = json.loads(responseDC1GtmStatus)["entries"]["https://localhost/mgmt/tm/gtm/datacenter/~Common~DC1/stats"] \
-        ["nestedStats"]["entries"]["status.availabilityState"]["description"]
-        DC2Status = json.loads(responseDC2GtmStatus)["entries"]["https://localhost/mgmt/tm/gtm/datacenter/~Common~DC2/stats"] \
-        ["nestedStats"]["entries"]["status.availabilityState"]["description"]
+    responseGtmDatacenters = responses["gtmDatacenters"]
+    if not responseGtmDatacenters.startswith('ERROR'):
+        logging.debug(f'RESPONSE GTM DCs = {responseGtmDatacenters}')
         result += dashedLine+"\nGTM/DNS Status"+dashedLine
-        result +="\nDC1 GTM DC\t"+DC1Status.upper()+"\nDC2 GTM DC\t"+DC2Status.upper()
+        for datacenter in parse_gtm(responseGtmDatacenters):
+            result += "\n"+datacenter.name+" GTM DC\t"+datacenter.availability.upper()
     else:
-        result +="\nError getting GTM DC status"
+        result += _section_error("GTM DC status", responseGtmDatacenters)
 
     #check GTM Servers object status
-    servers = {}
-    pathGtmServers = "/mgmt/tm/gtm/server/stats"
-    responseGtmServers = _api_request(host, pathGtmServers, username, password)
+    responseGtmServers = responses["gtmServers"]
     if not responseGtmServers.startswith('ERROR'):
         logging.debug(f' RESPONSE GTM Servers = {responseGtmServers}')
-        for k,v in (json.loads(responseGtmServers)["entries"]).items():
-            server = re.search(r'(~([\w]+)/)', k)
-            servers[server.group(2)] = v["nestedStats"]["entries"]["status.availabilityState"]["description"]
-        for k,v in servers.items(): result += " \nGTM server *"+str(k)+"*\t"+str(v).upper()
+        for server in parse_gtm(responseGtmServers):
+            result += " \nGTM server *"+server.name+"*\t"+server.availability.upper()
     else:
-        result += "\nError getting GTM Servers status"
+        result += _section_error("GTM Servers status", responseGtmServers)
+
+    #check GTM pools and wide IPs status, per record type
+    for kind, label in (("Pools", "pool"), ("Wideips", "wide IP")):
+        for recordType in GTM_RECORD_TYPES:
+            responseGtm = responses[f'gtm{kind}:{recordType}']
+            if not responseGtm.startswith('ERROR'):
+                logging.debug(f'RESPONSE GTM {kind} {recordType} = {responseGtm}')
+                for gtmObject in parse_gtm(responseGtm):
+                    result += f" \nGTM {label} *{gtmObject.name}* ({recordType.upper()})\t{gtmObject.availability.upper()}"
+            else:
+                result += _section_error(f"GTM {label} {recordType.upper()} status", responseGtm)
 
     return result
 
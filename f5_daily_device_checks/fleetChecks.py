@@ -0,0 +1,96 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Daily checks for a fleet of F5 devices using f5_daily_checks.
+
+Devices are checked concurrently, 'maxDevices' at a time, and a semaphore
+shared by every device caps the iControl calls in flight across the whole
+fleet at 'maxCalls', so adding devices does not add load beyond that. Each
+device has a deadline: sections whose calls have not completed when it passes
+are reported as timed out and the rest of that device's report is still
+built. An optional 'finishBy' bounds the whole run, devices still queued
+when it passes are reported as not checked and running devices have their
+deadline shortened to it, so the report is ready on time however many devices
+are in the inventory.
+
+Usage:
+python fleetChecks.py
+"""
+import time, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+from f5_daily_device_checks import f5_daily_checks, MAX_PARALLEL, REQUEST_TIMEOUT
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+#default devices checked at once
+MAX_DEVICES = 16
+#default iControl calls in flight across the fleet
+MAX_CALLS = 32
+#default seconds each device's checks must complete in
+DEVICE_DEADLINE = 60
+
+
+def fleet_daily_checks(inventory, maxDevices=MAX_DEVICES, maxCalls=MAX_CALLS, maxParallel=MAX_PARALLEL, \
+deadline=DEVICE_DEADLINE, finishBy=None, timeout=REQUEST_TIMEOUT, deviceCache=None):
+    """
+    Runs f5_daily_checks for every device in 'inventory'
+
+    Parameters:
+    inventory - list of dictionaries, one per device, with keys 'host',
+    'username' and 'password'
+    maxDevices - integer, devices checked at once, default=MAX_DEVICES
+    maxCalls - integer, calls in flight across all devices, default=MAX_CALLS
+    maxParallel - integer, calls in flight to one device, see f5_daily_checks
+    deadline - seconds each device's checks must complete in, default=DEVICE_DEADLINE
+    finishBy - seconds from now the whole run must complete in, default None
+    timeout - (connect, read) seconds for each call, see f5_daily_checks
+    deviceCache - DeviceCache shared by every device, default is the one
+    f5_daily_checks uses
+
+    Exceptions:
+    any exception raised checking a device is caught and reported in that
+    device's result, so one device cannot stop the run
+
+    Returns:
+    dictionary of device host:result string, in inventory order
+    """
+
+    startTime = time.monotonic()
+    limiter = threading.BoundedSemaphore(maxCalls)
+
+    def check(device):
+        host = device["host"]
+        deviceDeadline = deadline
+        if finishBy is not None:
+            remaining = finishBy - (time.monotonic() - startTime)
+            if remaining <= 0:
+                return f'\n==========================\n{host}\n==========================' \
+                '\nNot checked, run deadline passed'
+            deviceDeadline = remaining if deviceDeadline is None else min(deviceDeadline, remaining)
+        deviceStart = time.monotonic()
+        try:
+            result = f5_daily_checks(host, device["username"], device["password"], maxParallel, \
+            timeout=timeout, deadline=deviceDeadline, limiter=limiter, deviceCache=deviceCache)
+        except Exception as e:
+            #eg an unexpected response shape, must not stop the rest of the fleet
+            logging.debug(f'DEBUG {host} f5_daily_checks raised {e!r}')
+            result = f'\n==========================\n{host}\n==========================' \
+            f'\nERROR checks failed: {e!r}'
+        logging.debug(f'DEBUG {host} checked in {time.monotonic() - deviceStart:0.3f} seconds')
+        return result
+
+    with ThreadPoolExecutor(max_workers=maxDevices, thread_name_prefix="fleetcheck") as pool:
+        results = pool.map(check, inventory)
+        return {device["host"]: result for device, result in zip(inventory, results)}
+
+
+if __name__ == "__main__":
+    inventory = [
+        {"host": "IP1", "username": "username", "password": "password"},
+        {"host": "IP2", "username": "username", "password": "password"},
+    ]
+    #eg started 30 mins before business hours
+    results = fleet_daily_checks(inventory, finishBy=1800)
+    print("\n".join(results.values()))
@@ -1,12 +1,16 @@
-import requests, json, re, datetime, logging, os
+import requests, re, datetime, logging, os, sys, sqlite3
+import urllib3
 from netmiko import ConnectHandler
 from netmiko.ssh_exception import NetMikoTimeoutException
 from netmiko.ssh_exception import NetMikoAuthenticationException
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_common"))
+from f5Auth import F5TokenAuth
+from f5DeviceCache import default_cache
 logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
 {message} ({filename}:{lineno})", style="{")
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def ssl_cert_expiry(deviceDetails):
+def ssl_cert_expiry(deviceDetails, deviceCache=None):
     """
     Check F5 device for SSL traffic certs (NOT device certs) that expire in next XX days
 
@@ -23,6 +27,8 @@ def ssl_cert_expiry(deviceDetails):
 
     Parameters:
     deviceDetails - dictionary, continaing target F5 details - as per netmiko docco
+    deviceCache - DeviceCache (see f5_common/f5DeviceCache.py) the hostname
+    is read from, default is the one shared in the process
 
     Exceptions:
     -exceptions are caught for any netmiko connections
@@ -31,17 +37,19 @@ def ssl_cert_expiry(deviceDetails):
     succesful SSH call and parsing will return a string detailing those certs
     due to expire within threshold days.
     """
-    #GET hostname of the device from api call
-    path = "/mgmt/tm/sys/global-settings/?$select=hostname"
-    url = "https://"+deviceDetails["host"]+path
-    try:
-        resp = requests.get(url, auth=(deviceDetails["username"], deviceDetails["password"]), verify=False)
-        resp.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logging.debug(f'DEBUG GET request {path} failed error: {e}')
-        hostname = f'Host {host} api failed to get hostname'
-    else:
-        hostname = json.loads(resp.text)["hostname"].split('.')[0]
+    #hostname of the device from the shared device cache, the api is only
+    #called (with the shared cached token) when the cached row is stale
+    if deviceCache is None:
+        deviceCache = default_cache()
+    with requests.Session() as session:
+        session.auth = F5TokenAuth(deviceDetails["host"], deviceDetails["username"], deviceDetails["password"])
+        session.verify = False
+        session.trust_env = False
+        try:
+            hostname = deviceCache.hostname(deviceDetails["host"], session)
+        except (requests.exceptions.RequestException, ValueError, KeyError, sqlite3.Error) as e:
+            logging.debug(f'DEBUG device cache hostname lookup failed error: {e}')
+            hostname = f'Host {deviceDetails["host"]} api failed to get hostname'
 
     certExpiryDays = []
     dashedLine = "\n-------------------------"
@@ -21,11 +21,6 @@ for pulling data from older F5 units (the API stats for VPN usgae were inaccurat
 Uses pysnmp package for SNMP polling.
 """
 
-#establish time/date variables
-getDate = datetime.datetime.now()
-time = str(getDate.strftime("%d/%m/%Y %H:%M:%S"))+" "
-date = str(getDate.strftime("_%d_%m_%Y"))
-
 f5DestAkl = '10.11.12.13'
 f5DestWlg = '10.12.13.14'
 f5DestWlg002 = '10.13.14.15'
@@ -74,27 +69,34 @@ def getSnmpResponse(f5Dest, oid):
     else:
         return returnedValues
 
-#pull memory values from both AkL/Wlg and convert to int to calculate usage %
-memTotalValueWlg = int(getSnmpResponse(f5DestWlg, oidMemTotal))
-memUsedValueWlg = int(getSnmpResponse(f5DestWlg, oidMemUsed))
-memTotalValueAkl = int(getSnmpResponse(f5DestAkl, oidMemTotal))
-memUsedValueAkl = int(getSnmpResponse(f5DestAkl, oidMemUsed))
-#calculate usage % by rounding memtotal/100 to 2 digits and then
-#using it to divide memUsed to find %, then round to whole number
-memUsedPercentWlg = str(round((memUsedValueWlg /round((memTotalValueWlg /100), 2))))
-memUsedPercentAkl = str(round((memUsedValueAkl /round((memTotalValueAkl /100), 2))))
-#pull CPU OID and round it to whole number
-cpuPercentWlg = str(round(int(getSnmpResponse(f5DestWlg, oidCpu))))
-cpuPercentAkl = str(round(int(getSnmpResponse(f5DestAkl, oidCpu))))
-#pull Current APM users
-apmCurrentUsersWlg = str(int(getSnmpResponse(f5DestWlg, oidMyvpnUsersWlg)))
-apmCurrentUsersAkl = str(int(getSnmpResponse(f5DestAkl, oidMyvpnUsersAkl)))
+#poll only when run as a script, so getSnmpResponse can be imported (eg by the metrics exporter)
+if __name__ == "__main__":
+    #establish time/date variables
+    getDate = datetime.datetime.now()
+    time = str(getDate.strftime("%d/%m/%Y %H:%M:%S"))+" "
+    date = str(getDate.strftime("_%d_%m_%Y"))
+
+    #pull memory values from both AkL/Wlg and convert to int to calculate usage %
+    memTotalValueWlg = int(getSnmpResponse(f5DestWlg, oidMemTotal))
+    memUsedValueWlg = int(getSnmpResponse(f5DestWlg, oidMemUsed))
+    memTotalValueAkl = int(getSnmpResponse(f5DestAkl, oidMemTotal))
+    memUsedValueAkl = int(getSnmpResponse(f5DestAkl, oidMemUsed))
+    #calculate usage % by rounding memtotal/100 to 2 digits and then
+    #using it to divide memUsed to find %, then round to whole number
+    memUsedPercentWlg = str(round((memUsedValueWlg /round((memTotalValueWlg /100), 2))))
+    memUsedPercentAkl = str(round((memUsedValueAkl /round((memTotalValueAkl /100), 2))))
+    #pull CPU OID and round it to whole number
+    cpuPercentWlg = str(round(int(getSnmpResponse(f5DestWlg, oidCpu))))
+    cpuPercentAkl = str(round(int(getSnmpResponse(f5DestAkl, oidCpu))))
+    #pull Current APM users
+    apmCurrentUsersWlg = str(int(getSnmpResponse(f5DestWlg, oidMyvpnUsersWlg)))
+    apmCurrentUsersAkl = str(int(getSnmpResponse(f5DestAkl, oidMyvpnUsersAkl)))
 
-#open file to save to same values oid file each day
-with open(f'valuesWlg{date}.txt', 'a') as valuesFileWlg, \
-open(f'valuesAkl{date}.txt', 'a') as valuesFileAkl:
-#write values to file
-    valuesFileWlg.write(f'\n'+time+" "+memUsedPercentWlg+" "+cpuPercentWlg+" "\
-    +apmCurrentUsersWlg)
-    valuesFileAkl.write(f'\n'+time+" "+memUsedPercentAkl+" "+cpuPercentAkl+" "\
-    +apmCurrentUsersAkl)
+    #open file to save to same values oid file each day
+    with open(f'valuesWlg{date}.txt', 'a') as valuesFileWlg, \
+    open(f'valuesAkl{date}.txt', 'a') as valuesFileAkl:
+    #write values to file
+        valuesFileWlg.write(f'\n'+time+" "+memUsedPercentWlg+" "+cpuPercentWlg+" "\
+        +apmCurrentUsersWlg)
+        valuesFileAkl.write(f'\n'+time+" "+memUsedPercentAkl+" "+cpuPercentAkl+" "\
+        +apmCurrentUsersAkl)
@@ -0,0 +1,400 @@
+#! python3.8
+#git at cloudsecurity period nz
+"""
+Long running Prometheus/OpenMetrics exporter for the data collected by the
+daily check scripts (f5_daily_checks, pa_daily_checks) and getF5Snmp.py.
+
+The exporter polls devices on its own schedule and keeps the latest values
+in memory, a scrape of /metrics is answered from that cache and never calls
+a device, so any number of Prometheus servers or dashboards can scrape as
+often as they like without adding load to the devices' management planes.
+
+Each kind of data is polled at its own interval (POLL_INTERVALS), eg CPU and
+memory every 15 seconds but fans and PSUs every 5 minutes. A poll that is
+still running when it is next due is skipped rather than queued. When a poll
+fails its values are removed from the cache, rather than served stale, and
+'netdev_poll_success' for that device and group drops to 0.
+
+F5 polls use the shared F5 code: one pooled, token authenticated session
+per device, the $select coalescing query layer and the typed stats parsers
+(see f5_common). Palo Alto polls run pa_daily_checks (needs xmltodict) and
+SNMP polls use getSnmpResponse from getF5Snmp.py (needs pysnmp), adding a
+device of a kind whose package is not installed raises a RuntimeError.
+
+Usage:
+python metricsExporter.py [port]
+then scrape http://<host>:<port>/metrics
+"""
+import sys, os, time, heapq, threading, itertools, logging
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_common"))
+from f5Auth import F5TokenAuth
+from f5Query import Query, coalesce, stats_session, GTM_RECORD_TYPES
+from f5Stats import loads, stats_entries, parse_failover, parse_memory, parse_cpu, parse_hardware, parse_gtm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paloalto_daily_device_checks"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f5_vpn_snmp_stats"))
+try:
+    from paloalto_daily_device_checks import pa_daily_checks
+except ImportError:
+    pa_daily_checks = None
+try:
+    from getF5Snmp import getSnmpResponse, oidCpu, oidMemTotal, oidMemUsed
+except ImportError:
+    getSnmpResponse = None
+
+logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
+{message} ({filename}:{lineno})", style="{")
+logging.disable(logging.CRITICAL)
+
+EXPORTER_PORT = 9742
+#default seconds between polls of each group of data
+POLL_INTERVALS = {"failover": 30, "memory": 15, "cpu": 15, "interfaces": 30, "hardware": 300, "gtm": 60, \
+"paloalto": 300, "snmp": 60}
+#polls in flight across all devices
+MAX_PARALLEL = 8
+#(connect, read) seconds for each device call
+REQUEST_TIMEOUT = (5, 20)
+
+#data read by each F5 poll group, merged into one call per endpoint
+F5_QUERIES = {
+    "failover": (Query("failover", "/mgmt/tm/cm/failover-status", None),),
+    "memory": (Query("memory", "/mgmt/tm/sys/host-info", ("memoryTotal", "memoryUsed")),),
+    "cpu": (Query("cpu", "/mgmt/tm/sys/cpu/stats", None),),
+    "interfaces": (Query("interfaces", "/mgmt/tm/net/interface/stats", ("tmName", "status", \
+    "counters.bitsIn", "counters.bitsOut", "counters.dropsAll", "counters.errorsAll")),),
+    "hardware": (Query("hardware", "/mgmt/tm/sys/hardware/stats", None),),
+    #pools and wide IPs of every record type, named eg 'pool/aaaa'
+    "gtm": tuple(Query(kind, f'/mgmt/tm/gtm/{kind}/stats', ("tmName", "status.availabilityState")) \
+    for kind in ("datacenter", "server") + tuple(f'{kind}/{recordType}' for kind in ("pool", "wideip") \
+    for recordType in GTM_RECORD_TYPES)),
+}
+
+#metric name:(type, help)
+METRICS = {
+    "netdev_poll_success": ("gauge", "1 if the last poll of the group succeeded"),
+    "netdev_poll_duration_seconds": ("gauge", "seconds the last poll of the group took"),
+    "netdev_poll_timestamp_seconds": ("gauge", "unix time of the last successful poll of the group"),
+    "f5_failover_active": ("gauge", "1 if the unit is the active member of its traffic group"),
+    "f5_failover_info": ("gauge", "failover status and color of the unit"),
+    "f5_memory_total_bytes": ("gauge", "TMM host memory"),
+    "f5_memory_used_bytes": ("gauge", "TMM host memory in use"),
+    "f5_cpu_usage_percent": ("gauge", "5 minute average CPU usage"),
+    "f5_interface_up": ("gauge", "1 if the interface status is up"),
+    "f5_interface_bits_in_total": ("counter", "bits received"),
+    "f5_interface_bits_out_total": ("counter", "bits sent"),
+    "f5_interface_drops_total": ("counter", "packets dropped"),
+    "f5_interface_errors_total": ("counter", "interface errors"),
+    "f5_fan_up": ("gauge", "1 if the chassis fan status is up"),
+    "f5_psu_up": ("gauge", "1 if the power supply status is up"),
+    "f5_temperature_celsius": ("gauge", "chassis temperature"),
+    "f5_temperature_limit_celsius": ("gauge", "chassis temperature high limit"),
+    "f5_gtm_available": ("gauge", "1 if the GTM object availability is available"),
+    "pa_cpu_usage_percent": ("gauge", "current CPU usage"),
+    "pa_ha_info": ("gauge", "HA state of the device"),
+    "pa_fan_alarm": ("gauge", "1 if the fan has an alarm"),
+    "pa_psu_alarm": ("gauge", "1 if the power supply has an alarm"),
+    "pa_interface_up": ("gauge", "1 for each interface or aggregate that is up"),
+    "f5_snmp_cpu_usage_percent": ("gauge", "CPU usage polled by SNMP"),
+    "f5_snmp_memory_used_percent": ("gauge", "memory usage polled by SNMP"),
+    "f5_snmp_apm_sessions": ("gauge", "current APM sessions of the leasepool OID polled by SNMP"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricCache:
+    """
+    This class holds the latest samples of every device and poll group and
+    renders them in the Prometheus text exposition format.
+
+    Methods:
+    - update - replaces the samples of a device and group
+    - samples - returns the samples of a device and group
+    - render - returns the exposition text, rebuilt only after an update
+
+    A sample is a tuple of (metric name, dictionary of labels, value).
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._text = {}
+
+    def update(self, device, group, samples):
+        with self._lock:
+            self._groups[(device, group)] = samples
+            self._text = {}
+
+    def samples(self, device, group):
+        with self._lock:
+            return list(self._groups.get((device, group), []))
+
+    def render(self, openMetrics=False):
+        """
+        returns the cached samples as text, in OpenMetrics format (with its
+        '# EOF' terminator) if 'openMetrics'
+        """
+        with self._lock:
+            if openMetrics in self._text:
+                return self._text[openMetrics]
+            families = {}
+            for (device, group), samples in sorted(self._groups.items()):
+                for name, labels, value in samples:
+                    labels = dict({"device": device}, **labels)
+                    labelText = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+                    families.setdefault(name, []).append(f'{name}{{{labelText}}} {value}')
+            lines = []
+            for name, samples in families.items():
+                metricType, helpText = METRICS.get(name, ("gauge", name))
+                #OpenMetrics names a counter family without its samples' _total suffix
+                family = name[:-len("_total")] if openMetrics and metricType == "counter" else name
+                lines += [f'# HELP {family} {helpText}', f'# TYPE {family} {metricType}'] + samples
+            if openMetrics:
+                lines.append("# EOF")
+            self._text[openMetrics] = "\n".join(lines)+"\n"
+            return self._text[openMetrics]
+
+
+def _f5_samples(group, responses):
+    """
+    Converts the responses of an F5 poll group, dictionary of query
+    name:response text, to samples
+    """
+
+    samples = []
+    if group == "failover":
+        failover = parse_failover(responses["failover"])
+        samples.append(("f5_failover_active", {}, int(failover.status == "ACTIVE")))
+        samples.append(("f5_failover_info", {"status": failover.status, "color": failover.color}, 1))
+    elif group == "memory":
+        memory = parse_memory(responses["memory"])
+        samples += [("f5_memory_total_bytes", {}, memory.total), ("f5_memory_used_bytes", {}, memory.used)]
+    elif group == "cpu":
+        samples += [("f5_cpu_usage_percent", {"cpu": str(cpu.cpuId)}, cpu.fiveMinAvgUsed) \
+        for cpu in parse_cpu(responses["cpu"])]
+    elif group == "interfaces":
+        for name, entries in stats_entries(loads(responses["interfaces"]).get("entries", {}))[1].items():
+            fields = stats_entries(entries)[0]
+            labels = {"interface": fields.get("tmName", name)}
+            samples.append(("f5_interface_up", labels, int(fields.get("status") == "up")))
+            for metric, field in (("f5_interface_bits_in_total", "counters.bitsIn"), ("f5_interface_bits_out_total", \
+            "counters.bitsOut"), ("f5_interface_drops_total", "counters.dropsAll"), ("f5_interface_errors_total", \
+            "counters.errorsAll")):
+                if field in fields:
+                    samples.append((metric, labels, fields[field]))
+    elif group == "hardware":
+        fans, psus, temperatures = parse_hardware(responses["hardware"])
+        samples += [("f5_fan_up", {"fan": str(fan.index)}, int(fan.status == "up")) for fan in fans]
+        samples += [("f5_psu_up", {"psu": str(psu.index)}, int(psu.status == "up")) for psu in psus]
+        for sensor in temperatures:
+            samples.append(("f5_temperature_celsius", {"sensor": str(sensor.index)}, sensor.temperature))
+            samples.append(("f5_temperature_limit_celsius", {"sensor": str(sensor.index)}, sensor.hiLimit))
+    else:
+        for name, text in responses.items():
+            #pools and wide IPs are labelled with their record type, eg type="aaaa"
+            kind, _, recordType = name.partition("/")
+            labels = {"kind": kind, "type": recordType} if recordType else {"kind": kind}
+            samples += [("f5_gtm_available", dict(labels, name=gtmObject.name), \
+            int(gtmObject.availability == "available")) for gtmObject in parse_gtm(text)]
+    return samples
+
+
+def _pa_samples(deviceInfo):
+    """converts one device's dictionary from pa_daily_checks to samples"""
+    if "error" in deviceInfo:
+        raise RuntimeError(deviceInfo["error"])
+    samples = []
+    if "cpuusage" in deviceInfo:
+        samples.append(("pa_cpu_usage_percent", {}, int(deviceInfo["cpuusage"].rstrip("%"))))
+    state = deviceInfo.get("hastate", deviceInfo.get("hastatus"))
+    if state:
+        samples.append(("pa_ha_info", {"state": state, "hostname": deviceInfo.get("hostname", "")}, 1))
+    for key, value in deviceInfo.items():
+        if key.startswith(("fan", "psu")) and key.endswith("alarm"):
+            samples.append((f'pa_{key[:3]}_alarm', {key[:3]: key[3:-len("alarm")]}, int(str(value) == "True")))
+        elif key.startswith(("if_", "ag_")):
+            samples.append(("pa_interface_up", {"interface": value}, 1))
+    return samples
+
+
+class MetricsExporter:
+    """
+    This class polls devices on a schedule into a MetricCache and serves the
+    cache over HTTP.
+
+    Methods:
+    - add_f5 - polls an F5 by iControl REST, one job per poll group
+    - add_paloalto - polls Palo Alto devices with pa_daily_checks
+    - add_snmp - polls an F5 by SNMP
+    - poll_due - runs every job that is due, returns seconds until the next
+    - run - polls forever in a background thread and serves /metrics on 'port'
+    - stop - stops polling and serving
+
+    Instance Attributes:
+    -self.cache - MetricCache served to scrapes
+    -self.intervals - dictionary of poll group:seconds, default POLL_INTERVALS
+    """
+
+    def __init__(self, intervals=None, maxParallel=MAX_PARALLEL, timeout=REQUEST_TIMEOUT):
+        self.cache = MetricCache()
+        self.intervals = dict(POLL_INTERVALS, **(intervals or {}))
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=maxParallel, thread_name_prefix="poll")
+        self._jobs = []
+        self._sequence = itertools.count()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sessions = []
+        self._server = None
+
+    def _schedule(self, device, group, function):
+        #first polls are due at once, spread out by the heap order
+        heapq.heappush(self._jobs, (time.monotonic(), next(self._sequence), device, group, function))
+
+    def add_f5(self, host, username, password, groups=tuple(F5_QUERIES)):
+        """adds F5 'host', polled by iControl REST for each of 'groups'"""
+        session = stats_session(F5TokenAuth(host, username, password), 2)
+        self._sessions.append(session)
+
+        def poll(group):
+            responses = {}
+            calls = coalesce(F5_QUERIES[group])
+            for path, names in calls.items():
+                resp = session.get("https://"+host+path, timeout=self.timeout)
+                #an LTM only unit has no GTM objects, report what it has
+                if group == "gtm" and resp.status_code == 404:
+                    continue
+                resp.raise_for_status()
+                for name in names:
+                    responses[name] = resp.text
+            return _f5_samples(group, responses)
+
+        for group in groups:
+            self._schedule(host, group, poll)
+
+    def add_paloalto(self, host, apiKey, DCs=()):
+        """adds Palo Alto device 'host', polled with pa_daily_checks"""
+        if pa_daily_checks is None:
+            raise RuntimeError("Palo Alto polling needs the xmltodict package, pip install xmltodict")
+        self._schedule(host, "paloalto", lambda group: _pa_samples(pa_daily_checks({host: apiKey}, DCs)[host]))
+
+    def add_snmp(self, host, apmOid=None):
+        """adds F5 'host', polled by SNMP for CPU, memory and optionally APM sessions of 'apmOid'"""
+        if getSnmpResponse is None:
+            raise RuntimeError("SNMP polling needs the pysnmp package, pip install pysnmp")
+
+        def poll(group):
+            def value(oid):
+                response = getSnmpResponse(host, oid)
+                if str(response).startswith("ERROR"):
+                    raise RuntimeError(response)
+                return int(response)
+            samples = [("f5_snmp_cpu_usage_percent", {}, value(oidCpu)), \
+            ("f5_snmp_memory_used_percent", {}, round(value(oidMemUsed) / (0.01 * value(oidMemTotal))))]
+            if apmOid:
+                samples.append(("f5_snmp_apm_sessions", {}, value(apmOid)))
+            return samples
+
+        self._schedule(host, "snmp", poll)
+
+    def _poll(self, device, group, function):
+        startTime = time.monotonic()
+        try:
+            samples = function(group)
+            success = 1
+        except Exception as e:
+            #drop the group's values rather than serve them stale
+            logging.debug(f'DEBUG poll {device} {group} failed: {e!r}')
+            samples, success = [], 0
+        duration = time.monotonic() - startTime
+        status = [("netdev_poll_success", {"group": group}, success), \
+        ("netdev_poll_duration_seconds", {"group": group}, round(duration, 3))]
+        if success:
+            status.append(("netdev_poll_timestamp_seconds", {"group": group}, round(time.time(), 3)))
+        else:
+            status += [sample for sample in self.cache.samples(device, group) \
+            if sample[0] == "netdev_poll_timestamp_seconds"]
+        self.cache.update(device, group, samples + status)
+        with self._lock:
+            self._running.discard((device, group))
+
+    def poll_due(self):
+        """
+        submits every job that is due to the poll pool, skipping any whose
+        previous poll is still running
+
+        Returns:
+        seconds until the next job is due
+        """
+        now = time.monotonic()
+        while self._jobs and self._jobs[0][0] <= now:
+            due, sequence, device, group, function = heapq.heappop(self._jobs)
+            with self._lock:
+                running = (device, group) in self._running
+                self._running.add((device, group))
+            if running:
+                logging.debug(f'DEBUG poll {device} {group} still running, skipped')
+            else:
+                self._pool.submit(self._poll, device, group, function)
+            #keep to the schedule, unless it has fallen a whole interval behind
+            interval = self.intervals[group]
+            heapq.heappush(self._jobs, (max(due + interval, now), sequence, device, group, function))
+        return self._jobs[0][0] - now if self._jobs else 1
+
+    def _poll_forever(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(min(1, max(0, self.poll_due())))
+
+    def run(self, port=EXPORTER_PORT, address=""):
+        """starts polling and serves /metrics on 'port' in background threads, returns self"""
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug(f'DEBUG scrape {self.address_string()} {format % args}')
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                openMetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+                data = exporter.cache.render(openMetrics).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8" \
+                if openMetrics else "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="scrapes", daemon=True).start()
+        threading.Thread(target=self._poll_forever, name="scheduler", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        self._pool.shutdown(wait=False)
+        for session in self._sessions:
+            session.close()
+
+
+if __name__ == "__main__":
+    exporter = MetricsExporter()
+    exporter.add_f5("IP1", "username", "password")
+    exporter.add_f5("IP2", "username", "password")
+    #exporter.add_paloalto("IP3", "APIKey", ["DC1", "DC2"])
+    #exporter.add_snmp("10.11.12.13", '.1.3.6.1.4.1.3375.2.6.2.1.3.1.3.<specific object part of oid>')
+    exporter.run(int(sys.argv[1]) if len(sys.argv) > 1 else EXPORTER_PORT)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        exporter.stop()
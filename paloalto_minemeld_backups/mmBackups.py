@@ -2,8 +2,11 @@
 #git at cloudsecurity period nz
 
 
-import json, requests, os, time, random, logging
+import sys, json, requests, os, time, random, logging, hashlib, sqlite3
 from datetime import date
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from backupCatalog import BackupCatalog, MINEMELD
+from archiveCrypto import EncryptingWriter, ENC_SUFFIX
 """
 Script to create and download backups from Palo Alto Minemeld Servers 
 and store in specified local directory
@@ -17,7 +20,7 @@ logging.basicConfig(level=logging.DEBUG, format="{asctime} {processName:<12} \
 logging.disable(logging.CRITICAL)
 
 
-def mmBackup(IP, username, password):
+def mmBackup(IP, username, password, catalog=None, encryptKey=None):
     """
     Creates a mimemeld backup file and downloads and writes to local directory
 
@@ -26,12 +29,21 @@ def mmBackup(IP, username, password):
     -iterates API calls to determine status of backup job
     -If status is 'DONE', makes API call to download file and store in specified
     directory
+    -The download is streamed, each block hashed and written (encrypted if
+    'encryptKey' is given) as it arrives, so the backup is not held in memory
+    and is never on disk unencrypted
+    -Records the backup file, its md5/sha256 and download time in the backup
+    catalog (see backup_store/backupCatalog.py)
 
     Parameters:
     The following instance attributes are used in API calls:
     -IP - the IP of the minemeld server
     -username - minemeld admin account username
     -password - minemeld admin account password
+    -catalog - BackupCatalog to record the backup in, default is the catalog
+    file in the working directory
+    -encryptKey - 32 byte key, if given the backup is stored encrypted as
+    <backup>.zip.enc (see backup_store/archiveCrypto.py)
 
     Exceptions:
     exceptions are caught for an requests module API calls and stored as
@@ -51,12 +63,14 @@ def mmBackup(IP, username, password):
     today = date.today()
     day = today.strftime("%d_%m_%Y")
     randy = str(random.randint(100,900))+"_"
+    startTime = time.perf_counter()
     #set API URLs
     exportUrl = "https://"+IP+"/status/backup"
     statusUrl = "https://"+IP+"/jobs/status-backup/"
 
     #set directory location to store the backup files
     backupFile = os.getcwd()+"\\MMBackups\\"+randy+day+"_"+site+"minemeld.zip"
+    storedFile = backupFile+ENC_SUFFIX if encryptKey else backupFile
     #set required header values
     exportHeader = {"Content-Type" : "application/json"}
     downloadHeader = {"Content-Type" : "application/zip"}
@@ -93,20 +107,33 @@ def mmBackup(IP, username, password):
                     #if response json body 'status' key is 'Done,' exit loop
                     if statusString == 'DONE':
                         ready = True
+            md5, sha256 = hashlib.md5(), hashlib.sha256()
             try:
                 #once status DONE confirmed, download the backup file
-                downloadResp = requests.get(exportUrl+"/"+jobString, auth=(username, password), verify = False, headers = downloadHeader)
+                downloadResp = requests.get(exportUrl+"/"+jobString, auth=(username, password), verify = False, \
+                headers = downloadHeader, stream=True)
                 downloadResp.raise_for_status()
+                #hash and write (or encrypt) each block as it arrives, one pass over the data
+                with EncryptingWriter(storedFile, encryptKey) if encryptKey else open(storedFile, 'wb') as file:
+                    for block in downloadResp.iter_content(1024 * 1024):
+                        md5.update(block)
+                        sha256.update(block)
+                        file.write(block)
             except requests.exceptions.RequestException as e:
                 #any other errors, send email alert and abort
                 logging.debug(f'DEBUG GET export download failed error: {e}')
                 status = f'ERROR GET export download call failed: {e}'
             else:
-                #write backup file to specified directory
-                with open(backupFile, 'wb') as file:
-                    file.write(downloadResp.content)
-                if os.path.exists(backupFile) and os.path.getsize(backupFile) > 1000:
-                    status = os.path.basename(backupFile)+" Filesize "+str(os.path.getsize(backupFile)/1000)+"KB\n\n"
+                if os.path.exists(storedFile) and os.path.getsize(storedFile) > 1000:
+                    status = os.path.basename(storedFile)+" Filesize "+str(os.path.getsize(storedFile)/1000)+"KB\n\n"
+                    digests = {"md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+                    if encryptKey:
+                        digests["encryptedSha256"] = file.sha256.hexdigest()
+                    try:
+                        (catalog or BackupCatalog()).record(IP, MINEMELD, storedFile, digests=digests, \
+                        seconds=time.perf_counter() - startTime)
+                    except (sqlite3.Error, OSError) as e:
+                        logging.debug(f'DEBUG catalog record failed error: {e}')
     #return name of file, if backup successful; else, return exception details
     return status
 
@@ -1,13 +1,17 @@
 #! python3
 #git at cloudsecurity period nz
 from sendEmail import SendEmail as email
-import requests, os, shutils, random
+import sys, requests, os, shutils, random, time, hashlib, sqlite3, logging
 import xml.etree.ElementTree as ET
 from datetime import date
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup_store"))
+from backupCatalog import BackupCatalog, PANORAMA
+from archiveCrypto import EncryptingWriter, ENC_SUFFIX, load_key
 """
 A short script to:
 - call Palo Alto Panorama XML API and get running config file
-- store file in local backup directory
+- store file in local backup directory (encrypted if a key file is set) and
+record it in the backup catalog
 - parse running-config file to find security rules with specific tags
 to be used as reminder for auditing etc
 
@@ -22,25 +26,47 @@ day = today.strftime("%d_%m_%Y")
 randy = str(random.randint(100,900))+"_"
 #prepare API call and authentication header
 apiKey = {"X-PAN-KEY" : "LUFRPridiculouslylongapistringOaQ=="}
-url = "https://10.34.35.36/api/?type=export&category=configuration"
+panoramaIP = "10.34.35.36"
+url = "https://"+panoramaIP+"/api/?type=export&category=configuration"
+#key file made with 'archiveCrypto.py genkey' to store the export encrypted, empty for plain
+encryptKeyFile = ""
+encryptKey = load_key(encryptKeyFile) if encryptKeyFile else None
 
 
 #determine the full path for the config backup file to go to
 backupFile = os.getcwd()+"\\PABackups\\"+randy+day+"_running-config.xml"
-resp = requests.get(url, headers=apiKey, verify=False)
+if encryptKey:
+    backupFile += ENC_SUFFIX
+startTime = time.perf_counter()
 status = ""
+md5, sha256 = hashlib.md5(), hashlib.sha256()
+#the export is parsed as it streams in, so an encrypted backup is never read back
+parser = ET.XMLParser()
 try:
-    #download file and write to specified backup location
-    with open(backupFile, 'wb') as file:
-        file.write(resp.content)
-except IOError as e:
+    #download file and write to specified backup location, hashing, encrypting
+    #and parsing each block in the same pass
+    resp = requests.get(url, headers=apiKey, verify=False, stream=True)
+    resp.raise_for_status()
+    with EncryptingWriter(backupFile, encryptKey) if encryptKey else open(backupFile, 'wb') as file:
+        for block in resp.iter_content(1024 * 1024):
+            md5.update(block)
+            sha256.update(block)
+            parser.feed(block)
+            file.write(block)
+    root = parser.close()
+except (IOError, ET.ParseError) as e:
     #if exception, send error string indicating API call failed
     status = f"ERROR downloading Panorama backup file {e}"
-    logging.debug(f"DEBUG file write error: {e}")
+    logging.debug(f"DEBUG download or file write error: {e}")
 else:
-    #open and parse the downloaded XML config file
-    tree = ET.parse(backupFile)
-    root = tree.getroot()
+    digests = {"md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+    if encryptKey:
+        digests["encryptedSha256"] = file.sha256.hexdigest()
+    try:
+        BackupCatalog().record(panoramaIP, PANORAMA, backupFile, digests=digests, \
+        seconds=time.perf_counter() - startTime)
+    except (sqlite3.Error, OSError) as e:
+        logging.debug(f"DEBUG catalog record failed error: {e}")
     auditRules, deviceGroups = [], []
     desc = ""
     #determine the number of data groups